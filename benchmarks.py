@@ -0,0 +1,766 @@
+"""
+Benchmarks for sparqy's hot paths.
+
+Run with ``uv run benchmarks.py``; see ``--help`` for options. The pipeline
+suite saves its results as JSON and compares them with a baseline saved on
+the same machine:
+
+    uv run benchmarks.py --save_baseline benchmarks-baseline.json
+    uv run benchmarks.py --compare benchmarks-baseline.json --threshold 0.2
+"""
+
+import argparse
+import datetime
+import decimal
+import json
+import platform
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+from logging import INFO, basicConfig, getLogger
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+
+from main import (
+    DTYPE_BACKENDS,
+    FETCH_ENGINES,
+    PHASE_TIMINGS,
+    comment_fields,
+    create_db_engine,
+    cursor_to_arrow,
+    download_history_parquet,
+    extract_sampleid,
+    flag_viable,
+    parquet_path,
+    parse_comments,
+    peak_rss_mb,
+    polars_inventory_to_parquet,
+    query_to_df,
+    read_recording,
+    transform_inventory,
+)
+from synthetic import (
+    SQLITE_HISTORY_QUERY,
+    SQLITE_INVENTORY_QUERY,
+    synthetic_inventory,
+    write_sqlite,
+)
+
+logger = getLogger(__name__)
+
+# Stages of the pipeline suite, in the order they run
+PIPELINE_STAGES = ("fetch", "extract_sampleid", "flag_viable", "to_parquet", "history")
+PIPELINE_SIZES = [10_000, 100_000, 1_000_000]
+# The viability filters main.py uses by default
+EXCLUDE_CONDITIONS = ["SNR", "QNSR", "QNS", "NSI"]
+EXCLUDE_MATCODES = ["100x100Box", None]
+
+# A representative slice of the trial inventory columns, with the Python types
+# pyodbc reports for them in cursor.description.
+SYNTHETIC_DESCRIPTION = [
+    ("TRIAL_CODE", str, None, 50, 50, 0, True),
+    ("SUBJECTID", str, None, 50, 50, 0, True),
+    ("CID", str, None, 50, 50, 0, True),
+    ("SAMPLETYPE", str, None, 50, 50, 0, True),
+    ("AMOUNTLEFT", decimal.Decimal, None, 18, 18, 4, True),
+    ("THAWCOUNT", int, None, 10, 10, 0, True),
+    ("SEQ_NUM", int, None, 10, 10, 0, True),
+    ("FREEZER", str, None, 100, 100, 0, True),
+    ("SHELF", str, None, 100, 100, 0, True),
+    ("BOX_POS", int, None, 10, 10, 0, True),
+    ("DATE_COLLECTED", datetime.datetime, None, 23, 23, 3, True),
+    ("RECEIVED_CONDITION", str, None, 50, 50, 0, True),
+    ("COMMENTS", str, None, 4000, 4000, 0, True),
+    ("MATCODE", str, None, 50, 50, 0, True),
+    ("VIAL_CONTAINER_INV_ID", int, None, 10, 10, 0, True),
+]
+
+
+class ReplayCursor:
+    """
+    A minimal DBAPI cursor serving pre-built rows, so only conversion is timed.
+
+    Build one from synthetic rows, or replay a result set recorded from
+    production with ``main.py --record_dir`` using :meth:`from_recording`.
+    """
+
+    arraysize = 1
+
+    def __init__(self, description, rows):
+        self.description = description
+        self.rowcount = len(rows)
+        self._rows = rows
+        self._position = 0
+
+    @classmethod
+    def from_recording(cls, recording_file):
+        """
+        Load a recording made by :func:`main.write_recording`.
+
+        The rows are converted back to the Python values pyodbc returns up
+        front, so replaying them costs no more than slicing a list.
+
+        Args:
+            recording_file (Union[str, Path]): The ``.arrow`` recording.
+
+        Returns:
+            ReplayCursor: A cursor positioned at the first row.
+        """
+        table, description, _ = read_recording(recording_file)
+        columns = [column.to_pylist() for column in table.columns]
+        return cls(description, list(zip(*columns)))
+
+    def rewind(self):
+        """Serve the rows again from the first."""
+        self._position = 0
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = self._rows[self._position : self._position + size]
+        self._position += len(rows)
+        return rows
+
+    def fetchall(self):
+        return self.fetchmany(len(self._rows) - self._position)
+
+    def close(self):
+        pass
+
+
+def synthetic_rows(n_rows, seed=0):
+    """
+    Build trial-inventory-shaped row tuples matching SYNTHETIC_DESCRIPTION.
+
+    Args:
+        n_rows (int): Number of rows to build.
+        seed (int): Random seed.
+
+    Returns:
+        list[tuple]: The rows.
+    """
+    rng = random.Random(seed)
+    start = datetime.datetime(2015, 1, 1)
+    columns = [
+        ["BENCH"] * n_rows,
+        [f"S{rng.randrange(5_000):05d}" for _ in range(n_rows)],
+        [f"C{i:08d}" for i in range(n_rows)],
+        rng.choices(["Plasma", "Serum", "Buffy Coat", "Urine"], k=n_rows),
+        [decimal.Decimal(rng.randrange(0, 2_000)) / 1000 for _ in range(n_rows)],
+        rng.choices([0, 0, 0, 1, 2], k=n_rows),
+        [rng.randrange(1, 20) for _ in range(n_rows)],
+        rng.choices(["Freezer 1", "Freezer 2", "Freezer 3"], k=n_rows),
+        rng.choices([f"Shelf {i}" for i in range(1, 7)], k=n_rows),
+        [rng.randrange(1, 101) for _ in range(n_rows)],
+        [
+            start + datetime.timedelta(minutes=rng.randrange(5_000_000))
+            for _ in range(n_rows)
+        ],
+        rng.choices(["Good", "Good", "Good", "QNS", None], k=n_rows),
+        [
+            f"SAMPLEID:{rng.randrange(10**6)}, LAB_ID:{rng.randrange(10**6)}"
+            for _ in range(n_rows)
+        ],
+        rng.choices(["10x10Box", "9x9Box", "100x100Box", None], k=n_rows),
+        list(range(n_rows)),
+    ]
+    return list(zip(*columns))
+
+
+def fetch_with_engine(cursor, fetch_engine):
+    """Convert everything left in ``cursor`` to a DataFrame the way query_to_df does."""
+    if fetch_engine == "arrow":
+        return cursor_to_arrow(cursor).to_pandas(types_mapper=pd.ArrowDtype)
+    return pd.DataFrame(
+        cursor.fetchall(), columns=[column[0] for column in cursor.description]
+    )
+
+
+def time_fetch_engines(cursor, repeat=3):
+    """
+    Time row-tuple-to-DataFrame conversion of a cursor's rows for each fetch engine.
+
+    Args:
+        cursor (ReplayCursor): The rows to convert; rewound before every run.
+        repeat (int): Runs per engine; the fastest is reported.
+
+    Returns:
+        list[dict]: One result per engine.
+    """
+    results = []
+    for fetch_engine in FETCH_ENGINES:
+        timings = []
+        for _ in range(repeat):
+            cursor.rewind()
+            start = time.perf_counter()
+            df = fetch_with_engine(cursor, fetch_engine)
+            timings.append(time.perf_counter() - start)
+        seconds = min(timings)
+        results.append(
+            {
+                "engine": fetch_engine,
+                "rows": cursor.rowcount,
+                "seconds": round(seconds, 3),
+                "rows_per_sec": round(cursor.rowcount / seconds),
+                "frame_mb": round(df.memory_usage(deep=True).sum() / 2**20, 1),
+            }
+        )
+        logger.info(f"{fetch_engine} engine, {cursor.rowcount} rows: {seconds:.3f}s")
+        del df
+    return results
+
+
+def bench_fetch_engines(sizes, repeat=3):
+    """
+    Time row-tuple-to-DataFrame conversion for each fetch engine.
+
+    Args:
+        sizes (list[int]): Row counts to benchmark.
+        repeat (int): Runs per engine and size; the fastest is reported.
+
+    Returns:
+        pd.DataFrame: One row per engine and size.
+    """
+    results = []
+    for n_rows in sizes:
+        cursor = ReplayCursor(SYNTHETIC_DESCRIPTION, synthetic_rows(n_rows))
+        results.extend(time_fetch_engines(cursor, repeat=repeat))
+    return pd.DataFrame(results)
+
+
+def bench_recordings(recording_files, repeat=3):
+    """
+    Time each fetch engine on result sets recorded with ``main.py --record_dir``.
+
+    Args:
+        recording_files (list[Union[str, Path]]): The ``.arrow`` recordings.
+        repeat (int): Runs per engine and recording; the fastest is reported.
+
+    Returns:
+        pd.DataFrame: One row per engine and recording.
+    """
+    results = []
+    for recording_file in recording_files:
+        cursor = ReplayCursor.from_recording(recording_file)
+        for result in time_fetch_engines(cursor, repeat=repeat):
+            results.append({"recording": Path(recording_file).name, **result})
+    return pd.DataFrame(results)
+
+
+def extract_separately(comments, fields):
+    """Parse COMMENTS fields with one ``str.extract`` scan each, as sparqy used to."""
+    return pd.DataFrame(
+        {
+            name: comments.str.extract(
+                f"{re.escape(field['key'])}:(?P<{name}>{field['value']})"
+                + re.escape(field.get("end", "")),
+                expand=False,
+            )
+            for name, field in fields.items()
+        }
+    )
+
+
+def bench_comment_parser(sizes, key_counts=(0, 2, 6), repeat=3):
+    """
+    Time the Arrow COMMENTS parser against ``str.extract`` scans.
+
+    Synthetic COMMENTS get ``key_counts`` extra ``KEYn:value`` fields on top
+    of SAMPLEID and LAB_ID, in shuffled order.
+
+    Args:
+        sizes (list[int]): Row counts to benchmark.
+        key_counts (Sequence[int]): Numbers of extra keys to parse.
+        repeat (int): Runs per measurement; the fastest is reported.
+
+    Returns:
+        pd.DataFrame: One row per parser, size and number of fields.
+    """
+    results = []
+    for n_rows in sizes:
+        base = synthetic_inventory(n_rows)["COMMENTS"].fillna("")
+        for key_count in key_counts:
+            keys = [f"KEY{i}" for i in range(key_count)]
+            extra = [f"{key}:{key.lower()}-" + base.index.astype(str) for key in keys]
+            comments = pd.Series(base, dtype="str")
+            for i, values in enumerate(extra):
+                # Put the extra keys on either side of the built-in ones
+                comments = values + " " + comments if i % 2 else comments + " " + values
+            fields = comment_fields(keys)
+            for parser, parse in [
+                ("arrow_extract", parse_comments),
+                ("str_extract", extract_separately),
+            ]:
+                timings = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    parse(comments, fields)
+                    timings.append(time.perf_counter() - start)
+                seconds = min(timings)
+                results.append(
+                    {
+                        "parser": parser,
+                        "rows": n_rows,
+                        "fields": len(fields),
+                        "seconds": round(seconds, 3),
+                        "rows_per_sec": round(n_rows / seconds),
+                    }
+                )
+                logger.info(
+                    f"{parser}, {n_rows} rows, {len(fields)} fields: {seconds:.3f}s"
+                )
+    return pd.DataFrame(results)
+
+
+def bench_transform_engines(sizes, repeat=3):
+    """
+    Time the pandas and Polars trial inventory transforms, written to Parquet.
+
+    Both start from the same synthetic DataFrame, as returned by
+    :func:`main.query_to_df`, so the fetch isn't timed.
+
+    Args:
+        sizes (list[int]): Numbers of vials to benchmark.
+        repeat (int): Runs per measurement; the fastest is reported.
+
+    Returns:
+        pd.DataFrame: One row per engine and size.
+    """
+
+    def pandas_engine(df, parquet_file):
+        transform_inventory(
+            df.copy(), False, EXCLUDE_CONDITIONS, EXCLUDE_MATCODES
+        ).to_parquet(parquet_file, compression="zstd")
+
+    def polars_engine(df, parquet_file):
+        polars_inventory_to_parquet(
+            df, parquet_file, "zstd", False, EXCLUDE_CONDITIONS, EXCLUDE_MATCODES
+        )
+
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        parquet_file = Path(temp_dir) / "inventory.parquet"
+        for n_rows in sizes:
+            df = synthetic_inventory(n_rows)
+            for transform_engine, run in [
+                ("pandas", pandas_engine),
+                ("polars", polars_engine),
+            ]:
+                timings = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    run(df, parquet_file)
+                    timings.append(time.perf_counter() - start)
+                seconds = min(timings)
+                results.append(
+                    {
+                        "engine": transform_engine,
+                        "rows": n_rows,
+                        "seconds": round(seconds, 3),
+                        "rows_per_sec": round(n_rows / seconds),
+                    }
+                )
+                logger.info(f"{transform_engine}, {n_rows} rows: {seconds:.3f}s")
+    return pd.DataFrame(results)
+
+
+def pipeline_stages(engine, trial_code, output_dir, dtype_backend=None, state=None):
+    """
+    Build the stages of the pipeline suite as zero-argument callables.
+
+    Each stage takes the previous stage's DataFrame, like a sparqy run does,
+    and returns the number of rows it processed.
+
+    Args:
+        engine (Engine): Engine of a database written by :func:`synthetic.write_sqlite`.
+        trial_code (str): Trial to fetch.
+        output_dir (Path): Where the Parquet files are written.
+        dtype_backend (Optional[str]): Dtypes of the fetched frames, see
+            :func:`main.query_to_df`.
+        state (Optional[dict]): Holds the current DataFrame under ``"df"``.
+
+    Returns:
+        dict[str, Callable[[], int]]: The stages, keyed by PIPELINE_STAGES.
+    """
+    state = {} if state is None else state
+
+    def fetch():
+        state["df"] = query_to_df(
+            engine, SQLITE_INVENTORY_QUERY, trial_code, dtype_backend=dtype_backend
+        )
+        return len(state["df"])
+
+    def sampleid():
+        state["df"] = extract_sampleid(state["df"])
+        return len(state["df"])
+
+    def viable():
+        state["df"] = flag_viable(state["df"], EXCLUDE_CONDITIONS, EXCLUDE_MATCODES)
+        return len(state["df"])
+
+    def to_parquet():
+        path = parquet_path(trial_code, output_dir, False, False)
+        state["df"].to_parquet(path, compression="snappy")
+        return len(state["df"])
+
+    def history():
+        return download_history_parquet(
+            engine,
+            SQLITE_HISTORY_QUERY,
+            trial_code,
+            Path(output_dir) / f"{trial_code}_history.parquet",
+            "snappy",
+            dtype_backend=dtype_backend,
+        )
+
+    return dict(zip(PIPELINE_STAGES, [fetch, sampleid, viable, to_parquet, history]))
+
+
+def bench_pipeline(sizes, repeat=3, work_dir=None, dtype_backends=("numpy",)):
+    """
+    Time each pipeline stage on synthetic data in a local SQLite database.
+
+    Every size is timed ``repeat`` times and the fastest run is reported,
+    then run once more under tracemalloc for the peak of the allocations
+    made by each stage. Tracing slows the stages down, so it isn't timed.
+    Arrow's own memory pool isn't traced, so ``arrow_mb`` is what the stage
+    left allocated there and ``frame_mb`` the size of its DataFrame;
+    ``peak_rss_mb`` is the process high-water mark after the size has run.
+
+    Args:
+        sizes (list[int]): Numbers of vials to benchmark.
+        repeat (int): Timed runs per size.
+        work_dir (Optional[Path]): Where to write the databases and Parquet
+            files; a temporary directory by default.
+        dtype_backends (Sequence[str]): Dtype backends to run the pipeline
+            with, see :func:`main.query_to_df`.
+
+    Returns:
+        pd.DataFrame: One row per stage, size and dtype backend.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = Path(work_dir or temp_dir)
+        for n_rows in sizes:
+            trial_code = f"BENCH{n_rows}"
+            db_file = work_dir / f"{trial_code}.db"
+            db_file.unlink(missing_ok=True)
+            logger.info(f"Writing {n_rows} synthetic vials to {db_file}")
+            engine = create_db_engine(
+                write_sqlite(db_file, n_rows, trial_code=trial_code)
+            )
+            for dtype_backend in dtype_backends:
+                results.extend(
+                    bench_pipeline_backend(
+                        engine, n_rows, work_dir, dtype_backend, repeat
+                    )
+                )
+            engine.dispose()
+    return pd.DataFrame(results)
+
+
+def bench_pipeline_backend(engine, n_rows, work_dir, dtype_backend, repeat):
+    """
+    Time and measure the pipeline stages on one database with one dtype backend.
+
+    Args:
+        engine (Engine): Engine of a database written by :func:`synthetic.write_sqlite`.
+        n_rows (int): Number of vials in the database's ``BENCH<rows>`` trial.
+        work_dir (Path): Where the Parquet files are written.
+        dtype_backend (str): Dtype backend, see :func:`main.query_to_df`.
+        repeat (int): Timed runs.
+
+    Returns:
+        list[dict]: One result per stage, see :func:`bench_pipeline`.
+    """
+    trial_code = f"BENCH{n_rows}"
+    timings = {stage: [] for stage in PIPELINE_STAGES}
+    rows = {}
+    for _ in range(repeat):
+        stages = pipeline_stages(engine, trial_code, work_dir, dtype_backend)
+        for stage, run in stages.items():
+            start = time.perf_counter()
+            rows[stage] = run()
+            timings[stage].append(time.perf_counter() - start)
+    peaks, arrow, frames = {}, {}, {}
+    state = {}
+    stages = pipeline_stages(engine, trial_code, work_dir, dtype_backend, state)
+    tracemalloc.start()
+    try:
+        for stage, run in stages.items():
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            arrow_baseline = pa.total_allocated_bytes()
+            run()
+            peaks[stage] = tracemalloc.get_traced_memory()[1] - baseline
+            arrow[stage] = pa.total_allocated_bytes() - arrow_baseline
+            # The history stage writes its own frame and keeps none
+            frames[stage] = (
+                state["df"].memory_usage(deep=True).sum() if stage != "history" else 0
+            )
+    finally:
+        tracemalloc.stop()
+    PHASE_TIMINGS.clear()
+    results = []
+    for stage in PIPELINE_STAGES:
+        seconds = min(timings[stage])
+        results.append(
+            {
+                "stage": stage,
+                "rows": n_rows,
+                "dtype_backend": dtype_backend,
+                "stage_rows": rows[stage],
+                "seconds": round(seconds, 4),
+                "rows_per_sec": round(rows[stage] / seconds),
+                "us_per_row": round(seconds * 1e6 / rows[stage], 3),
+                "peak_traced_mb": round(peaks[stage] / 2**20, 1),
+                "arrow_mb": round(arrow[stage] / 2**20, 1),
+                "frame_mb": round(frames[stage] / 2**20, 1),
+                "peak_rss_mb": peak_rss_mb(),
+            }
+        )
+        logger.info(f"{stage}, {n_rows} rows, {dtype_backend}: {seconds:.3f}s")
+    return results
+
+
+def save_results(results, output_file):
+    """
+    Save benchmark results as JSON, with the machine they ran on.
+
+    Args:
+        results (pd.DataFrame): Results of :func:`bench_pipeline`.
+        output_file (Union[str, Path]): The JSON file.
+
+    Returns:
+        Path: The JSON file.
+    """
+    output_file = Path(output_file)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    document = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "pandas": pd.__version__,
+        "machine": platform.platform(),
+        "results": json.loads(results.to_json(orient="records")),
+    }
+    with open(output_file, "w") as file:
+        json.dump(document, file, indent=2)
+    return output_file
+
+
+def load_results(results_file):
+    """
+    Load benchmark results saved by :func:`save_results`.
+
+    Args:
+        results_file (Union[str, Path]): The JSON file.
+
+    Returns:
+        pd.DataFrame: The results.
+    """
+    with open(results_file) as file:
+        return pd.DataFrame(json.load(file)["results"])
+
+
+def compare_to_baseline(results, baseline, threshold=0.2):
+    """
+    Compare benchmark results with a baseline.
+
+    A stage regresses when its time or traced peak memory at a size grows by
+    more than ``threshold`` relative to the baseline. Stages, sizes and dtype
+    backends missing from the baseline are skipped; baselines saved before
+    the dtype backends were benchmarked count as ``"numpy"``.
+
+    Args:
+        results (pd.DataFrame): Results of :func:`bench_pipeline`.
+        baseline (pd.DataFrame): Baseline results.
+        threshold (float): Allowed relative slowdown, e.g. 0.2 for 20%.
+
+    Returns:
+        pd.DataFrame: One row per stage and size in both, with the baseline
+        values, their ratios and a ``regressed`` flag.
+    """
+    keys = ["stage", "rows", "dtype_backend"]
+    results = results.assign(dtype_backend=results.get("dtype_backend", "numpy"))
+    baseline = baseline.assign(dtype_backend=baseline.get("dtype_backend", "numpy"))
+    comparison = results.merge(
+        baseline[keys + ["seconds", "peak_traced_mb"]],
+        on=keys,
+        suffixes=("", "_baseline"),
+    )
+    comparison["time_ratio"] = (
+        comparison["seconds"] / comparison["seconds_baseline"]
+    ).round(3)
+    # Ignore memory changes within a MiB, which are mostly noise at small sizes
+    comparison["memory_ratio"] = (
+        (comparison["peak_traced_mb"] + 1) / (comparison["peak_traced_mb_baseline"] + 1)
+    ).round(3)
+    comparison["regressed"] = (comparison["time_ratio"] > 1 + threshold) | (
+        comparison["memory_ratio"] > 1 + threshold
+    )
+    return comparison[
+        [
+            "stage",
+            "rows",
+            "dtype_backend",
+            "seconds",
+            "seconds_baseline",
+            "time_ratio",
+            "peak_traced_mb",
+            "peak_traced_mb_baseline",
+            "memory_ratio",
+            "regressed",
+        ]
+    ]
+
+
+def parse_args():
+    """
+    Parse command line arguments.
+    Returns:
+        Namespace: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark sparqy's hot paths.")
+    parser.add_argument(
+        "--suite",
+        choices=[
+            "pipeline",
+            "fetch_engines",
+            "replay",
+            "comments",
+            "transform_engines",
+        ],
+        default="pipeline",
+        help="Benchmark the pipeline stages on synthetic SQLite data, compare "
+        "the fetch engines' row conversion, compare them on --recordings, "
+        "compare the Arrow COMMENTS parser with str.extract, or compare the "
+        "pandas and Polars transforms",
+    )
+    parser.add_argument(
+        "--recordings",
+        nargs="+",
+        default=[],
+        help="Result sets recorded with main.py --record_dir, for --suite replay",
+    )
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=None,
+        help="Row counts to benchmark (default: 10k, 100k and 1M for the pipeline "
+        "suite, 100k, 1M and 5M for the fetch engines, 100k and 1M otherwise)",
+    )
+    parser.add_argument(
+        "--dtype_backends",
+        nargs="+",
+        choices=DTYPE_BACKENDS,
+        default=["numpy"],
+        help="Dtype backends to run the pipeline suite with",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Runs per measurement; the fastest is reported",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="JSON file for the pipeline results "
+        "(default: sparqy-benchmark-<start time>.json)",
+    )
+    baseline = parser.add_mutually_exclusive_group()
+    baseline.add_argument(
+        "--compare",
+        type=str,
+        default=None,
+        help="Baseline results, saved with --save_baseline on this machine, to "
+        "compare the pipeline results with",
+    )
+    baseline.add_argument(
+        "--save_baseline",
+        type=str,
+        default=None,
+        help="Save the pipeline results to this file as a baseline",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Relative slowdown or memory growth over the baseline that counts "
+        "as a regression",
+    )
+    parser.add_argument(
+        "--work_dir",
+        type=str,
+        default=None,
+        help="Directory for the synthetic databases and Parquet files "
+        "(default: a temporary directory)",
+    )
+    args = parser.parse_args()
+    # Fail before the benchmarks run rather than after
+    if args.compare is not None and not Path(args.compare).is_file():
+        parser.error(
+            f"No baseline at {args.compare}; save one with --save_baseline first."
+        )
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    basicConfig(level=INFO)
+    if args.suite == "fetch_engines":
+        sizes = args.sizes or [100_000, 1_000_000, 5_000_000]
+        print(bench_fetch_engines(sizes, repeat=args.repeat).to_string(index=False))
+        sys.exit()
+    if args.suite == "comments":
+        sizes = args.sizes or [100_000, 1_000_000]
+        print(bench_comment_parser(sizes, repeat=args.repeat).to_string(index=False))
+        sys.exit()
+    if args.suite == "transform_engines":
+        sizes = args.sizes or [100_000, 1_000_000]
+        print(bench_transform_engines(sizes, repeat=args.repeat).to_string(index=False))
+        sys.exit()
+    if args.suite == "replay":
+        results = bench_recordings(args.recordings, repeat=args.repeat)
+        print(results.to_string(index=False))
+        sys.exit()
+
+    started = datetime.datetime.now()
+    results = bench_pipeline(
+        args.sizes or PIPELINE_SIZES,
+        repeat=args.repeat,
+        work_dir=args.work_dir,
+        dtype_backends=args.dtype_backends,
+    )
+    print(results.to_string(index=False))
+    if args.save_baseline:
+        logger.info(f"Saved baseline to {save_results(results, args.save_baseline)}")
+        sys.exit()
+    output = args.output or f"sparqy-benchmark-{started:%Y%m%dT%H%M%S}.json"
+    logger.info(f"Saved results to {save_results(results, output)}")
+    if args.compare is None:
+        sys.exit()
+    comparison = compare_to_baseline(
+        results, load_results(args.compare), threshold=args.threshold
+    )
+    print(comparison.to_string(index=False))
+    if comparison["regressed"].any():
+        regressed = comparison[comparison["regressed"]]
+        logger.error(
+            f"{len(regressed)} stages regressed by more than {args.threshold:.0%}: "
+            + ", ".join(
+                f"{row.stage} at {row.rows} rows ({row.dtype_backend})"
+                for row in regressed.itertuples()
+            )
+        )
+        sys.exit(1)
@@ -0,0 +1,14 @@
+SELECT
+    L.LOCATIONCODE
+    , L.PARENT_LOCATION_CODE
+    , L.LOCATION_NAME
+    , L.SORTER
+    , L.LONGNAME
+    , L.LONGCODE
+    , ROOMS.ROOM_NAME
+    , ROOMS.ROOM_CODE
+    , BUILDINGS.BUILDING_NAME AS BUILDING_NAME
+    , BUILDINGS.BUILDING_CODE AS BUILDING_CODE
+FROM LOCATIONS L
+    LEFT JOIN ROOMS ON L.ROOM_ID = ROOMS.ROOM_ID
+    LEFT JOIN BUILDINGS ON ROOMS.BUILDING_ID = BUILDINGS.BUILDING_ID
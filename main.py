@@ -1,15 +1,40 @@
+import cProfile
+import datetime
+import decimal
+import hashlib
+import io
+import json
 import logging
 import os
+import pstats
 import re
+import sys
+import threading
+import time
+import tomllib
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import partial
 from pathlib import Path
 from logging import basicConfig, INFO, DEBUG, getLogger
 import argparse
 import pyodbc
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import feather
+import pyarrow.parquet as pq
 import environ
 from slugify import slugify
 from sqlalchemy import text, create_engine
-from sqlalchemy.engine import URL
+from sqlalchemy.engine import URL, Engine
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
 
 logger = getLogger(__name__)
 BASE_DIR = Path(__file__).resolve().parent
@@ -19,6 +44,112 @@ env = environ.Env(
 )
 environ.Env.read_env(env_file=BASE_DIR / ".env")
 
+FETCH_ENGINES = ("pandas", "arrow")
+# Backing of fetched DataFrames: NumPy and Python objects, or Arrow arrays
+DTYPE_BACKENDS = ("numpy", "pyarrow")
+# Engines that run the trial inventory transforms; polars is an optional extra
+TRANSFORM_ENGINES = ("pandas", "polars")
+# Views of a trial's Parquet outputs that --transform_sql queries select from
+TRANSFORM_SQL_RELATIONS = ("inventory", "history")
+# Columns trial_inventory.sql joins LOCATIONS, ROOMS and BUILDINGS for. With
+# --location_cache they are resolved locally from the vial's location code,
+# which trial_inventory_narrow.sql selects as LOCATION_KEY_COLUMN
+LOCATION_COLUMNS = (
+    "FREEZER",
+    "SHELF",
+    "RACK",
+    "RACK_CODE",
+    "SHELF_SORT",
+    "RACK_SORT",
+    "LONGNAME",
+    "LONGCODE",
+    "ROOM_NAME",
+    "ROOM_CODE",
+    "BUILDING_NAME",
+    "BUILDING_CODE",
+)
+LOCATION_KEY_COLUMN = "RACK_CODE"
+# Separates the location names of LOCATION_PATH, as in LONGNAME
+LOCATION_PATH_SEPARATOR = " > "
+# Timings of the pipeline phases in this run, appended to by timed_phase
+PHASE_TIMINGS = []
+# Phases in progress and the largest allocation snapshot, while --profile traces memory
+OPEN_PHASES = []
+PROFILE_LOCK = threading.Lock()
+ALLOCATION_SNAPSHOT = {"traced_bytes": 0, "phase": None, "snapshot": None}
+PARTITION_PROBES = ("minmax", "quantile")
+# Column the incremental history download tracks, as selected in inventory_history.sql
+HISTORY_WATERMARK_COLUMN = "TRANSACTION_ID"
+HISTORY_WATERMARK_EXPRESSION = "IT.TRANSACTION_ID"
+HISTORY_WATERMARK_FILE = "_watermark.json"
+# Key and change columns the incremental inventory refresh merges on, as selected
+# in trial_inventory.sql
+INVENTORY_KEY_COLUMN = "VIAL_CONTAINER_INV_ID"
+INVENTORY_CHANGE_COLUMN = "CURRENT_TRANSACTION_ID"
+# Columns the inventory transforms read, which a column selection always keeps
+SAMPLEID_COLUMNS = ("COMMENTS",)
+# KEY:value fields extract_sampleid parses out of COMMENTS, by output column: the
+# key, a regex for the value, the text that must follow it and an optional dtype
+COMMENT_FIELDS = {
+    "SAMPLEID": {"key": "SAMPLEID", "value": r".*?", "end": ","},
+    "SAMPLEID2": {"key": "LAB_ID", "value": r"\d+"},
+}
+# Value pattern of the extra keys added with --comment_keys
+COMMENT_KEY_VALUE = r"[^,;\s]+"
+VIABILITY_COLUMNS = ("MATCODE", "RECEIVED_CONDITION", "SAMPLE_CONDITION", "AMOUNTLEFT")
+# Viability rules and the tests they can use, see viability.toml
+VIABILITY_RULES_FILE = BASE_DIR / "viability.toml"
+VIABILITY_TESTS = ("in", "is_null", "at_most")
+# Lists from the command line that an "in" rule can name as its values
+VIABILITY_VALUE_LISTS = ("exclude_conditions", "exclude_matcodes")
+# Named column selections of trial_inventory.sql for --column_profile
+COLUMN_PROFILES = {
+    "ids": [
+        "TRIAL_CODE",
+        "SUBJECTID",
+        "LABID",
+        "CID",
+        "SAMPLETYPE",
+        "SEQ",
+        "SEQ_NUM",
+        "ACCESSION",
+        "BARCODE",
+        "LAST_NAME",
+        "VIAL_CONTAINER_INV_ID",
+        "PARENT_CONTAINER_INV_ID",
+        "CR_ORIGREC",
+    ],
+    "location": [
+        "TRIAL_CODE",
+        "CID",
+        "FREEZER",
+        "SHELF",
+        "RACK",
+        "BOX_CODE",
+        "BOX_NAME",
+        "BOX_POS",
+        "RACK_CODE",
+        "SHELF_SORT",
+        "RACK_SORT",
+        "LONGNAME",
+        "LONGCODE",
+        "ROOM_NAME",
+        "ROOM_CODE",
+        "BUILDING_NAME",
+        "BUILDING_CODE",
+        "VIAL_CONTAINER_INV_ID",
+    ],
+    "viability": [
+        "TRIAL_CODE",
+        "CID",
+        "SAMPLETYPE",
+        "AMOUNT_UNIT_CODE",
+        "THAWCOUNT",
+        "VIAL_CONTAINER_INV_ID",
+        *VIABILITY_COLUMNS,
+    ],
+}
+
 
 def parse_args():
     """
@@ -77,6 +208,24 @@ def parse_args():
         default=env("TRIAL_CODE", default=None),  # type: ignore
         help="Trial code to filter the data",
     )
+    parser.add_argument(
+        "--trial_codes",
+        nargs="+",
+        default=env.list("TRIAL_CODES", default=[]),  # type: ignore
+        help="Process several trials in one run",
+    )
+    parser.add_argument(
+        "--trial_codes_file",
+        type=str,
+        default=env("TRIAL_CODES_FILE", default=None),  # type: ignore
+        help="File listing trial codes to process, one per line",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=env.int("WORKERS", default=4),  # type: ignore
+        help="Number of trials processed concurrently",
+    )
     parser.add_argument(
         "--output_dir",
         type=str,
@@ -101,12 +250,84 @@ def parse_args():
         default=env.bool("NO_VIABLE", False),  # type: ignore
         help="Don't try to flag non-viable samples",
     )
+    parser.add_argument(
+        "--viable_only",
+        action="store_true",
+        default=env.bool("VIABLE_ONLY", default=False),  # type: ignore
+        help="Only download viable specimens, applying the viability rules in the SQL query",
+    )
+    parser.add_argument(
+        "--no_schema",
+        action="store_true",
+        default=env.bool("NO_SCHEMA", default=False),  # type: ignore
+        help="Keep inferred column types instead of the compact types in the .schema.toml manifest next to each SQL file",
+    )
+    parser.add_argument(
+        "--report",
+        action="store_true",
+        default=env.bool("REPORT", default=False),  # type: ignore
+        help="Print a table of per-phase timings; a JSON run report is always saved to the output directory",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile the run with cProfile and tracemalloc, saving a .pstats file, an allocation snapshot and per-phase peak memory to the output directory. Slows the run down noticeably",
+    )
+    parser.add_argument(
+        "--profile_top",
+        type=int,
+        default=25,
+        help="Number of functions and allocation sites listed by --profile",
+    )
+    parser.add_argument(
+        "--viability_rules",
+        type=str,
+        default=env("VIABILITY_RULES", default=None),  # type: ignore
+        help="TOML file of the viability rules behind VIABLE and NONVIABLE_REASON (default: viability.toml)",
+    )
+    parser.add_argument(
+        "--comment_keys",
+        nargs="+",
+        default=env.list("COMMENT_KEYS", default=[]),  # type: ignore
+        help="Extra KEY:value fields to parse out of COMMENTS into columns named after their keys, on top of SAMPLEID and LAB_ID",
+    )
+    parser.add_argument(
+        "--transform_sql",
+        nargs="+",
+        default=env.list("TRANSFORM_SQL", default=[]),  # type: ignore
+        help="DuckDB SQL files to run over each trial's 'inventory' and 'history' outputs, each saved as <inventory file>_<sql file name>.parquet (needs the duckdb extra)",
+    )
+    parser.add_argument(
+        "--record_dir",
+        type=str,
+        default=None,
+        help="Record each query's raw result set to an Arrow IPC file in this directory, for replaying offline with benchmarks.py --suite replay --recordings (see ReplayCursor.from_recording); cached results aren't recorded",
+    )
+    parser.add_argument(
+        "--dictionary_threshold",
+        type=float,
+        default=env.float("DICTIONARY_THRESHOLD", default=0.05),  # type: ignore
+        help="Dictionary encode string columns whose distinct values are at most this fraction of their rows; 0 disables",
+    )
     parser.add_argument(
         "--exclude_conditions",
         nargs="+",
         default=env.list("EXCLUDE_CONDITIONS", default=["SNR", "QNSR", "QNS", "NSI"]),  # type: ignore
         help="List of conditions to exclude",
     )
+    parser.add_argument(
+        "--columns",
+        nargs="+",
+        default=env.list("INVENTORY_COLUMNS", default=[]),  # type: ignore
+        help="Only select these trial inventory columns; the columns the transforms need are always kept",
+    )
+    parser.add_argument(
+        "--column_profile",
+        type=str,
+        choices=sorted(COLUMN_PROFILES),
+        default=env("COLUMN_PROFILE", default=None),  # type: ignore
+        help="Only select a named set of trial inventory columns, combined with --columns",
+    )
     parser.add_argument(
         "--exclude_matcodes",
         nargs="+",
@@ -137,6 +358,145 @@ def parse_args():
         default=env.bool("DOWNLOAD_HISTORY", default=False),  # type: ignore
         help="Enable downloading of inventory history",
     )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        default=env.bool("INCREMENTAL", default=False),  # type: ignore
+        help="Only download vials whose current transaction changed since the last run and merge them into the existing parquet file",
+    )
+    parser.add_argument(
+        "--incremental_history",
+        action="store_true",
+        default=env.bool("INCREMENTAL_HISTORY", default=False),  # type: ignore
+        help="Only download history transactions newer than the last run, appending them to a history dataset directory",
+    )
+    parser.add_argument(
+        "--full_refresh",
+        action="store_true",
+        help="Ignore incremental state and re-download everything",
+    )
+    parser.add_argument(
+        "--pool_size",
+        type=int,
+        default=env.int("POOL_SIZE", default=5),  # type: ignore
+        help="Number of database connections kept open in the shared pool",
+    )
+    parser.add_argument(
+        "--pool_pre_ping",
+        action=argparse.BooleanOptionalAction,
+        default=env.bool("POOL_PRE_PING", default=True),  # type: ignore
+        help="Test pooled connections for liveness before use",
+    )
+    parser.add_argument(
+        "--pool_recycle",
+        type=int,
+        default=env.int("POOL_RECYCLE", default=3600),  # type: ignore
+        help="Seconds after which pooled connections are replaced (-1 to disable)",
+    )
+    parser.add_argument(
+        "--fetch_engine",
+        type=str,
+        choices=FETCH_ENGINES,
+        default=env("FETCH_ENGINE", default="pandas"),  # type: ignore
+        help="How fetched rows are converted: 'pandas' builds a DataFrame from row tuples, 'arrow' builds typed Arrow columns from the cursor",
+    )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        choices=TRANSFORM_ENGINES,
+        default=env("TRANSFORM_ENGINE", default="pandas"),  # type: ignore
+        help="Run the trial inventory transforms with pandas, or as a Polars lazy query on all cores that streams to Parquet (needs the polars extra)",
+    )
+    parser.add_argument(
+        "--dtype_backend",
+        type=str,
+        choices=DTYPE_BACKENDS,
+        default=env("DTYPE_BACKEND", default=None),  # type: ignore
+        help="Keep DataFrames on 'numpy' or 'pyarrow' dtypes from fetch to Parquet (default: numpy for the pandas fetch engine, pyarrow for the arrow one)",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        default=env.bool("QUERY_CACHE", default=False),  # type: ignore
+        help="Cache query results under the output directory and reuse them on later runs",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Don't use the query cache, even if QUERY_CACHE is set",
+    )
+    parser.add_argument(
+        "--refresh_cache",
+        action="store_true",
+        help="Re-run queries and overwrite their cached results",
+    )
+    parser.add_argument(
+        "--cache_ttl",
+        type=float,
+        default=env.float("CACHE_TTL", default=24.0),  # type: ignore
+        help="Hours a cached query result stays valid",
+    )
+    parser.add_argument(
+        "--location_cache",
+        action="store_true",
+        default=env.bool("LOCATION_CACHE", default=False),  # type: ignore
+        help="Resolve storage locations from a cached copy of LOCATIONS, ROOMS and BUILDINGS instead of joining them for every vial; uses trial_inventory_narrow.sql and locations.sql next to --sql_file",
+    )
+    parser.add_argument(
+        "--location_cache_ttl",
+        type=float,
+        default=env.float("LOCATION_CACHE_TTL", default=24.0),  # type: ignore
+        help="Hours the cached locations stay valid",
+    )
+    parser.add_argument(
+        "--cache_max_mb",
+        type=float,
+        default=env.float("CACHE_MAX_MB", default=2048.0),  # type: ignore
+        help="Size limit of the query cache; least recently used results are evicted first",
+    )
+    parser.add_argument(
+        "--partitions",
+        type=int,
+        default=env.int("PARTITIONS", default=1),  # type: ignore
+        help="Split each trial inventory query into this many key ranges fetched in parallel",
+    )
+    parser.add_argument(
+        "--partition_key",
+        type=str,
+        default=env("PARTITION_KEY", default="INV.INVENTORYID"),  # type: ignore
+        help="SQL expression the key ranges split on",
+    )
+    parser.add_argument(
+        "--partition_probe",
+        type=str,
+        choices=PARTITION_PROBES,
+        default=env("PARTITION_PROBE", default="minmax"),  # type: ignore
+        help="How range boundaries are found: 'minmax' splits MIN..MAX evenly, 'quantile' uses NTILE for evenly sized ranges",
+    )
+    parser.add_argument(
+        "--stream_results",
+        action="store_true",
+        default=env.bool("STREAM_RESULTS", default=False),  # type: ignore
+        help="Fetch query results incrementally (server-side cursor where the dialect supports one) and log time-to-first-row and rows/sec",
+    )
+    parser.add_argument(
+        "--arraysize",
+        type=int,
+        default=env.int("ARRAYSIZE", default=10_000),  # type: ignore
+        help="Rows per fetch (cursor.arraysize and yield_per) with --stream_results",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        default=env.bool("STREAM", default=False),  # type: ignore
+        help="Stream the trial inventory to parquet in chunks instead of loading it into memory",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=env.int("CHUNK_SIZE", default=50_000),  # type: ignore
+        help="Rows fetched per chunk (and written per row group) when streaming",
+    )
 
     return parser.parse_args()
 
@@ -160,227 +520,3474 @@ def parse_sql_file(sql_file):
         return None
 
 
-def query_to_df(connection_url, query, trial_code=None):
+def load_schema(sql_file):
     """
-    Execute a database query and return the results as a DataFrame.
+    Load the schema manifest that sits next to a SQL file.
+
+    The manifest for ``trial_inventory.sql`` is ``trial_inventory.schema.toml``,
+    whose ``[columns]`` table maps result columns to compact types.
 
     Args:
-        connection_url (URL): SQLAlchemy connection URL.
-        query (str): SQL query text to execute.
-        trial_code (Optional[str]): Trial code parameter for the query.
+        sql_file (Union[str, Path]): Path to the .sql file.
 
     Returns:
-        pd.DataFrame: Query results as a pandas DataFrame.
+        dict[str, str]: Type name of each column, or empty without a manifest.
     """
-    logger.debug(f"Creating engine with URL: {connection_url}")
-    engine = create_engine(connection_url)
-    logger.debug(f"Engine created: {engine}")
-    try:
-        with engine.connect() as conn:
-            # SQLAlchemy text() handles named parameters like :trial_code
-            logger.debug(f"Executing query: {query}")
-            params = {"trial_code": trial_code} if trial_code else {}
-            logger.debug(f"Query parameters: {params}")
-            result = conn.execute(text(query), params)
-            logger.debug(f"Query result object: {result}")
-            # Fetch all rows and create a DataFrame
-            rows = result.fetchall()
-            logger.debug(f"Fetched {len(rows)} rows")
-            df = pd.DataFrame(rows, columns=result.keys())
-            logger.debug(f"DataFrame created with shape: {df.shape}")
-    except Exception as e:
-        logger.error(f"Error executing query: {e}")
-        raise
-    finally:
-        engine.dispose()
-    return df
+    schema_file = Path(sql_file).with_suffix(".schema.toml")
+    if not schema_file.exists():
+        return {}
+    with open(schema_file, "rb") as file:
+        schema = tomllib.load(file).get("columns", {})
+    logger.debug(f"Loaded types of {len(schema)} columns from {schema_file}")
+    return schema
 
 
-def flag_viable(df, exclude_conditions, exclude_matcodes):
+def schema_dtype(type_name, arrow=False):
     """
-    Apply viability rules to filter or mark specimens in the DataFrame.
+    Resolve a schema manifest type name to a pandas dtype.
 
     Args:
-        df (pd.DataFrame): Input specimen data.
-        exclude_conditions (list[str]): List of RECEIVED_CONDITION or SAMPLE_CONDITION values to exclude.
-        exclude_matcodes (list[str]): List of MATCODE values to exclude.
+        type_name (str): A pandas dtype name such as ``Int16``, ``category`` or
+            ``datetime64[ms]``, or ``decimal(precision, scale)``.
+        arrow (bool): Return the Arrow-backed equivalent, e.g. ``int16[pyarrow]``
+            for ``Int16``. ``category`` stays a pandas categorical, as Parquet
+            files with Arrow dictionary columns in their pandas metadata can't
+            be read back by ``pd.read_parquet``.
 
     Returns:
-        pd.DataFrame: DataFrame with an added 'VIABLE' boolean column.
+        The pandas dtype.
     """
-    logging.info(
-        f"Flagging non-viable specimens based on conditions: {exclude_conditions} and matcodes: {exclude_matcodes}"
-    )
-    # Assume all specimens are viable initially
-    df["VIABLE"] = True
-    # Define conditions for non-viable specimens
-    df["VIABLE"] = (
-        ~df["MATCODE"].isin(exclude_matcodes)
-        # NA MATCODE indicates specimen is not allocated to storage box
-        & ~df["MATCODE"].isna()
-        & ~df["RECEIVED_CONDITION"].isin(exclude_conditions)
-        & ~df["SAMPLE_CONDITION"].isin(exclude_conditions)
-        & ~df["AMOUNTLEFT"].isnull()
-        & ~df["AMOUNTLEFT"].le(0)
-    )
-    not_viable = df[~df["VIABLE"]]
-    not_viable_count = not_viable.shape[0]
-    percent_not_viable = (
-        round((not_viable_count / df.shape[0]) * 100, 2) if df.shape[0] > 0 else 0
-    )
-    logging.info(
-        f"Flagged {not_viable_count} non-viable specimens ({percent_not_viable}%)."
-    )
-    return df
+    match = DECIMAL_TYPE_PATTERN.fullmatch(type_name.strip())
+    if match:
+        return pd.ArrowDtype(pa.decimal128(int(match[1]), int(match[2])))
+    dtype = pd.api.types.pandas_dtype(type_name)
+    if not arrow or isinstance(dtype, (pd.ArrowDtype, pd.CategoricalDtype)):
+        return dtype
+    if pd.api.types.is_string_dtype(dtype):
+        return pd.ArrowDtype(pa.large_string())
+    # Nullable extension types such as Int16 wrap a NumPy dtype
+    return pd.ArrowDtype(pa.from_numpy_dtype(getattr(dtype, "numpy_dtype", dtype)))
 
 
-def extract_sampleid(df):
+def apply_schema(df, schema, report=False):
     """
-    Extract an alternative sample identifier from the COMMENTS column based on LAB_ID.
+    Cast DataFrame columns to the compact types of a schema manifest.
 
-    This function searches the `COMMENTS` column for a pattern of the form
-    ``LAB_ID:<digits>`` and extracts the numeric portion into a new ``SAMPLEID2``
-    column. It is intended for use when sample identifiers are encoded as numeric
-    lab IDs rather than in the ``SAMPLEID:...`` format handled by
-    :func:`extract_sampleid`.
+    Columns the manifest doesn't list keep their type, and listed columns the
+    DataFrame doesn't have are skipped. Arrow-backed columns are cast to the
+    Arrow equivalent of their type, so they stay on Arrow, except categories,
+    see :func:`schema_dtype`. A value that doesn't
+    fit its type, such as a position too large for ``Int16``, raises rather
+    than being truncated.
 
-    Parameters
-    ----------
-    df : pandas.DataFrame
-        A DataFrame that must contain a ``COMMENTS`` column from which the
-        ``LAB_ID``-based identifier will be extracted.
+    Args:
+        df (pd.DataFrame): Query results.
+        schema (dict[str, str]): Type name of each column.
+        report (bool): Log the memory each cast column saved.
 
-    Returns
-    -------
-    pandas.DataFrame
-        The same DataFrame with an additional ``SAMPLEID2`` column containing
-        the extracted numeric lab ID values (or NaN where no match is found).
+    Returns:
+        pd.DataFrame: The DataFrame with the columns cast.
     """
-    df["SAMPLEID"] = df["COMMENTS"].str.extract(r"SAMPLEID:(.*?),")
-    df["SAMPLEID2"] = df["COMMENTS"].str.extract(r"LAB_ID:(\d+)")
+    dtypes = {
+        column: schema_dtype(
+            schema[column], arrow=isinstance(df[column].dtype, pd.ArrowDtype)
+        )
+        for column in schema
+        if column in df
+    }
+    if not dtypes:
+        return df
+    before = df[list(dtypes)].memory_usage(deep=True, index=False) if report else None
+    df = df.astype(dtypes)
+    if report:
+        after = df[list(dtypes)].memory_usage(deep=True, index=False)
+        savings = pd.DataFrame(
+            {
+                "type": [str(dtype) for dtype in dtypes.values()],
+                "bytes_before": before,
+                "bytes_after": after,
+                "bytes_saved": before - after,
+            }
+        ).sort_values("bytes_saved", ascending=False)
+        logger.info(
+            f"Schema types saved {savings['bytes_saved'].sum():,} of "
+            f"{savings['bytes_before'].sum():,} bytes in {len(dtypes)} columns:\n"
+            f"{savings.to_string()}"
+        )
     return df
 
 
-def parquet_path(trial_code, output_dir, include_dsn_in_filename, add_trial_to_path):
+def low_cardinality_columns(df, threshold):
     """
-    Construct the final filesystem path for the output parquet file.
+    Find the string columns with few distinct values for their number of rows.
 
     Args:
-        trial_code (str): The trial code used for naming.
-        output_dir (Union[str, Path]): Base directory for output.
-        include_dsn_in_filename (bool): Whether to append '_PROD' to the filename.
-        add_trial_to_path (bool): Whether to nest the file in a trial-named subdirectory.
+        df (pd.DataFrame): Query results.
+        threshold (float): Largest ratio of distinct values to rows; 0 disables.
 
     Returns:
-        Path: The absolute or relative Path object for the target file.
+        list[str]: Names of the qualifying columns.
     """
-    # Add DSN to filename if specified
-    if include_dsn_in_filename:
-        final_parquet_file = f"{trial_code}_PROD"
-    else:
-        final_parquet_file = f"{trial_code}"
-    final_parquet_file = (
-        slugify(text=final_parquet_file, separator="_", lowercase=False) + ".parquet"
-    )
-    final_parquet_path = Path(output_dir)
-    # Store the parquet file in a subdirectory named after the trial code if specified
-    if add_trial_to_path:
-        final_parquet_path = final_parquet_path / trial_code
-    final_parquet_path.mkdir(parents=True, exist_ok=True)
-    final_parquet_file_path = final_parquet_path / final_parquet_file
-    return final_parquet_file_path
+    if not threshold or df.empty:
+        return []
+    columns = []
+    for column in df.columns:
+        series = df[column]
+        if isinstance(series.dtype, pd.CategoricalDtype) or (
+            isinstance(series.dtype, pd.ArrowDtype)
+            and pa.types.is_dictionary(series.dtype.pyarrow_dtype)
+        ):
+            continue
+        if not pd.api.types.is_string_dtype(series):
+            continue
+        # All-NULL columns are left for the cursor description to type
+        if 0 < series.nunique() <= threshold * len(series):
+            columns.append(column)
+    return columns
 
 
-def redact_dsn_password(dsn: str) -> str:
+def dictionary_encode(df, threshold, columns=None):
     """
-    Redact the PWD parameter in a DSN string for safe logging.
+    Convert low-cardinality string columns to categoricals.
+
+    Each distinct value is stored once, so memory drops, and the columns are
+    written to Parquet as dictionary-encoded columns that load back as
+    categoricals. Arrow-backed columns become categoricals too, with Arrow
+    string categories.
 
     Args:
-        dsn (str): Original ODBC connection string.
+        df (pd.DataFrame): Query results.
+        threshold (float): Largest ratio of distinct values to rows; 0 disables.
+        columns (Optional[list[str]]): Columns to convert instead of measuring,
+            e.g. those chosen for the first chunk of a streamed download.
 
     Returns:
-        str: Connection string with the password replaced by asterisks.
+        pd.DataFrame: The DataFrame with the columns converted.
     """
-    # Replace PWD=...; with PWD=****;
-    # handles case like PWD=password123;
-    return re.sub(r"(PWD=)[^;]*", r"\1****", dsn, flags=re.IGNORECASE)
+    if columns is None:
+        columns = low_cardinality_columns(df, threshold)
+        if columns:
+            logger.info(f"Dictionary encoding low-cardinality columns: {columns}")
+    if not columns:
+        return df
+    # An all-NULL Arrow column, e.g. in a streamed chunk, has no type for categories
+    untyped = {
+        column: pd.ArrowDtype(pa.large_string())
+        for column in columns
+        if isinstance(df[column].dtype, pd.ArrowDtype)
+        and pa.types.is_null(df[column].dtype.pyarrow_dtype)
+    }
+    if untyped:
+        df = df.astype(untyped)
+    return df.astype({column: "category" for column in columns})
 
 
-def main(
-    db_host,
-    db_name,
-    db_port,
-    db_user,
-    db_password,
-    sql_file,
-    trial_code,
-    output_dir,
-    add_trial_to_path,
-    include_dsn_in_filename,
-    no_viable,
-    exclude_conditions,
-    exclude_matcodes,
-    parquet_compression,
-    db_driver,
-    debug=False,
-    download_history=False,
+def create_db_engine(
+    connection_url, pool_size=5, pool_pre_ping=True, pool_recycle=3600
 ):
     """
-    Main orchestration function for the Sparqy data extraction process.
+    Create the SQLAlchemy engine (and its connection pool) shared by all queries.
 
-    This function sets up logging, parses the SQL query, connects to the database,
-    fetches data, flags viability, and saves the final result to Parquet.
+    Logging in to SQL Server over ODBC is slow, so the engine should be created
+    once per process and passed to every query rather than rebuilt per query.
 
     Args:
-        db_host (str): Database server address.
-        db_name (str): SQL database name.
-        db_port (int): Server port.
-        db_user (Optional[str]): Database username.
-        db_password (Optional[str]): Database password.
-        sql_file (str): Path to the source SQL file.
-        trial_code (str): Filter parameter for the query.
-        output_dir (str): Destination directory for parquet output.
-        add_trial_to_path (bool): Nested directory flag.
-        include_dsn_in_filename (bool): Filename suffix flag.
-        no_viable (bool): Flag to skip viability processing.
-        exclude_conditions (list[str]): Viability filters.
-        exclude_matcodes (list[str]): Matcode filters.
-        parquet_compression (str): Compression algo for the output file.
-        db_driver (str): Name of the ODBC driver to use.
-        debug (bool): Enable verbose logging.
+        connection_url (URL): SQLAlchemy connection URL.
+        pool_size (int): Number of connections kept open in the pool.
+        pool_pre_ping (bool): Test connections for liveness before handing them out.
+        pool_recycle (int): Seconds after which a connection is replaced, or -1 to never recycle.
+
+    Returns:
+        Engine: The SQLAlchemy engine. The caller is responsible for disposing it.
     """
-    basicConfig(level=INFO if not debug else DEBUG)
-    if not trial_code:
-        logger.error("No trial code provided.")
-        return
-    try:
-        logger.info(f"Processing trial inventory for {trial_code}...")
-        query = parse_sql_file(sql_file)
-        if not query:
-            logger.error("Failed to parse SQL file.")
-            return
-        logger.debug(f"SQL Query: {query}")
-        # Common MSSQL parameters. Default to secure TLS settings and allow
-        # explicit environment-based overrides for legacy deployments.
-        encrypt = os.getenv("DB_ENCRYPT", "yes").strip().lower()
-        trust_server_certificate = (
-            os.getenv("DB_TRUST_SERVER_CERTIFICATE", "yes").strip().lower()
-        )
-        if encrypt not in {"yes", "no"}:
-            raise ValueError("DB_ENCRYPT must be either 'yes' or 'no'.")
-        if trust_server_certificate not in {"yes", "no"}:
-            raise ValueError(
-                "DB_TRUST_SERVER_CERTIFICATE must be either 'yes' or 'no'."
-            )
-        if encrypt == "no" or trust_server_certificate == "yes":
-            logger.warning(
-                "Using insecure SQL Server TLS settings: Encrypt=%s, TrustServerCertificate=%s. "
-                "This should only be used for legacy environments.",
-                encrypt,
-                trust_server_certificate,
-            )
-        query_params = {
-            "driver": db_driver,
+    logger.debug(f"Creating engine with URL: {connection_url}")
+    engine = create_engine(
+        connection_url,
+        pool_size=pool_size,
+        pool_pre_ping=pool_pre_ping,
+        pool_recycle=pool_recycle,
+    )
+    logger.debug(f"Engine created: {engine}")
+    return engine
+
+
+# Type names in a schema manifest are pandas dtype names, or decimal(precision, scale)
+DECIMAL_TYPE_PATTERN = re.compile(r"decimal\((\d+),\s*(\d+)\)", re.IGNORECASE)
+SQL_TOKEN_PATTERN = re.compile(
+    r"--[^\n]*|/\*.*?\*/|'(?:[^']|'')*'|\[[^\]]*\]|[(),]|\w+", re.DOTALL
+)
+SQL_ALIAS_PATTERN = re.compile(r"\s+AS\s+(?:\[[^\]]*\]|\w+)\s*$", re.IGNORECASE)
+SQL_CLAUSE_KEYWORDS = {"GROUP", "HAVING", "ORDER", "UNION", "EXCEPT", "INTERSECT"}
+# cursor.description type codes pyodbc reports, by the name recordings store
+DESCRIPTION_TYPES = {
+    type_code.__name__: type_code
+    for type_code in (
+        str,
+        bool,
+        int,
+        float,
+        bytes,
+        bytearray,
+        decimal.Decimal,
+        datetime.datetime,
+        datetime.date,
+        datetime.time,
+    )
+}
+
+
+def top_level_keywords(query):
+    """
+    Find the keywords of the outermost statement in a SQL query.
+
+    Comments, string literals, bracketed identifiers and anything nested in
+    parentheses (subqueries, APPLY blocks, function calls) are skipped.
+
+    Args:
+        query (str): SQL query text.
+
+    Returns:
+        list[tuple[str, int, int]]: Upper-cased word, start and end offset of
+        each top-level word in order.
+    """
+    depth = 0
+    words = []
+    for match in SQL_TOKEN_PATTERN.finditer(query):
+        token = match.group()
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+        elif depth == 0 and (token[0].isalnum() or token[0] == "_"):
+            words.append((token.upper(), match.start(), match.end()))
+    return words
+
+
+def select_items(query):
+    """
+    Split the top-level SELECT list of a SQL query into its columns.
+
+    Each column is named by its ``AS`` alias if it has one, otherwise by the
+    last part of its identifier, which is the name it has in the result.
+
+    Args:
+        query (str): SQL query text.
+
+    Returns:
+        list[tuple[str, str]]: Result column name and SQL text of each column,
+        in SELECT order.
+
+    Raises:
+        ValueError: If the SELECT list uses ``*``, whose columns can't be named.
+    """
+    words = top_level_keywords(query)
+    list_start = next(end for word, _, end in words if word == "SELECT")
+    list_end = next(start for word, start, _ in words if word == "FROM")
+    items = []
+    depth = 0
+    item_start = list_start
+    name = None
+    for match in SQL_TOKEN_PATTERN.finditer(query, list_start, list_end):
+        token = match.group()
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+        elif depth > 0 or token.startswith(("--", "/*", "'")):
+            continue
+        elif token == ",":
+            items.append((name, query[item_start : match.start()].strip()))
+            item_start = match.end()
+            name = None
+        elif token.upper() not in {"AS", "DISTINCT"}:
+            name = token.strip("[]")
+    items.append((name, query[item_start:list_end].strip()))
+    if any(item.endswith("*") for _, item in items):
+        raise ValueError("Can't name the columns of a query using SELECT *.")
+    return items
+
+
+def project_columns(query, columns):
+    """
+    Rewrite the SELECT list of a SQL query to only the given columns.
+
+    Columns keep their original SELECT order and SQL text, so types and
+    expressions are unchanged; the rest of the query is left as it is.
+
+    Args:
+        query (str): SQL query text.
+        columns (Iterable[str]): Result column names to keep.
+
+    Returns:
+        str: The rewritten query.
+
+    Raises:
+        ValueError: If a column isn't selected by the query.
+    """
+    items = select_items(query)
+    columns = set(columns)
+    unknown = columns - {name for name, _ in items}
+    if unknown:
+        raise ValueError(
+            f"Unknown columns {sorted(unknown)}; the query selects "
+            f"{[name for name, _ in items]}."
+        )
+    words = top_level_keywords(query)
+    list_start = next(end for word, _, end in words if word == "SELECT")
+    list_end = next(start for word, start, _ in words if word == "FROM")
+    kept = [item for name, item in items if name in columns]
+    logger.info(f"Selecting {len(kept)} of {len(items)} columns.")
+    return (
+        query[:list_start] + "\n    " + "\n    , ".join(kept) + "\n" + query[list_end:]
+    )
+
+
+def select_expressions(query):
+    """
+    Map the result columns of a SQL query to the SQL expressions that produce them.
+
+    Args:
+        query (str): SQL query text.
+
+    Returns:
+        dict[str, str]: Expression of each named column, without its alias.
+        Empty for a ``SELECT *`` query, whose columns are their own expressions.
+    """
+    try:
+        items = select_items(query)
+    except ValueError:
+        return {}
+    return {name: SQL_ALIAS_PATTERN.sub("", item) for name, item in items}
+
+
+def load_viability_rules(rules_file=None):
+    """
+    Load and check the viability rules.
+
+    Args:
+        rules_file (Optional[Union[str, Path]]): TOML file with a ``[[rules]]``
+            array; defaults to VIABILITY_RULES_FILE.
+
+    Returns:
+        list[dict]: The rules, in bit order of NONVIABLE_REASON.
+
+    Raises:
+        ValueError: If a rule is malformed, or there are more than 64 rules.
+    """
+    rules_file = Path(rules_file or VIABILITY_RULES_FILE)
+    with open(rules_file, "rb") as file:
+        rules = tomllib.load(file).get("rules", [])
+    if len(rules) > 64:
+        raise ValueError(
+            f"{rules_file} has {len(rules)} rules; at most 64 fit a bitmask"
+        )
+    names = set()
+    for rule in rules:
+        name = rule.get("name")
+        if not name or name in names or not rule.get("column"):
+            raise ValueError(f"Rules need a unique name and a column: {rule}")
+        names.add(name)
+        if rule.get("test") not in VIABILITY_TESTS:
+            raise ValueError(f"Rule {name} must test one of {VIABILITY_TESTS}")
+        if rule["test"] == "in":
+            values = rule.get("values")
+            if not isinstance(values, list) and values not in VIABILITY_VALUE_LISTS:
+                raise ValueError(
+                    f"Rule {name} needs a list of values or one of {VIABILITY_VALUE_LISTS}"
+                )
+        value = rule.get("value")
+        if rule["test"] == "at_most" and (
+            isinstance(value, bool) or not isinstance(value, (int, float))
+        ):
+            raise ValueError(f"Rule {name} needs a numeric value")
+    logger.debug(f"Loaded {len(rules)} viability rules from {rules_file}")
+    return rules
+
+
+def viability_rule_values(rule, exclude_conditions, exclude_matcodes):
+    """
+    Return the values an ``in`` rule excludes.
+
+    Args:
+        rule (dict): A rule from :func:`load_viability_rules`.
+        exclude_conditions (list[str]): The ``exclude_conditions`` list.
+        exclude_matcodes (list[str]): The ``exclude_matcodes`` list.
+
+    Returns:
+        list: The values, which may include None for NULL.
+    """
+    lists = {
+        "exclude_conditions": exclude_conditions,
+        "exclude_matcodes": exclude_matcodes,
+    }
+    values = rule["values"]
+    return list(lists[values]) if isinstance(values, str) else values
+
+
+def viability_condition(query, exclude_conditions, exclude_matcodes, rules=None):
+    """
+    Build a SQL condition that keeps the same rows :func:`flag_viable` marks viable.
+
+    The rules are applied to the expressions behind the query's columns, with
+    the excluded values as bound parameters. NULLs pass an ``in`` rule unless
+    None is one of its values, matching ``isin`` in pandas, and always pass an
+    ``at_most`` rule, as NaN is never ``<=`` a value in pandas.
+
+    Args:
+        query (str): SQL query text.
+        exclude_conditions (list[str]): RECEIVED_CONDITION or SAMPLE_CONDITION values to exclude.
+        exclude_matcodes (list[str]): MATCODE values to exclude.
+        rules (Optional[list[dict]]): Viability rules; defaults to those in
+            VIABILITY_RULES_FILE.
+
+    Returns:
+        tuple[str, dict]: The condition and its bound parameters.
+    """
+    expressions = select_expressions(query)
+    params = {}
+    conditions = []
+    for rule in load_viability_rules() if rules is None else rules:
+        expression = expressions.get(rule["column"], rule["column"])
+        if rule["test"] == "is_null":
+            conditions.append(f"{expression} IS NOT NULL")
+            continue
+        if rule["test"] == "at_most":
+            conditions.append(
+                f"({expression} IS NULL OR {expression} > {rule['value']})"
+            )
+            continue
+        values = viability_rule_values(rule, exclude_conditions, exclude_matcodes)
+        # e.g. :exclude_condition_0 for the exclude_conditions list
+        prefix = (
+            rule["values"].rstrip("s")
+            if isinstance(rule["values"], str)
+            else rule["name"].lower()
+        )
+        names = []
+        for value in values:
+            if value is not None:
+                names.append(f":{prefix}_{len(params)}")
+                params[names[-1][1:]] = value
+        keep_null = None not in values
+        if not names:
+            if not keep_null:
+                conditions.append(f"{expression} IS NOT NULL")
+            continue
+        null_test = "IS NULL OR" if keep_null else "IS NOT NULL AND"
+        conditions.append(
+            f"({expression} {null_test} {expression} NOT IN ({', '.join(names)}))"
+        )
+    return "\n    AND ".join(conditions), params
+
+
+def add_where_condition(query, condition):
+    """
+    AND an extra condition into the top-level WHERE clause of a query.
+
+    The existing WHERE clause is parenthesised so the new condition applies to
+    all of it, and the condition is placed ahead of any GROUP BY/ORDER BY.
+
+    Args:
+        query (str): SQL query text.
+        condition (str): SQL boolean expression, which may use bound parameters.
+
+    Returns:
+        str: The rewritten query.
+    """
+    query = query.rstrip().rstrip(";").rstrip()
+    words = top_level_keywords(query)
+    where = next((word for word in words if word[0] == "WHERE"), None)
+    after = where[2] if where else 0
+    end = next(
+        (
+            start
+            for word, start, _ in words
+            if word in SQL_CLAUSE_KEYWORDS and start > after
+        ),
+        len(query),
+    )
+    if where is None:
+        return (
+            f"{query[:end].rstrip()}\nWHERE\n    ({condition})\n{query[end:]}".rstrip()
+        )
+    existing = query[where[2] : end].strip()
+    # The closing parenthesis goes on its own line in case the clause ends in a comment
+    return (
+        f"{query[: where[2]]}\n    ({existing}\n    )\n    AND ({condition})\n{query[end:]}"
+    ).rstrip()
+
+
+def query_params(trial_code=None, params=None):
+    """
+    Combine the trial code and any additional bound parameters for a query.
+
+    Args:
+        trial_code (Optional[str]): Trial code parameter for the query.
+        params (Optional[dict]): Additional bound parameters.
+
+    Returns:
+        dict: Parameters to bind.
+    """
+    bound = {"trial_code": trial_code} if trial_code else {}
+    bound.update(params or {})
+    return bound
+
+
+@contextmanager
+def execute_query(
+    connection_url,
+    query,
+    trial_code=None,
+    stream_results=False,
+    arraysize=None,
+    params=None,
+):
+    """
+    Execute a database query and yield the open SQLAlchemy result.
+
+    When given a URL rather than an engine, a single-use engine is created for
+    the duration of the context and disposed on exit. Rows must be fetched
+    before the context is left.
+
+    Args:
+        connection_url (Union[URL, Engine]): SQLAlchemy connection URL, or a shared engine.
+        query (str): SQL query text to execute.
+        trial_code (Optional[str]): Trial code parameter for the query.
+        stream_results (bool): Ask SQLAlchemy for a server-side cursor that
+            yields ``arraysize`` rows at a time. Dialects without server-side
+            cursor support (including mssql+pyodbc, whose default forward-only
+            cursor already streams from the server) ignore this.
+        arraysize (Optional[int]): Set ``cursor.arraysize`` on the DBAPI cursor.
+        params (Optional[dict]): Additional bound parameters for the query.
+
+    Yields:
+        CursorResult: The result of the executed query.
+    """
+    owns_engine = not isinstance(connection_url, Engine)
+    if owns_engine:
+        logger.debug(f"Creating engine with URL: {connection_url}")
+        engine = create_engine(connection_url)
+        logger.debug(f"Engine created: {engine}")
+    else:
+        engine = connection_url
+    try:
+        with engine.connect() as conn:
+            # SQLAlchemy text() handles named parameters like :trial_code
+            logger.debug(f"Executing query: {query}")
+            params = query_params(trial_code, params)
+            logger.debug(f"Query parameters: {params}")
+            execution_options = {}
+            if stream_results:
+                execution_options["stream_results"] = True
+                if arraysize:
+                    execution_options["yield_per"] = arraysize
+            with timed_phase("execute", trial_code):
+                result = conn.execute(
+                    text(query), params, execution_options=execution_options
+                )
+            logger.debug(f"Query result object: {result}")
+            if arraysize and result.cursor is not None:
+                result.cursor.arraysize = arraysize
+            yield result
+    except Exception as e:
+        logger.error(f"Error executing query: {e}")
+        raise
+    finally:
+        if owns_engine:
+            engine.dispose()
+
+
+def query_to_df(
+    connection_url,
+    query,
+    trial_code=None,
+    fetch_engine="pandas",
+    stream_results=False,
+    arraysize=10_000,
+    params=None,
+    partitions=1,
+    partition_key="INV.INVENTORYID",
+    partition_probe="minmax",
+    record_dir=None,
+    dtype_backend=None,
+):
+    """
+    Execute a database query and return the results as a DataFrame.
+
+    Args:
+        connection_url (Union[URL, Engine]): SQLAlchemy connection URL, or a shared engine.
+        query (str): SQL query text to execute.
+        trial_code (Optional[str]): Trial code parameter for the query.
+        fetch_engine (str): ``"pandas"`` to build the DataFrame from row tuples,
+            or ``"arrow"`` to build typed Arrow columns straight from the cursor
+            and return a DataFrame with Arrow-backed dtypes.
+        stream_results (bool): Fetch the result ``arraysize`` rows at a time
+            (see :func:`execute_query`) and log time-to-first-row and
+            steady-state rows/sec.
+        arraysize (int): Rows per fetch when ``stream_results`` is set.
+        params (Optional[dict]): Additional bound parameters for the query.
+        partitions (int): Split the query into this many key ranges fetched in
+            parallel, see :func:`partitioned_query_to_df`.
+        partition_key (str): SQL expression the key ranges split on.
+        partition_probe (str): ``"minmax"`` or ``"quantile"`` range boundaries.
+        record_dir (Optional[Path]): Also save the raw result set here for
+            replaying offline, see :func:`write_recording`.
+        dtype_backend (Optional[str]): ``"numpy"`` or ``"pyarrow"`` dtypes for
+            the DataFrame; by default the pandas engine gives NumPy dtypes and
+            the arrow engine Arrow dtypes. With the pandas engine, ``"pyarrow"``
+            types the columns from the cursor description like the arrow engine.
+
+    Returns:
+        pd.DataFrame: Query results as a pandas DataFrame.
+    """
+    if partitions > 1:
+        return partitioned_query_to_df(
+            connection_url,
+            query,
+            trial_code=trial_code,
+            partitions=partitions,
+            partition_key=partition_key,
+            partition_probe=partition_probe,
+            fetch_engine=fetch_engine,
+            stream_results=stream_results,
+            arraysize=arraysize,
+            params=params,
+            record_dir=record_dir,
+            dtype_backend=dtype_backend,
+        )
+    started = time.perf_counter()
+    with execute_query(
+        connection_url,
+        query,
+        trial_code=trial_code,
+        stream_results=stream_results,
+        arraysize=arraysize if stream_results else None,
+        params=params,
+    ) as result:
+        if fetch_engine == "arrow":
+            with timed_phase("fetch", trial_code) as phase:
+                batches = iter_record_batches(result.cursor, arraysize or 50_000)
+                if stream_results:
+                    batches = metered_batches(batches, started)
+                table = record_batches_to_table(batches, result.cursor.description)
+                phase["rows"], phase["bytes"] = table.num_rows, table.nbytes
+            logger.debug(f"Fetched {table.num_rows} rows into Arrow")
+            if record_dir is not None:
+                write_recording(
+                    recording_path(record_dir, query, trial_code, params),
+                    table,
+                    result.cursor.description,
+                    query=query,
+                    params=query_params(trial_code, params),
+                )
+            with timed_phase("dataframe", trial_code) as phase:
+                if dtype_backend == "numpy":
+                    df = table.to_pandas()
+                else:
+                    df = table.to_pandas(types_mapper=pd.ArrowDtype)
+        else:
+            # SQLAlchemy releases the cursor once every row is fetched
+            description = result.cursor.description
+            with timed_phase("fetch", trial_code) as phase:
+                if stream_results:
+                    batches = iter(partial(result.fetchmany, arraysize), [])
+                    batches = metered_batches(batches, started)
+                    rows = [row for batch in batches for row in batch]
+                else:
+                    # Fetch all rows and create a DataFrame
+                    rows = result.fetchall()
+                phase["rows"] = len(rows)
+            logger.debug(f"Fetched {len(rows)} rows")
+            table = None
+            if record_dir is not None:
+                table = rows_to_arrow(rows, description)
+                write_recording(
+                    recording_path(record_dir, query, trial_code, params),
+                    table,
+                    description,
+                    query=query,
+                    params=query_params(trial_code, params),
+                )
+            with timed_phase("dataframe", trial_code) as phase:
+                if dtype_backend == "pyarrow":
+                    if table is None:
+                        table = rows_to_arrow(rows, description)
+                    df = table.to_pandas(types_mapper=pd.ArrowDtype)
+                else:
+                    df = pd.DataFrame(rows, columns=result.keys())
+        # Measured after the phase ends, so the deep scan of strings isn't timed
+        phase["rows"] = len(df)
+        phase["bytes"] = int(df.memory_usage(deep=True).sum())
+        logger.debug(f"DataFrame created with shape: {df.shape}")
+    return df
+
+
+def query_cache_key(connection_url, query, params, schema=None, dictionary_threshold=0):
+    """
+    Build the cache key for a query result.
+
+    The key covers the SQL text, the bound parameters, the server and database
+    the query runs against and the types the result is stored with, so a
+    changed query file, schema manifest or ``--dictionary_threshold``, or a
+    different target, never reuses a stale result.
+
+    Args:
+        connection_url (Union[URL, Engine]): SQLAlchemy connection URL, or a shared engine.
+        query (str): SQL query text.
+        params (dict): Bound query parameters.
+        schema (Optional[dict[str, str]]): Column types applied to the result.
+        dictionary_threshold (float): Dictionary encoding threshold applied to
+            the result.
+
+    Returns:
+        str: Hex digest identifying the result.
+    """
+    url = connection_url.url if isinstance(connection_url, Engine) else connection_url
+    key_fields = {
+        "query": query,
+        "params": params,
+        "host": url.host,
+        "port": url.port,
+        "database": url.database,
+        "schema": schema or None,
+        "dictionary_threshold": dictionary_threshold,
+    }
+    return hashlib.sha256(
+        json.dumps(key_fields, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def arrow_dtype(arrow_type):
+    """
+    Map an Arrow type to its Arrow-backed pandas dtype, for ``types_mapper``.
+
+    Dictionaries are left to load as pandas categoricals, see :func:`schema_dtype`.
+
+    Args:
+        arrow_type (pa.DataType): The Arrow type.
+
+    Returns:
+        Optional[pd.ArrowDtype]: The dtype, or None for the default conversion.
+    """
+    return None if pa.types.is_dictionary(arrow_type) else pd.ArrowDtype(arrow_type)
+
+
+def read_query_cache(cache_dir, key, ttl, dtype_backend="numpy"):
+    """
+    Load a cached query result if it exists and hasn't expired.
+
+    A hit updates the file's access time, which drives LRU eviction. The
+    modification time is left alone so it keeps recording when the result was
+    fetched.
+
+    Args:
+        cache_dir (Path): Cache directory.
+        key (str): Key from :func:`query_cache_key`.
+        ttl (float): Seconds a cached result stays valid.
+        dtype_backend (str): ``"numpy"`` or ``"pyarrow"`` dtypes for the result.
+
+    Returns:
+        Optional[pd.DataFrame]: The cached result, or None on a miss.
+    """
+    cache_file = Path(cache_dir) / f"{key}.arrow"
+    if not cache_file.exists():
+        return None
+    try:
+        modified = cache_file.stat().st_mtime
+        age = time.time() - modified
+        if age > ttl:
+            logger.debug(f"Cached result {cache_file.name} expired ({age:.0f}s old)")
+            return None
+        os.utime(cache_file, (time.time(), modified))
+        if dtype_backend == "pyarrow":
+            df = feather.read_table(cache_file).to_pandas(types_mapper=arrow_dtype)
+        else:
+            df = pd.read_feather(cache_file)
+    except OSError as e:
+        # Another trial's eviction can remove the file after the exists() check
+        logger.debug(f"Cached result {cache_file.name} went away: {e}")
+        return None
+    logger.info(
+        f"Loaded {len(df)} rows from query cache ({age / 3600:.1f}h old): {cache_file}"
+    )
+    return df
+
+
+def temp_file_path(path):
+    """
+    Name a temporary file next to ``path`` for a write that replaces it.
+
+    The name is unique to the process and thread, so concurrent trials writing
+    the same file don't clobber each other's partial output.
+
+    Args:
+        path (Path): The file to be replaced.
+
+    Returns:
+        Path: The temporary file.
+    """
+    return path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def write_query_cache(cache_dir, key, df, ttl, max_bytes):
+    """
+    Store a query result in the cache as an Arrow IPC file and evict old entries.
+
+    Args:
+        cache_dir (Path): Cache directory.
+        key (str): Key from :func:`query_cache_key`.
+        df (pd.DataFrame): The query result.
+        ttl (float): Seconds a cached result stays valid.
+        max_bytes (float): Size limit of the cache directory.
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    cache_file = cache_dir / f"{key}.arrow"
+    # Write to a temporary file first so readers never see a partial result
+    temp_file = temp_file_path(cache_file)
+    df.to_feather(temp_file)
+    os.replace(temp_file, cache_file)
+    logger.debug(f"Cached {len(df)} rows in {cache_file}")
+    evict_query_cache(cache_dir, ttl, max_bytes)
+
+
+def evict_query_cache(cache_dir, ttl, max_bytes):
+    """
+    Remove expired results, then least recently used ones until under the size limit.
+
+    Args:
+        cache_dir (Path): Cache directory.
+        ttl (float): Seconds a cached result stays valid.
+        max_bytes (float): Size limit of the cache directory.
+    """
+    now = time.time()
+    entries = []
+    for cache_file in Path(cache_dir).glob("*.arrow"):
+        try:
+            stat = cache_file.stat()
+        except FileNotFoundError:
+            # Already evicted by another trial
+            continue
+        if now - stat.st_mtime > ttl:
+            cache_file.unlink(missing_ok=True)
+        else:
+            entries.append((stat.st_atime, stat.st_size, cache_file))
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, cache_file in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        logger.debug(f"Evicting {cache_file.name} from query cache")
+        cache_file.unlink(missing_ok=True)
+        total_bytes -= size
+
+
+def cached_query_to_df(
+    connection_url,
+    query,
+    trial_code=None,
+    cache_dir=None,
+    cache_ttl=86_400,
+    cache_max_bytes=2**31,
+    refresh_cache=False,
+    schema=None,
+    dictionary_threshold=0,
+    **kwargs,
+):
+    """
+    Run :func:`query_to_df`, going through the on-disk query cache if enabled.
+
+    Args:
+        connection_url (Union[URL, Engine]): SQLAlchemy connection URL, or a shared engine.
+        query (str): SQL query text to execute.
+        trial_code (Optional[str]): Trial code parameter for the query.
+        cache_dir (Optional[Path]): Cache directory, or None to disable caching.
+        cache_ttl (float): Seconds a cached result stays valid.
+        cache_max_bytes (float): Size limit of the cache directory.
+        refresh_cache (bool): Skip reading the cache but store the fresh result.
+        schema (Optional[dict[str, str]]): Column types applied to the result
+            before it is cached, see :func:`apply_schema`.
+        dictionary_threshold (float): Dictionary encode string columns with at
+            most this ratio of distinct values to rows, see :func:`dictionary_encode`.
+        **kwargs: Passed through to :func:`query_to_df`.
+
+    Returns:
+        pd.DataFrame: Query results as a pandas DataFrame.
+    """
+    key = None
+    if cache_dir is not None:
+        key = query_cache_key(
+            connection_url,
+            query,
+            query_params(trial_code, kwargs.get("params")),
+            schema,
+            dictionary_threshold,
+        )
+        if not refresh_cache:
+            # Cached results come back on the backend a fresh fetch would give
+            dtype_backend = kwargs.get("dtype_backend") or (
+                "pyarrow" if kwargs.get("fetch_engine") == "arrow" else "numpy"
+            )
+            df = read_query_cache(cache_dir, key, cache_ttl, dtype_backend)
+            if df is not None:
+                return df
+    df = query_to_df(connection_url, query, trial_code=trial_code, **kwargs)
+    if schema:
+        df = apply_schema(df, schema, report=True)
+    df = dictionary_encode(df, dictionary_threshold)
+    if key is not None:
+        write_query_cache(cache_dir, key, df, cache_ttl, cache_max_bytes)
+    return df
+
+
+def partition_ranges(
+    connection_url,
+    query,
+    partition_key,
+    partitions,
+    partition_probe="minmax",
+    trial_code=None,
+    params=None,
+):
+    """
+    Probe a query for key ranges that split its result into parts.
+
+    The probe reuses the query's FROM and WHERE clauses but only selects the
+    partition key, so nothing but a few boundary values crosses the network.
+    ``"minmax"`` splits MIN..MAX into equal-width ranges, which is cheapest but
+    assumes keys are spread evenly. ``"quantile"`` uses NTILE to find boundaries
+    that give each range roughly the same number of rows.
+
+    Args:
+        connection_url (Union[URL, Engine]): SQLAlchemy connection URL, or a shared engine.
+        query (str): SQL query text to split.
+        partition_key (str): SQL expression to split on, e.g. ``INV.INVENTORYID``.
+        partitions (int): Number of ranges wanted.
+        partition_probe (str): ``"minmax"`` or ``"quantile"``.
+        trial_code (Optional[str]): Trial code parameter for the query.
+        params (Optional[dict]): Additional bound parameters for the query.
+
+    Returns:
+        list[tuple]: ``(lower, upper)`` bounds in key order; ``lower`` is
+        inclusive and ``upper`` exclusive, with None for the open-ended last
+        range. Empty if the query matches no rows.
+    """
+    words = top_level_keywords(query)
+    from_start = next(start for word, start, _ in words if word == "FROM")
+    from_end = next(
+        (start for word, start, _ in words if word == "ORDER" and start > from_start),
+        len(query),
+    )
+    from_clause = query[from_start:from_end].rstrip().rstrip(";")
+    if partition_probe == "quantile":
+        probe = (
+            "SELECT MIN(PARTITION_KEY) AS LOWER_BOUND FROM (\n"
+            f"SELECT {partition_key} AS PARTITION_KEY, "
+            f"NTILE({int(partitions)}) OVER (ORDER BY {partition_key}) AS PARTITION_BUCKET\n"
+            f"{from_clause}\n"
+            ") AS PARTITION_PROBE GROUP BY PARTITION_BUCKET ORDER BY LOWER_BOUND"
+        )
+        with execute_query(connection_url, probe, trial_code, params=params) as result:
+            lower_bounds = [row[0] for row in result.fetchall()]
+    else:
+        probe = f"SELECT MIN({partition_key}), MAX({partition_key})\n{from_clause}"
+        with execute_query(connection_url, probe, trial_code, params=params) as result:
+            lowest, highest = result.fetchone()
+        if lowest is None:
+            return []
+        lowest, highest = int(lowest), int(highest)
+        step = (highest - lowest + 1) / partitions
+        lower_bounds = sorted({lowest + int(step * i) for i in range(partitions)})
+    logger.debug(f"Partition lower bounds on {partition_key}: {lower_bounds}")
+    upper_bounds = lower_bounds[1:] + [None]
+    return list(zip(lower_bounds, upper_bounds))
+
+
+def partitioned_query_to_df(
+    connection_url,
+    query,
+    trial_code=None,
+    partitions=4,
+    partition_key="INV.INVENTORYID",
+    partition_probe="minmax",
+    params=None,
+    **kwargs,
+):
+    """
+    Fetch a query as several key ranges in parallel and combine the results.
+
+    Each range runs on its own pooled connection with a
+    ``partition_key >= :partition_lower AND partition_key < :partition_upper``
+    condition added to the query. The parts are concatenated in key order, so
+    the combined output is the same from run to run. Rows with a NULL key are
+    not fetched.
+
+    Args:
+        connection_url (Union[URL, Engine]): SQLAlchemy connection URL, or a shared engine.
+        query (str): SQL query text to execute.
+        trial_code (Optional[str]): Trial code parameter for the query.
+        partitions (int): Number of key ranges.
+        partition_key (str): SQL expression to split on.
+        partition_probe (str): ``"minmax"`` or ``"quantile"``, see :func:`partition_ranges`.
+        params (Optional[dict]): Additional bound parameters for the query.
+        **kwargs: Passed through to :func:`query_to_df` for each range.
+
+    Returns:
+        pd.DataFrame: Query results as a pandas DataFrame.
+    """
+    owns_engine = not isinstance(connection_url, Engine)
+    engine = create_db_engine(connection_url) if owns_engine else connection_url
+    try:
+        ranges = partition_ranges(
+            engine,
+            query,
+            partition_key,
+            partitions,
+            partition_probe=partition_probe,
+            trial_code=trial_code,
+            params=params,
+        )
+        if not ranges:
+            return query_to_df(engine, query, trial_code, params=params, **kwargs)
+        logger.info(f"Fetching {len(ranges)} key ranges of {partition_key} in parallel")
+        with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+            futures = []
+            for lower, upper in ranges:
+                condition = f"{partition_key} >= :partition_lower"
+                range_params = {**(params or {}), "partition_lower": lower}
+                if upper is not None:
+                    condition += f" AND {partition_key} < :partition_upper"
+                    range_params["partition_upper"] = upper
+                futures.append(
+                    pool.submit(
+                        query_to_df,
+                        engine,
+                        add_where_condition(query, condition),
+                        trial_code,
+                        params=range_params,
+                        **kwargs,
+                    )
+                )
+            parts = [future.result() for future in futures]
+    finally:
+        if owns_engine:
+            engine.dispose()
+    logger.debug(f"Fetched partitions of {[len(part) for part in parts]} rows")
+    return pd.concat(parts, ignore_index=True)
+
+
+def metered_batches(batches, started):
+    """
+    Pass batches through while logging fetch latency and throughput.
+
+    Only the time spent producing each batch is counted, not the time the
+    consumer spends on it, so the rate reflects the fetch rather than whatever
+    is done with the rows afterwards.
+
+    Args:
+        batches (Iterable[Sized]): Batches of rows.
+        started (float): ``time.perf_counter()`` when the query was submitted.
+
+    Yields:
+        The batches, unchanged.
+    """
+    iterator = iter(batches)
+    row_count = 0
+    steady_rows = 0
+    steady_seconds = 0.0
+    while True:
+        batch_started = time.perf_counter()
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            break
+        fetch_seconds = time.perf_counter() - batch_started
+        if row_count == 0:
+            logger.info(
+                f"Time to first row: {batch_started + fetch_seconds - started:.3f}s"
+            )
+        else:
+            steady_rows += len(batch)
+            steady_seconds += fetch_seconds
+        row_count += len(batch)
+        yield batch
+    if steady_seconds > 0:
+        logger.info(
+            f"Fetched {row_count} rows; steady-state {steady_rows / steady_seconds:,.0f} rows/sec after the first batch."
+        )
+    else:
+        logger.info(f"Fetched {row_count} rows in a single batch.")
+
+
+def arrow_type(column_description):
+    """
+    Map a DBAPI cursor description entry to a pyarrow type.
+
+    pyodbc reports the Python type of each column as its ``type_code``; drivers
+    that don't (e.g. sqlite3) report ``None`` and the type is left to inference.
+
+    Args:
+        column_description (tuple): One entry of ``cursor.description``.
+
+    Returns:
+        Optional[pa.DataType]: The matching Arrow type, or None if unknown.
+    """
+    _, type_code, _, _, precision, scale, *_ = column_description
+    if type_code is str:
+        return pa.large_string()
+    if type_code is bool:
+        return pa.bool_()
+    if type_code is int:
+        return pa.int64()
+    if type_code is float:
+        return pa.float64()
+    if type_code is decimal.Decimal:
+        if precision and 0 < precision <= 38:
+            return pa.decimal128(precision, scale or 0)
+        return pa.float64()
+    if type_code is datetime.datetime:
+        return pa.timestamp("us")
+    if type_code is datetime.date:
+        return pa.date32()
+    if type_code is datetime.time:
+        return pa.time64("us")
+    if type_code in (bytes, bytearray):
+        return pa.large_binary()
+    return None
+
+
+def iter_record_batches(cursor, batch_size=50_000):
+    """
+    Read a DBAPI cursor into Arrow record batches.
+
+    Each batch is built column by column with ``pa.array``, typed from the cursor
+    description, so values never pass through a DataFrame of boxed Python
+    objects. Columns the driver doesn't type are inferred from the first batch
+    that contains a non-NULL value and held to that type afterwards.
+
+    Args:
+        cursor: An executed DBAPI cursor.
+        batch_size (int): Number of rows to fetch per batch.
+
+    Yields:
+        pa.RecordBatch: The next batch of rows.
+    """
+    names = [column[0] for column in cursor.description]
+    types = [arrow_type(column) for column in cursor.description]
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        arrays = []
+        for i, values in enumerate(zip(*rows)):
+            array = pa.array(values, type=types[i])
+            if types[i] is None and not pa.types.is_null(array.type):
+                types[i] = array.type
+            arrays.append(array)
+        yield pa.RecordBatch.from_arrays(arrays, names=names)
+
+
+def cursor_to_arrow(cursor, batch_size=50_000):
+    """
+    Read all remaining rows of a DBAPI cursor into an Arrow table.
+
+    Args:
+        cursor: An executed DBAPI cursor.
+        batch_size (int): Number of rows to fetch per batch.
+
+    Returns:
+        pa.Table: The result set, typed from the cursor description.
+    """
+    return record_batches_to_table(
+        iter_record_batches(cursor, batch_size), cursor.description
+    )
+
+
+def record_batches_to_table(batches, description):
+    """
+    Combine record batches from :func:`iter_record_batches` into one table.
+
+    Args:
+        batches (Iterable[pa.RecordBatch]): Batches read from the cursor.
+        description (Sequence[tuple]): The DBAPI cursor description.
+
+    Returns:
+        pa.Table: The combined table with one consistent schema.
+    """
+    batches = list(batches)
+    types = [arrow_type(column) for column in description]
+    for batch in batches:
+        # Fill in types for columns the driver left untyped
+        types = [
+            field_type or (None if pa.types.is_null(field.type) else field.type)
+            for field_type, field in zip(types, batch.schema)
+        ]
+    schema = pa.schema(
+        [
+            (column[0], field_type or pa.null())
+            for column, field_type in zip(description, types)
+        ]
+    )
+    return pa.Table.from_batches(
+        [batch.cast(schema) for batch in batches], schema=schema
+    )
+
+
+def rows_to_arrow(rows, description):
+    """
+    Convert fetched row tuples to an Arrow table typed from the cursor description.
+
+    Args:
+        rows (Sequence[tuple]): Rows fetched from the cursor.
+        description (Sequence[tuple]): The DBAPI cursor description.
+
+    Returns:
+        pa.Table: The rows; columns the driver doesn't type are inferred.
+    """
+    columns = list(zip(*rows)) or [()] * len(description)
+    return pa.table(
+        [
+            pa.array(values, type=arrow_type(column))
+            for column, values in zip(description, columns)
+        ],
+        names=[column[0] for column in description],
+    )
+
+
+def recording_path(record_dir, query, trial_code=None, params=None):
+    """
+    Build the file a query's result set is recorded to.
+
+    Args:
+        record_dir (Union[str, Path]): Directory of recordings.
+        query (str): SQL query text.
+        trial_code (Optional[str]): Trial code parameter for the query.
+        params (Optional[dict]): Additional bound parameters for the query.
+
+    Returns:
+        Path: ``<trial code>-<digest of query and parameters>.arrow``.
+    """
+    key = hashlib.sha256(
+        json.dumps(
+            {"query": query, "params": query_params(trial_code, params)},
+            sort_keys=True,
+            default=str,
+        ).encode()
+    ).hexdigest()[:12]
+    name = slugify(text=trial_code or "query", separator="_", lowercase=False)
+    return Path(record_dir) / f"{name}-{key}.arrow"
+
+
+def write_recording(recording_file, table, description, query=None, params=None):
+    """
+    Record a result set to an Arrow IPC file, to be replayed without a server.
+
+    The file holds the rows with their Arrow types, plus the cursor
+    description, query and parameters as schema metadata. The description's
+    type codes are stored by name, see DESCRIPTION_TYPES.
+
+    Args:
+        recording_file (Union[str, Path]): The ``.arrow`` file to write.
+        table (pa.Table): The result set.
+        description (Sequence[tuple]): The DBAPI cursor description.
+        query (Optional[str]): SQL query text that produced the result.
+        params (Optional[dict]): Bound query parameters.
+
+    Returns:
+        Path: The recording file.
+    """
+    recording_file = Path(recording_file)
+    recording_file.parent.mkdir(parents=True, exist_ok=True)
+    description = [
+        [
+            column[0],
+            getattr(column[1], "__name__", None),
+            *column[2:7],
+        ]
+        for column in description
+    ]
+    metadata = {
+        "sparqy.description": json.dumps(description),
+        "sparqy.query": query or "",
+        "sparqy.params": json.dumps(params or {}, default=str),
+        "sparqy.recorded": datetime.datetime.now().isoformat(),
+    }
+    table = table.replace_schema_metadata(metadata)
+    with pa.OSFile(str(recording_file), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    logger.info(f"Recorded {table.num_rows} rows to {recording_file}")
+    return recording_file
+
+
+def read_recording(recording_file):
+    """
+    Read a result set recorded by :func:`write_recording`.
+
+    Args:
+        recording_file (Union[str, Path]): The ``.arrow`` file.
+
+    Returns:
+        tuple[pa.Table, list[tuple], dict]: The rows, the cursor description
+        with its Python type codes restored, and the recording's query,
+        params and recording time.
+    """
+    with pa.memory_map(str(recording_file)) as source:
+        table = pa.ipc.open_file(source).read_all()
+    metadata = {
+        key.decode(): value.decode()
+        for key, value in (table.schema.metadata or {}).items()
+    }
+    description = [
+        (name, DESCRIPTION_TYPES.get(type_name), *rest)
+        for name, type_name, *rest in json.loads(metadata["sparqy.description"])
+    ]
+    info = {
+        "query": metadata.get("sparqy.query"),
+        "params": json.loads(metadata.get("sparqy.params", "{}")),
+        "recorded": metadata.get("sparqy.recorded"),
+    }
+    return table.replace_schema_metadata(None), description, info
+
+
+def parquet_schema(table, description=None, typed_columns=()):
+    """
+    Build a stable parquet schema for a chunked write from its first chunk.
+
+    Types reported by the cursor description take precedence over those inferred
+    from the first chunk, so a column that happens to be all NULL (or all whole
+    numbers) in one chunk doesn't fix the wrong type for the rest of the file.
+    Columns that remain untyped are written as strings. Dictionary columns get
+    32-bit indices, so later chunks with more distinct values still fit.
+
+    Args:
+        table (pa.Table): The first chunk converted to Arrow.
+        description (Optional[Sequence[tuple]]): The DBAPI cursor description.
+        typed_columns (Iterable[str]): Columns whose chunk type was set on
+            purpose, e.g. by a schema manifest, and takes precedence instead.
+
+    Returns:
+        pa.Schema: Schema to open the parquet writer with.
+    """
+    described_types = {column[0]: arrow_type(column) for column in (description or [])}
+    typed_columns = set(typed_columns)
+    fields = []
+    for field in table.schema:
+        described_type = described_types.get(field.name)
+        if field.name in typed_columns:
+            field_type = field.type
+        else:
+            field_type = described_type or field.type
+        if pa.types.is_dictionary(field_type):
+            value_type = described_type or field_type.value_type
+            if pa.types.is_null(value_type):
+                value_type = pa.large_string()
+            field_type = pa.dictionary(pa.int32(), value_type)
+        if pa.types.is_null(field_type):
+            field_type = pa.large_string()
+        fields.append(field.with_type(field_type))
+    return pa.schema(fields, metadata=table.schema.metadata)
+
+
+def query_to_parquet(
+    connection_url,
+    query,
+    parquet_file_path,
+    trial_code=None,
+    chunk_size=50_000,
+    compression="zstd",
+    transform=None,
+    fetch_engine="pandas",
+    stream_results=False,
+    arraysize=None,
+    params=None,
+    schema=None,
+    dictionary_threshold=0,
+    dtype_backend=None,
+):
+    """
+    Execute a database query and stream the results to a parquet file.
+
+    Rows are read from the cursor with ``fetchmany`` and each chunk is written as
+    its own row group, so peak memory is bounded by ``chunk_size`` rather than
+    by the size of the result.
+
+    Args:
+        connection_url (Union[URL, Engine]): SQLAlchemy connection URL, or a shared engine.
+        query (str): SQL query text to execute.
+        parquet_file_path (Union[str, Path]): Destination parquet file.
+        trial_code (Optional[str]): Trial code parameter for the query.
+        chunk_size (int): Number of rows to fetch and write at a time.
+        compression (str): Parquet compression codec.
+        transform (Optional[Callable[[pd.DataFrame], pd.DataFrame]]): Applied to
+            each chunk before it is written.
+        fetch_engine (str): ``"pandas"`` or ``"arrow"``, see :func:`query_to_df`.
+        stream_results (bool): Request a server-side cursor, see
+            :func:`execute_query`.
+        arraysize (Optional[int]): Set ``cursor.arraysize`` on the DBAPI cursor.
+        params (Optional[dict]): Additional bound parameters for the query.
+        schema (Optional[dict[str, str]]): Column types applied to each chunk,
+            see :func:`apply_schema`.
+        dictionary_threshold (float): Dictionary encode string columns with at
+            most this ratio of distinct values to rows in the first chunk.
+        dtype_backend (Optional[str]): ``"numpy"`` or ``"pyarrow"`` dtypes for
+            each chunk, see :func:`query_to_df`.
+
+    Returns:
+        int: Number of rows written.
+    """
+    row_count = 0
+    writer = None
+    encoded_columns = None
+
+    def write_chunk(df, writer):
+        nonlocal row_count, encoded_columns
+        if schema:
+            df = apply_schema(df, schema)
+        # The first chunk decides, so every chunk matches the writer's schema
+        if encoded_columns is None:
+            encoded_columns = low_cardinality_columns(df, dictionary_threshold)
+            if encoded_columns:
+                logger.info(
+                    f"Dictionary encoding low-cardinality columns: {encoded_columns}"
+                )
+        df = dictionary_encode(df, dictionary_threshold, encoded_columns)
+        if transform is not None:
+            df = transform(df)
+        with timed_phase("to_parquet", trial_code) as phase:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if writer is None:
+                writer_schema = parquet_schema(
+                    table, description, [*(schema or ()), *encoded_columns]
+                )
+                writer = pq.ParquetWriter(
+                    parquet_file_path, writer_schema, compression=compression
+                )
+            writer.write_table(table.cast(writer.schema))
+            phase["rows"], phase["bytes"] = len(df), table.nbytes
+        row_count += len(df)
+        logger.debug(f"Wrote chunk of {len(df)} rows ({row_count} total)")
+        return writer
+
+    started = time.perf_counter()
+    with execute_query(
+        connection_url,
+        query,
+        trial_code=trial_code,
+        stream_results=stream_results,
+        arraysize=arraysize,
+        params=params,
+    ) as result:
+        columns = list(result.keys())
+        description = result.cursor.description if result.cursor else None
+        if fetch_engine == "arrow":
+            batches = metered_batches(
+                iter_record_batches(result.cursor, chunk_size), started
+            )
+            types_mapper = None if dtype_backend == "numpy" else pd.ArrowDtype
+            chunks = (batch.to_pandas(types_mapper=types_mapper) for batch in batches)
+        else:
+            batches = metered_batches(
+                iter(partial(result.fetchmany, chunk_size), []), started
+            )
+            if dtype_backend == "pyarrow":
+                chunks = (
+                    rows_to_arrow(rows, description).to_pandas(
+                        types_mapper=pd.ArrowDtype
+                    )
+                    for rows in batches
+                )
+            else:
+                chunks = (pd.DataFrame(rows, columns=columns) for rows in batches)
+        try:
+            for df in chunks:
+                writer = write_chunk(df, writer)
+            if writer is None:
+                # An empty result still writes the (empty) schema
+                writer = write_chunk(pd.DataFrame(columns=columns), writer)
+        finally:
+            if writer is not None:
+                writer.close()
+    return row_count
+
+
+def viability_reasons(df, rules, exclude_conditions, exclude_matcodes):
+    """
+    Evaluate viability rules into a bitmask of the rules each row breaks.
+
+    Each rule is one vectorized comparison whose result is OR-ed into its bit
+    of a single unsigned integer array, so no filtered copies of the frame are
+    made.
+
+    Args:
+        df (pd.DataFrame): Input specimen data.
+        rules (list[dict]): Rules from :func:`load_viability_rules`.
+        exclude_conditions (list[str]): The ``exclude_conditions`` list.
+        exclude_matcodes (list[str]): The ``exclude_matcodes`` list.
+
+    Returns:
+        tuple[np.ndarray, dict[str, int]]: The smallest unsigned integer array
+        that holds a bit per rule, and the number of rows each rule matched.
+    """
+    dtype = next(
+        dtype
+        for dtype in (np.uint8, np.uint16, np.uint32, np.uint64)
+        if len(rules) <= np.iinfo(dtype).bits
+    )
+    reasons = np.zeros(len(df), dtype=dtype)
+    counts = {}
+    for bit, rule in enumerate(rules):
+        column = df[rule["column"]]
+        if rule["test"] == "is_null":
+            matched = column.isna()
+        elif rule["test"] == "at_most":
+            matched = column.le(rule["value"])
+        else:
+            matched = column.isin(
+                viability_rule_values(rule, exclude_conditions, exclude_matcodes)
+            )
+        matched = matched.to_numpy(dtype=bool, na_value=False)
+        counts[rule["name"]] = int(np.count_nonzero(matched))
+        reasons |= matched.astype(dtype) << dtype(bit)
+    return reasons, counts
+
+
+def flag_viable(df, exclude_conditions, exclude_matcodes, rules=None):
+    """
+    Apply viability rules to filter or mark specimens in the DataFrame.
+
+    Args:
+        df (pd.DataFrame): Input specimen data.
+        exclude_conditions (list[str]): List of RECEIVED_CONDITION or SAMPLE_CONDITION values to exclude.
+        exclude_matcodes (list[str]): List of MATCODE values to exclude.
+        rules (Optional[list[dict]]): Viability rules; defaults to those in
+            VIABILITY_RULES_FILE.
+
+    Returns:
+        pd.DataFrame: DataFrame with an added 'VIABLE' boolean column, and a
+        'NONVIABLE_REASON' bitmask of the rules each specimen breaks, bit i
+        for the i-th rule; both are Arrow-backed if the rule columns are. The
+        number of specimens each rule matched is kept in
+        ``df.attrs["nonviable_counts"]``.
+    """
+    logging.info(
+        f"Flagging non-viable specimens based on conditions: {exclude_conditions} and matcodes: {exclude_matcodes}"
+    )
+    rules = load_viability_rules() if rules is None else rules
+    reasons, counts = viability_reasons(df, rules, exclude_conditions, exclude_matcodes)
+    viable = reasons == 0
+    if rules and all(
+        isinstance(df[rule["column"]].dtype, pd.ArrowDtype) for rule in rules
+    ):
+        # Keep an Arrow-backed frame on Arrow, so Parquet writes need no conversion
+        viable = pd.arrays.ArrowExtensionArray(pa.array(viable))
+        reasons = pd.arrays.ArrowExtensionArray(pa.array(reasons))
+    df["VIABLE"] = viable
+    df["NONVIABLE_REASON"] = reasons
+    df.attrs["nonviable_counts"] = counts
+    not_viable_count = int(np.count_nonzero(df["NONVIABLE_REASON"].to_numpy()))
+    percent_not_viable = (
+        round((not_viable_count / df.shape[0]) * 100, 2) if df.shape[0] > 0 else 0
+    )
+    logging.info(
+        f"Flagged {not_viable_count} non-viable specimens ({percent_not_viable}%): "
+        + ", ".join(f"{name} {count}" for name, count in counts.items())
+    )
+    return df
+
+
+def comment_fields(keys=None):
+    """
+    Build the COMMENTS fields to parse, adding extra keys to COMMENT_FIELDS.
+
+    Args:
+        keys (Optional[list[str]]): Extra keys, each parsed into a column of
+            the same name. Their values run up to the next comma, semicolon or
+            whitespace.
+
+    Returns:
+        dict[str, dict]: Fields by output column, see COMMENT_FIELDS.
+    """
+    fields = dict(COMMENT_FIELDS)
+    for key in keys or []:
+        if not re.fullmatch(r"\w+", key):
+            raise ValueError(f"Invalid COMMENTS key: {key!r}")
+        fields.setdefault(key, {"key": key, "value": COMMENT_KEY_VALUE})
+    return fields
+
+
+def comment_field_pattern(field):
+    """
+    Build the regex for one COMMENTS field on its own.
+
+    Args:
+        field (dict): The field, see COMMENT_FIELDS.
+
+    Returns:
+        str: The pattern, with the value in group ``value``.
+    """
+    return (
+        f"{re.escape(field['key'])}:(?P<value>{field['value']})"
+        f"{re.escape(field.get('end', ''))}"
+    )
+
+
+def parse_comments(comments, fields=None):
+    """
+    Parse KEY:value fields out of a COMMENTS column with vectorized regexes.
+
+    Each field runs :func:`comment_field_pattern` over the whole column with
+    ``pyarrow.compute.extract_regex`` and gets its first match, so a key inside
+    another field's value is still found. Arrow's regex scans are faster than
+    ``Series.str.extract`` and skip converting the column to Python strings.
+
+    Args:
+        comments (pd.Series): The COMMENTS column.
+        fields (Optional[dict[str, dict]]): Fields by output column; defaults to
+            COMMENT_FIELDS.
+
+    Returns:
+        pd.DataFrame: One column per field, NULL where its key isn't present.
+        Columns are Arrow-backed if ``comments`` is, and ``str`` otherwise,
+        unless the field sets a ``dtype``.
+    """
+    fields = COMMENT_FIELDS if fields is None else fields
+    arrow_backed = isinstance(comments.dtype, pd.ArrowDtype)
+    array = pa.array(comments, from_pandas=True)
+    if pa.types.is_dictionary(array.type):
+        array = array.dictionary_decode()
+    if not (pa.types.is_string(array.type) or pa.types.is_large_string(array.type)):
+        array = array.cast(pa.large_string())
+    columns = {}
+    for name, field in fields.items():
+        matches = pc.extract_regex(array, comment_field_pattern(field))
+        # flatten(), unlike field(), keeps the NULLs of comments that don't match
+        values = matches.flatten()[0]
+        if arrow_backed:
+            column = pd.Series(
+                values, index=comments.index, dtype=pd.ArrowDtype(values.type)
+            )
+        else:
+            column = pd.Series(values, index=comments.index, dtype="str")
+        columns[name] = column.astype(field["dtype"]) if "dtype" in field else column
+    return pd.DataFrame(columns, index=comments.index)
+
+
+def extract_sampleid(df, fields=None):
+    """
+    Add columns parsed from the ``KEY:value`` fields of the COMMENTS column.
+
+    By default these are COMMENT_FIELDS: ``SAMPLEID`` from ``SAMPLEID:...,``
+    and ``SAMPLEID2``, the numeric lab ID from ``LAB_ID:<digits>``, for samples
+    identified that way instead. ``fields`` adds or replaces fields, each
+    becoming a column of its own, see :func:`parse_comments`.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        A DataFrame that must contain a ``COMMENTS`` column.
+    fields : dict, optional
+        Fields to parse by output column; defaults to COMMENT_FIELDS, see
+        :func:`comment_fields` for adding keys.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The same DataFrame with a column per field, holding its value or NaN
+        where the comment doesn't contain its key.
+    """
+    parsed = parse_comments(df["COMMENTS"], fields)
+    for column in parsed.columns:
+        df[column] = parsed[column]
+    return df
+
+
+def transform_inventory(
+    df,
+    no_viable,
+    exclude_conditions,
+    exclude_matcodes,
+    trial_code=None,
+    comment_fields=None,
+    viability_rules=None,
+    locations=None,
+    column_order=None,
+):
+    """
+    Apply the standard trial inventory transforms to a DataFrame.
+
+    Args:
+        df (pd.DataFrame): Raw trial inventory rows.
+        no_viable (bool): Skip viability flagging.
+        exclude_conditions (list[str]): Viability filters.
+        exclude_matcodes (list[str]): Matcode filters.
+        trial_code (Optional[str]): Trial the rows belong to, for phase timings.
+        comment_fields (Optional[dict[str, dict]]): Fields parsed out of
+            COMMENTS, see :func:`extract_sampleid`.
+        viability_rules (Optional[list[dict]]): Rules for :func:`flag_viable`.
+        locations (Optional[pd.DataFrame]): Locations dimension to resolve the
+            location columns from, see :func:`resolve_locations`.
+        column_order (Optional[list[str]]): Column order restored by
+            :func:`resolve_locations`.
+
+    Returns:
+        pd.DataFrame: The transformed DataFrame.
+    """
+    if locations is not None:
+        with timed_phase("resolve_locations", trial_code) as phase:
+            df = resolve_locations(df, locations, column_order)
+            phase["rows"] = len(df)
+    with timed_phase("extract_sampleid", trial_code) as phase:
+        df = extract_sampleid(df, comment_fields)
+        phase["rows"] = len(df)
+    if not no_viable:
+        with timed_phase("flag_viable", trial_code) as phase:
+            df = flag_viable(
+                df, exclude_conditions, exclude_matcodes, rules=viability_rules
+            )
+            phase["rows"] = len(df)
+    return df
+
+
+def polars_comment_columns(fields=None):
+    """
+    Build Polars expressions that parse COMMENTS like :func:`parse_comments`.
+
+    Each field runs :func:`comment_field_pattern` with ``str.extract``, which
+    gives its first match as :func:`parse_comments` does. Polars evaluates the
+    expressions in parallel.
+
+    Args:
+        fields (Optional[dict[str, dict]]): Fields by output column; defaults to
+            COMMENT_FIELDS.
+
+    Returns:
+        list[pl.Expr]: An expression per field.
+
+    Raises:
+        ValueError: If a field sets a ``dtype``, which is a pandas dtype.
+    """
+    import polars as pl
+
+    fields = COMMENT_FIELDS if fields is None else fields
+    typed = [name for name, field in fields.items() if "dtype" in field]
+    if typed:
+        raise ValueError(f"The polars engine can't apply the dtype of {typed}")
+    comments = pl.col("COMMENTS").cast(pl.String)
+    return [
+        comments.str.extract(comment_field_pattern(field), 1).alias(name)
+        for name, field in fields.items()
+    ]
+
+
+def polars_viability_reasons(rules, exclude_conditions, exclude_matcodes):
+    """
+    Build the Polars expression for the NONVIABLE_REASON bitmask.
+
+    Matches :func:`viability_reasons`: a bit per rule in the same order, in
+    the same smallest unsigned integer type, with NULLs never matching a
+    comparison and matching an ``in`` rule only if its values include None.
+
+    Args:
+        rules (list[dict]): Rules from :func:`load_viability_rules`.
+        exclude_conditions (list[str]): The ``exclude_conditions`` list.
+        exclude_matcodes (list[str]): The ``exclude_matcodes`` list.
+
+    Returns:
+        pl.Expr: The bitmask.
+    """
+    import polars as pl
+
+    dtype = next(
+        dtype
+        for bits, dtype in (
+            (8, pl.UInt8),
+            (16, pl.UInt16),
+            (32, pl.UInt32),
+            (64, pl.UInt64),
+        )
+        if len(rules) <= bits
+    )
+    bits = []
+    for bit, rule in enumerate(rules):
+        column = pl.col(rule["column"])
+        if rule["test"] == "is_null":
+            matched = column.is_null()
+        elif rule["test"] == "at_most":
+            matched = (column <= rule["value"]).fill_null(False)
+        else:
+            values = viability_rule_values(rule, exclude_conditions, exclude_matcodes)
+            matched = column.is_in([value for value in values if value is not None])
+            matched = matched.fill_null(False)
+            if None in values:
+                matched = matched | column.is_null()
+        bits.append(matched.cast(dtype) * pl.lit(1 << bit, dtype=dtype))
+    if not bits:
+        return pl.lit(0, dtype=dtype)
+    return pl.sum_horizontal(bits).cast(dtype)
+
+
+def polars_transform_inventory(
+    df,
+    no_viable,
+    exclude_conditions,
+    exclude_matcodes,
+    comment_fields=None,
+    viability_rules=None,
+):
+    """
+    Express :func:`transform_inventory` as a Polars lazy query.
+
+    The columns added, their order and their values are those of the pandas
+    transforms. The query runs on all cores when it's collected or sunk.
+
+    Args:
+        df (Union[pd.DataFrame, pa.Table]): Raw trial inventory rows.
+        no_viable (bool): Skip viability flagging.
+        exclude_conditions (list[str]): Viability filters.
+        exclude_matcodes (list[str]): Matcode filters.
+        comment_fields (Optional[dict[str, dict]]): Fields parsed out of
+            COMMENTS, see :func:`extract_sampleid`.
+        viability_rules (Optional[list[dict]]): Rules for :func:`flag_viable`.
+
+    Returns:
+        pl.LazyFrame: The transformed rows.
+    """
+    import polars as pl
+
+    # Through Arrow, which Arrow-backed columns reach without a copy
+    if isinstance(df, pd.DataFrame):
+        df = pa.Table.from_pandas(df, preserve_index=False)
+    frame = pl.from_arrow(df)
+    lazy = frame.lazy().with_columns(polars_comment_columns(comment_fields))
+    if not no_viable:
+        rules = load_viability_rules() if viability_rules is None else viability_rules
+        reasons = polars_viability_reasons(rules, exclude_conditions, exclude_matcodes)
+        lazy = lazy.with_columns(reasons.alias("NONVIABLE_REASON")).with_columns(
+            (pl.col("NONVIABLE_REASON") == 0).alias("VIABLE")
+        )
+        # flag_viable adds VIABLE first
+        names = lazy.collect_schema().names()
+        names.remove("VIABLE")
+        names.insert(names.index("NONVIABLE_REASON"), "VIABLE")
+        lazy = lazy.select(names)
+    return lazy
+
+
+def polars_inventory_to_parquet(
+    df,
+    parquet_file,
+    compression,
+    no_viable,
+    exclude_conditions,
+    exclude_matcodes,
+    comment_fields=None,
+    viability_rules=None,
+):
+    """
+    Transform the trial inventory with Polars and stream it to Parquet.
+
+    The number of specimens each viability rule matched is logged, like
+    :func:`flag_viable` does. The counts and the file come from one plan, so
+    the transforms run once.
+
+    Args:
+        df (Union[pd.DataFrame, pa.Table]): Raw trial inventory rows.
+        parquet_file (Path): Destination parquet file.
+        compression (Optional[str]): Parquet compression codec.
+        no_viable (bool): Skip viability flagging.
+        exclude_conditions (list[str]): Viability filters.
+        exclude_matcodes (list[str]): Matcode filters.
+        comment_fields (Optional[dict[str, dict]]): Fields parsed out of
+            COMMENTS, see :func:`extract_sampleid`.
+        viability_rules (Optional[list[dict]]): Rules for :func:`flag_viable`.
+
+    Returns:
+        dict[str, int]: Specimens matched by each viability rule; empty with
+        ``no_viable``.
+    """
+    import polars as pl
+
+    rules = load_viability_rules() if viability_rules is None else viability_rules
+    lazy = polars_transform_inventory(
+        df,
+        no_viable,
+        exclude_conditions,
+        exclude_matcodes,
+        comment_fields=comment_fields,
+        viability_rules=rules,
+    )
+    sink = lazy.sink_parquet(
+        parquet_file, compression=compression or "uncompressed", lazy=True
+    )
+    if no_viable:
+        sink.collect()
+        return {}
+    reasons = pl.col("NONVIABLE_REASON")
+    counts = lazy.select(
+        (reasons != 0).sum().alias("_NONVIABLE"),
+        *[
+            ((reasons & (1 << bit)) != 0).sum().alias(rule["name"])
+            for bit, rule in enumerate(rules)
+        ],
+    )
+    _, counts = pl.collect_all([sink, counts])
+    totals = counts.row(0, named=True)
+    not_viable_count = totals.pop("_NONVIABLE")
+    percent_not_viable = round(not_viable_count / len(df) * 100, 2) if len(df) else 0
+    logging.info(
+        f"Flagged {not_viable_count} non-viable specimens ({percent_not_viable}%): "
+        + ", ".join(f"{name} {count}" for name, count in totals.items())
+    )
+    return totals
+
+
+def parquet_path(trial_code, output_dir, include_dsn_in_filename, add_trial_to_path):
+    """
+    Construct the final filesystem path for the output parquet file.
+
+    Args:
+        trial_code (str): The trial code used for naming.
+        output_dir (Union[str, Path]): Base directory for output.
+        include_dsn_in_filename (bool): Whether to append '_PROD' to the filename.
+        add_trial_to_path (bool): Whether to nest the file in a trial-named subdirectory.
+
+    Returns:
+        Path: The absolute or relative Path object for the target file.
+    """
+    # Add DSN to filename if specified
+    if include_dsn_in_filename:
+        final_parquet_file = f"{trial_code}_PROD"
+    else:
+        final_parquet_file = f"{trial_code}"
+    final_parquet_file = (
+        slugify(text=final_parquet_file, separator="_", lowercase=False) + ".parquet"
+    )
+    final_parquet_path = Path(output_dir)
+    # Store the parquet file in a subdirectory named after the trial code if specified
+    if add_trial_to_path:
+        final_parquet_path = final_parquet_path / trial_code
+    final_parquet_path.mkdir(parents=True, exist_ok=True)
+    final_parquet_file_path = final_parquet_path / final_parquet_file
+    return final_parquet_file_path
+
+
+def redact_dsn_password(dsn: str) -> str:
+    """
+    Redact the PWD parameter in a DSN string for safe logging.
+
+    Args:
+        dsn (str): Original ODBC connection string.
+
+    Returns:
+        str: Connection string with the password replaced by asterisks.
+    """
+    # Replace PWD=...; with PWD=****;
+    # handles case like PWD=password123;
+    return re.sub(r"(PWD=)[^;]*", r"\1****", dsn, flags=re.IGNORECASE)
+
+
+def timed(phase, trial_code, func, *args, **kwargs):
+    """
+    Call a function as a timed phase, see :func:`timed_phase`.
+
+    The function's return value is recorded as the phase's row count.
+
+    Returns:
+        tuple: The function's return value and the elapsed wall-clock seconds.
+    """
+    with timed_phase(phase, trial_code) as record:
+        result = record["rows"] = func(*args, **kwargs)
+    return result, record["wall_seconds"]
+
+
+def peak_rss_mb():
+    """
+    Return the peak resident set size of this process so far.
+
+    Returns:
+        Optional[float]: Peak RSS in MiB, or None where the ``resource`` module
+        isn't available (Windows).
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS but kilobytes on Linux
+    return round(peak / (2**20 if sys.platform == "darwin" else 2**10), 1)
+
+
+@contextmanager
+def timed_phase(phase, trial_code=None):
+    """
+    Time a phase of the pipeline and record it in PHASE_TIMINGS.
+
+    The block can fill in the ``rows`` and ``bytes`` of the yielded record.
+    CPU time is that of the calling thread, so work the phase hands to other
+    threads isn't counted; peak RSS is the process high-water mark when the
+    phase ends. While tracemalloc is tracing, the peak of Python allocations
+    during the phase is recorded too, see :func:`trace_phase_start`.
+
+    Args:
+        phase (str): Name of the phase, e.g. ``"fetch"`` or ``"flag_viable"``.
+        trial_code (Optional[str]): Trial the phase belongs to.
+
+    Yields:
+        dict: The record being timed.
+    """
+    record = {"phase": phase, "trial_code": trial_code, "rows": None, "bytes": None}
+    record["traced_peak_mb"] = None
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        trace_phase_start(record)
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield record
+    finally:
+        record["wall_seconds"] = time.perf_counter() - wall_start
+        record["cpu_seconds"] = time.thread_time() - cpu_start
+        record["peak_rss_mb"] = peak_rss_mb()
+        if tracing:
+            trace_phase_end(record)
+        PHASE_TIMINGS.append(record)
+
+
+def trace_phase_start(record):
+    """
+    Start tracking the peak of traced allocations for a phase.
+
+    tracemalloc has one process-wide peak, so before it is reset for the new
+    phase, the peak so far is carried into the phases that are already open.
+    Phases running concurrently on other threads share that peak.
+
+    Args:
+        record (dict): The record of the phase, see :func:`timed_phase`.
+    """
+    with PROFILE_LOCK:
+        _, peak = tracemalloc.get_traced_memory()
+        for open_record in OPEN_PHASES:
+            open_record["traced_peak"] = max(open_record["traced_peak"], peak)
+        tracemalloc.reset_peak()
+        record["traced_peak"] = 0
+        OPEN_PHASES.append(record)
+
+
+def trace_phase_end(record):
+    """
+    Record the peak of traced allocations of a phase that has ended.
+
+    A snapshot of the live allocations is kept whenever a phase ends with
+    clearly more memory allocated than at any earlier snapshot, so the
+    profile shows what was holding memory at the high point of the run.
+
+    Args:
+        record (dict): The record of the phase, see :func:`timed_phase`.
+    """
+    with PROFILE_LOCK:
+        current, peak = tracemalloc.get_traced_memory()
+        OPEN_PHASES.remove(record)
+        peak = max(record.pop("traced_peak"), peak)
+        record["traced_peak_mb"] = round(peak / 2**20, 1)
+        if current > ALLOCATION_SNAPSHOT["traced_bytes"] * 1.1:
+            ALLOCATION_SNAPSHOT.update(
+                traced_bytes=current,
+                phase=record["phase"],
+                snapshot=tracemalloc.take_snapshot(),
+            )
+
+
+def write_profile(output_dir, started, profiler, top_n=25):
+    """
+    Save the cProfile statistics and allocation snapshot of a profiled run.
+
+    Writes ``sparqy-profile-<start time>.pstats``, which can be opened with
+    ``python -m pstats`` or snakeviz, and ``...-allocations.txt`` with the
+    ``top_n`` source lines holding the most memory in the largest snapshot.
+
+    Args:
+        output_dir (Union[str, Path]): Output directory of the run.
+        started (datetime.datetime): When the run started.
+        profiler (cProfile.Profile): The profiler, already disabled.
+        top_n (int): Number of functions and allocation sites to report.
+
+    Returns:
+        Path: The .pstats file.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    stem = f"sparqy-profile-{started:%Y%m%dT%H%M%S}"
+    stats_file = output_dir / f"{stem}.pstats"
+    profiler.dump_stats(stats_file)
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top_n)
+    logger.info(f"Profile saved to {stats_file.absolute()}\n{stream.getvalue()}")
+
+    snapshot = ALLOCATION_SNAPSHOT["snapshot"]
+    if snapshot is None:
+        lines = ["No allocations were traced."]
+    else:
+        lines = [
+            f"Top {top_n} allocation sites at the end of the "
+            f"{ALLOCATION_SNAPSHOT['phase']} phase, with "
+            f"{ALLOCATION_SNAPSHOT['traced_bytes'] / 2**20:.1f} MiB allocated:"
+        ]
+        snapshot = snapshot.filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        lines += [str(stat) for stat in snapshot.statistics("lineno")[:top_n]]
+    allocations_file = output_dir / f"{stem}-allocations.txt"
+    allocations_file.write_text("\n".join(lines) + "\n")
+    logger.info(f"Allocation snapshot saved to {allocations_file.absolute()}")
+    return stats_file
+
+
+def summarize_phases(records):
+    """
+    Total phase timings by trial and phase.
+
+    Phases that run once per chunk or query, like ``fetch`` or
+    ``extract_sampleid`` in a streamed download, are summed into one row.
+
+    Args:
+        records (list[dict]): Records made by :func:`timed_phase`.
+
+    Returns:
+        pd.DataFrame: One row per trial and phase, in the order they first ran.
+    """
+
+    def total(values):
+        # Phases that don't count rows or bytes stay null rather than 0
+        return values.sum(min_count=1)
+
+    columns = ["trial_code", "phase", "count", "wall_seconds", "cpu_seconds"]
+    columns += ["rows", "bytes", "peak_rss_mb", "traced_peak_mb"]
+    if not records:
+        return pd.DataFrame(columns=columns)
+    summary = (
+        pd.DataFrame(records)
+        .groupby(["trial_code", "phase"], dropna=False, sort=False)
+        .agg(
+            count=("phase", "size"),
+            wall_seconds=("wall_seconds", "sum"),
+            cpu_seconds=("cpu_seconds", "sum"),
+            rows=("rows", total),
+            bytes=("bytes", total),
+            peak_rss_mb=("peak_rss_mb", "max"),
+            traced_peak_mb=("traced_peak_mb", "max"),
+        )
+        .reset_index()
+    )
+    summary = summary.astype({"rows": "Int64", "bytes": "Int64"})
+    return summary[columns].round({"wall_seconds": 3, "cpu_seconds": 3})
+
+
+def write_run_report(output_dir, started, trial_summaries, records):
+    """
+    Write the JSON report of a run next to its parquet output.
+
+    Args:
+        output_dir (Union[str, Path]): Output directory of the run.
+        started (datetime.datetime): When the run started.
+        trial_summaries (list[dict]): Results returned by :func:`process_trial`.
+        records (list[dict]): Records made by :func:`timed_phase`.
+
+    Returns:
+        Path: The report file.
+    """
+    finished = datetime.datetime.now()
+    report = {
+        "started": started.isoformat(),
+        "finished": finished.isoformat(),
+        "wall_seconds": round((finished - started).total_seconds(), 3),
+        "peak_rss_mb": peak_rss_mb(),
+        "trials": trial_summaries,
+        # Round trip through pandas' JSON writer, which turns NaN into null
+        "phases": json.loads(summarize_phases(records).to_json(orient="records")),
+    }
+    report_file = Path(output_dir) / f"sparqy-report-{started:%Y%m%dT%H%M%S}.json"
+    report_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(report_file, "w") as file:
+        json.dump(report, file, indent=2, default=str)
+    logger.info(f"Run report saved to {report_file.absolute()}")
+    return report_file
+
+
+def load_transform_queries(sql_files):
+    """
+    Load the post-processing queries of ``--transform_sql``.
+
+    Args:
+        sql_files (list[Union[str, Path]]): DuckDB SQL files, each holding one
+            SELECT over the TRANSFORM_SQL_RELATIONS.
+
+    Returns:
+        dict[str, str]: Query text by file stem, which names its output.
+
+    Raises:
+        ValueError: If a file is missing or empty, or two files, or a file and
+            a relation, share a name.
+    """
+    queries = {}
+    for sql_file in sql_files or []:
+        name = Path(sql_file).stem
+        if name in queries or name in TRANSFORM_SQL_RELATIONS:
+            raise ValueError(f"Transform SQL file names must be unique: {sql_file}")
+        query = parse_sql_file(sql_file)
+        if not query or not query.strip():
+            raise ValueError(f"Transform SQL file is missing or empty: {sql_file}")
+        queries[name] = query
+    return queries
+
+
+def transform_output_path(final_parquet_file_path, name):
+    """
+    Derive the output path of a transform query from the trial inventory parquet path.
+
+    Args:
+        final_parquet_file_path (Path): The trial inventory parquet file.
+        name (str): Name of the transform query.
+
+    Returns:
+        Path: The same path with a ``_<name>`` suffix on the file name.
+    """
+    return final_parquet_file_path.parent / (
+        f"{final_parquet_file_path.stem}_{name}.parquet"
+    )
+
+
+def run_transform_sql(
+    transform_queries,
+    final_parquet_file_path,
+    parquet_compression,
+    history_path=None,
+    trial_code=None,
+):
+    """
+    Run post-processing queries over a trial's outputs with DuckDB.
+
+    The trial inventory, and the history when it was downloaded, are views
+    named ``inventory`` and ``history`` over their Parquet files, so DuckDB
+    reads just the columns and row groups a query needs, on all cores,
+    without a copy in pandas. Each result is written next to the inventory,
+    see :func:`transform_output_path`.
+
+    Args:
+        transform_queries (dict[str, str]): Queries by name, see
+            :func:`load_transform_queries`.
+        final_parquet_file_path (Path): The trial inventory parquet file.
+        parquet_compression (Optional[str]): Compression algo for the outputs.
+        history_path (Optional[Path]): The history parquet file, or incremental
+            history dataset directory.
+        trial_code (Optional[str]): Trial the outputs belong to, for phase timings.
+
+    Returns:
+        dict[str, int]: Number of rows each query wrote.
+    """
+    import duckdb
+
+    counts = {}
+    with duckdb.connect() as connection:
+        connection.read_parquet(str(final_parquet_file_path)).create_view("inventory")
+        history_files = []
+        if history_path is not None:
+            history_path = Path(history_path)
+            history_files = (
+                sorted(history_path.glob("part-*.parquet"))
+                if history_path.is_dir()
+                else [history_path]
+            )
+        if history_files:
+            connection.read_parquet(
+                [str(history_file) for history_file in history_files]
+            ).create_view("history")
+        for name, query in transform_queries.items():
+            output_file = transform_output_path(final_parquet_file_path, name)
+            temp_file = temp_file_path(output_file)
+            with timed_phase("transform_sql", trial_code) as phase:
+                try:
+                    connection.sql(query).write_parquet(
+                        str(temp_file),
+                        compression=parquet_compression or "uncompressed",
+                    )
+                    os.replace(temp_file, output_file)
+                finally:
+                    temp_file.unlink(missing_ok=True)
+                counts[name] = pq.read_metadata(output_file).num_rows
+                phase["rows"] = counts[name]
+                phase["bytes"] = output_file.stat().st_size
+            logger.info(
+                f"{counts[name]} {trial_code} {name} records saved to {output_file}."
+            )
+    return counts
+
+
+def load_location_queries(sql_file, query):
+    """
+    Load the queries that resolve storage locations locally.
+
+    The narrow trial inventory query and the locations query sit next to the
+    trial inventory query, like the history query. The narrow query selects
+    the same columns as ``query``, a column selection of it, except those
+    in LOCATION_COLUMNS, which are resolved from LOCATION_KEY_COLUMN.
+
+    Args:
+        sql_file (Union[str, Path]): Path to the trial inventory SQL file.
+        query (str): The trial inventory query, after any column selection.
+
+    Returns:
+        tuple[str, str, list[str]]: The narrow trial inventory query, the
+        locations query, and the columns of ``query`` in their order.
+
+    Raises:
+        ValueError: If either SQL file is missing or empty.
+    """
+    sql_dir = Path(sql_file).parent
+    narrow_query = parse_sql_file(sql_dir / "trial_inventory_narrow.sql")
+    locations_query = parse_sql_file(sql_dir / "locations.sql")
+    if not narrow_query or not locations_query:
+        raise ValueError(
+            f"--location_cache needs trial_inventory_narrow.sql and locations.sql in {sql_dir}"
+        )
+    column_order = [name for name, _ in select_items(query)]
+    narrow_columns = [name for name, _ in select_items(narrow_query)]
+    kept = [column for column in column_order if column in narrow_columns]
+    if set(narrow_columns) - set(kept) - {LOCATION_KEY_COLUMN}:
+        narrow_query = project_columns(narrow_query, kept + [LOCATION_KEY_COLUMN])
+    return narrow_query, locations_query, column_order
+
+
+def load_locations(
+    connection_url,
+    locations_query,
+    cache_dir,
+    cache_ttl=86_400,
+    cache_max_bytes=2**31,
+    refresh_cache=False,
+    schema=None,
+):
+    """
+    Fetch the locations dimension, going through the query cache.
+
+    The LOCATIONS table changes far less often than the inventory, so it is
+    cached for ``cache_ttl`` even without ``--cache``.
+
+    Args:
+        connection_url (Union[URL, Engine]): SQLAlchemy connection URL, or a shared engine.
+        locations_query (str): Locations SQL query text, see ``locations.sql``.
+        cache_dir (Path): Query cache directory.
+        cache_ttl (float): Seconds the cached locations stay valid.
+        cache_max_bytes (float): Size limit of the query cache.
+        refresh_cache (bool): Re-run the query and overwrite the cached result.
+        schema (Optional[dict[str, str]]): Trial inventory column types, applied
+            to the resolved location columns.
+
+    Returns:
+        pd.DataFrame: The dimension, see :func:`location_dimension`.
+    """
+    with timed_phase("locations"):
+        locations = cached_query_to_df(
+            connection_url,
+            locations_query,
+            cache_dir=cache_dir,
+            cache_ttl=cache_ttl,
+            cache_max_bytes=cache_max_bytes,
+            refresh_cache=refresh_cache,
+        )
+        dimension = location_dimension(locations, schema)
+    logger.info(f"Resolved the paths of {len(dimension)} locations.")
+    return dimension
+
+
+def location_dimension(locations, schema=None):
+    """
+    Resolve the location columns of every location, as if it held a vial.
+
+    Parents are followed with integer positions into the locations, one level
+    at a time for all of them at once. The columns follow the CASE expressions
+    of trial_inventory.sql: a location whose parent has a parent is a rack on
+    a shelf in a freezer, which sits in a room; otherwise its parent is the
+    freezer and it's the shelf. LOCATION_PATH joins the names of every
+    ancestor, however deep, with LOCATION_PATH_SEPARATOR.
+
+    Args:
+        locations (pd.DataFrame): Results of ``locations.sql``.
+        schema (Optional[dict[str, str]]): Column types, see :func:`apply_schema`.
+
+    Returns:
+        pd.DataFrame: LOCATION_COLUMNS and LOCATION_PATH, indexed by LOCATIONCODE.
+    """
+    locations = (
+        locations.dropna(subset=["LOCATIONCODE"])
+        .drop_duplicates("LOCATIONCODE")
+        .reset_index(drop=True)
+    )
+    codes = pd.Index(locations["LOCATIONCODE"])
+    # Position of each location's parent, or -1 at the top
+    parents = np.append(codes.get_indexer(locations["PARENT_LOCATION_CODE"]), -1)
+    rack = np.arange(len(locations))
+    shelf = parents[rack]
+    freezer = parents[shelf]
+    three_levels = freezer >= 0
+
+    def take(column, positions):
+        return pd.api.extensions.take(
+            locations[column].array, positions, allow_fill=True
+        )
+
+    columns = {
+        "FREEZER": take("LOCATION_NAME", np.where(three_levels, freezer, shelf)),
+        "SHELF": take("LOCATION_NAME", np.where(three_levels, shelf, rack)),
+        "RACK": take("LOCATION_NAME", np.where(three_levels, rack, -1)),
+        "RACK_CODE": take("LOCATIONCODE", rack),
+        "SHELF_SORT": take("SORTER", shelf),
+        "RACK_SORT": take("SORTER", rack),
+        "LONGNAME": take("LONGNAME", rack),
+        "LONGCODE": take("LONGCODE", rack),
+        "ROOM_NAME": take("ROOM_NAME", freezer),
+        "ROOM_CODE": take("ROOM_CODE", freezer),
+        "BUILDING_NAME": take("BUILDING_NAME", freezer),
+        "BUILDING_CODE": take("BUILDING_CODE", freezer),
+    }
+    names = locations["LOCATION_NAME"].fillna("").to_numpy(dtype=object)
+    path = names.copy()
+    ancestor = shelf.copy()
+    # A cycle in the parents would never reach the top, so stop after every level
+    for _ in range(len(locations)):
+        below = ancestor >= 0
+        if not below.any():
+            break
+        # Unnamed locations are left out of the path
+        above, rest = names[ancestor[below]], path[below]
+        path[below] = np.where(
+            above == "",
+            rest,
+            np.where(rest == "", above, above + LOCATION_PATH_SEPARATOR + rest),
+        )
+        ancestor[below] = parents[ancestor[below]]
+    columns["LOCATION_PATH"] = pd.array(np.where(path == "", None, path), dtype="str")
+    dimension = pd.DataFrame(columns, index=codes)
+    return apply_schema(dimension, schema) if schema else dimension
+
+
+def resolve_locations(df, locations, column_order=None):
+    """
+    Add the location columns of each vial from the locations dimension.
+
+    A vectorized lookup of LOCATION_KEY_COLUMN replaces the LOCATIONS joins
+    of the trial inventory query. Vials whose location isn't in the dimension
+    get NULLs, as with the joins.
+
+    Args:
+        df (pd.DataFrame): Trial inventory rows with LOCATION_KEY_COLUMN.
+        locations (pd.DataFrame): Dimension from :func:`location_dimension`.
+        column_order (Optional[list[str]]): Columns of the full trial inventory
+            query, whose order is restored; only its location columns are
+            added. LOCATION_PATH comes after them.
+
+    Returns:
+        pd.DataFrame: The rows with the location columns and LOCATION_PATH.
+    """
+    keys = df[LOCATION_KEY_COLUMN].astype(object)
+    columns = [
+        column
+        for column in locations.columns
+        if column_order is None or column in column_order or column == "LOCATION_PATH"
+    ]
+    resolved = locations[columns].reindex(pd.Index(keys))
+    resolved.index = df.index
+    df = df.drop(columns=LOCATION_KEY_COLUMN).join(resolved)
+    if column_order is not None:
+        ordered = [column for column in column_order if column in df.columns]
+        df = df[ordered + [column for column in df.columns if column not in ordered]]
+    return df
+
+
+def load_history_query(sql_file):
+    """
+    Load the inventory history query that sits next to the trial inventory query.
+
+    Args:
+        sql_file (Union[str, Path]): Path to the trial inventory SQL file.
+
+    Returns:
+        Optional[str]: The history SQL query text, or None if it is unavailable.
+    """
+    history_sql_file = Path(sql_file).parent / "inventory_history.sql"
+    if not history_sql_file.exists():
+        logger.warning(f"History SQL file not found: {history_sql_file}")
+        return None
+    history_query = parse_sql_file(history_sql_file)
+    if not history_query:
+        logger.warning("History query was empty.")
+    return history_query
+
+
+def history_parquet_path(final_parquet_file_path):
+    """
+    Derive the history parquet path from the trial inventory parquet path.
+
+    Args:
+        final_parquet_file_path (Path): The trial inventory parquet file.
+
+    Returns:
+        Path: The same path with a '_history' suffix on the file name.
+    """
+    return final_parquet_file_path.parent / (
+        final_parquet_file_path.stem + "_history.parquet"
+    )
+
+
+def inventory_watermark(final_parquet_file_path):
+    """
+    Find the newest current transaction in an existing trial inventory snapshot.
+
+    Args:
+        final_parquet_file_path (Path): The trial inventory parquet file.
+
+    Returns:
+        Optional[int]: The highest ``CURRENT_TRANSACTION_ID``, or None if there is
+        no usable snapshot.
+    """
+    if not Path(final_parquet_file_path).exists():
+        return None
+    schema = pq.read_schema(final_parquet_file_path)
+    if INVENTORY_CHANGE_COLUMN not in schema.names:
+        logger.info(
+            f"{final_parquet_file_path} has no {INVENTORY_CHANGE_COLUMN} column; doing a full download."
+        )
+        return None
+    changes = pq.read_table(final_parquet_file_path, columns=[INVENTORY_CHANGE_COLUMN])
+    watermark = pc.max(changes.column(0)).as_py()
+    return None if watermark is None else int(watermark)
+
+
+def merge_inventory(previous, changed):
+    """
+    Upsert changed trial inventory rows into a previous snapshot by vial.
+
+    Rows of ``previous`` whose ``VIAL_CONTAINER_INV_ID`` appears in ``changed``
+    are replaced; vials that weren't in the snapshot are added at the end.
+
+    Args:
+        previous (pd.DataFrame): The previous snapshot.
+        changed (pd.DataFrame): Rows whose current transaction changed.
+
+    Returns:
+        tuple[pd.DataFrame, int]: The merged snapshot and the number of changed
+        rows that replaced existing vials.
+    """
+    replaced = previous[INVENTORY_KEY_COLUMN].isin(changed[INVENTORY_KEY_COLUMN])
+    merged = pd.concat([previous[~replaced], changed], ignore_index=True)
+    return merged, int(replaced.sum())
+
+
+def write_parquet_atomic(df, parquet_file_path, compression):
+    """
+    Write a DataFrame to parquet via a temporary file, then swap it into place.
+
+    Readers of ``parquet_file_path`` never see a partially written file, and
+    the previous file survives if the write fails.
+
+    Args:
+        df (pd.DataFrame): Data to write.
+        parquet_file_path (Path): Destination parquet file.
+        compression (str): Parquet compression codec.
+    """
+    temp_file = temp_file_path(Path(parquet_file_path))
+    try:
+        df.to_parquet(temp_file, compression=compression)
+        os.replace(temp_file, parquet_file_path)
+    finally:
+        temp_file.unlink(missing_ok=True)
+
+
+def download_inventory_parquet(
+    engine,
+    query,
+    trial_code,
+    final_parquet_file_path,
+    no_viable,
+    exclude_conditions,
+    exclude_matcodes,
+    parquet_compression,
+    stream=False,
+    chunk_size=50_000,
+    fetch_engine="pandas",
+    stream_results=False,
+    arraysize=10_000,
+    cache_dir=None,
+    cache_ttl=86_400,
+    cache_max_bytes=2**31,
+    refresh_cache=False,
+    incremental=False,
+    full_refresh=False,
+    partitions=1,
+    partition_key="INV.INVENTORYID",
+    partition_probe="minmax",
+    params=None,
+    schema=None,
+    dictionary_threshold=0,
+    record_dir=None,
+    comment_fields=None,
+    viability_rules=None,
+    dtype_backend=None,
+    transform_engine="pandas",
+    locations=None,
+    column_order=None,
+):
+    """
+    Fetch, transform and save the trial inventory.
+
+    Args:
+        engine (Engine): Shared SQLAlchemy engine.
+        query (str): Trial inventory SQL query text.
+        trial_code (str): Filter parameter for the query.
+        final_parquet_file_path (Path): Destination parquet file.
+        no_viable (bool): Flag to skip viability processing.
+        exclude_conditions (list[str]): Viability filters.
+        exclude_matcodes (list[str]): Matcode filters.
+        parquet_compression (str): Compression algo for the output file.
+        stream (bool): Stream the trial inventory to parquet in chunks.
+        chunk_size (int): Rows per chunk when streaming.
+        fetch_engine (str): ``"pandas"`` or ``"arrow"`` row conversion.
+        stream_results (bool): Fetch incrementally and log fetch latency and throughput.
+        arraysize (int): Rows per fetch with ``stream_results``.
+        cache_dir (Optional[Path]): Query cache directory, or None to disable caching.
+        cache_ttl (float): Seconds a cached query result stays valid.
+        cache_max_bytes (float): Size limit of the query cache.
+        refresh_cache (bool): Re-run queries and overwrite their cached results.
+        incremental (bool): Only fetch vials whose current transaction is newer
+            than the existing snapshot and merge them into it. Vials that leave
+            the trial, and edits that don't create a transaction, are only
+            picked up by a full download.
+        full_refresh (bool): Ignore the existing snapshot and download everything.
+        partitions (int): Fetch the inventory as this many key ranges in parallel.
+            Not used when streaming.
+        partition_key (str): SQL expression the key ranges split on.
+        partition_probe (str): ``"minmax"`` or ``"quantile"`` range boundaries.
+        params (Optional[dict]): Additional bound parameters for the query.
+        schema (Optional[dict[str, str]]): Compact column types applied at fetch
+            time, see :func:`apply_schema`.
+        dictionary_threshold (float): Dictionary encode string columns with at
+            most this ratio of distinct values to rows, see :func:`dictionary_encode`.
+        record_dir (Optional[Path]): Record the raw query results here, see
+            :func:`write_recording`. Streamed inventories aren't recorded.
+        comment_fields (Optional[dict[str, dict]]): Fields parsed out of
+            COMMENTS, see :func:`extract_sampleid`.
+        viability_rules (Optional[list[dict]]): Rules for :func:`flag_viable`.
+        dtype_backend (Optional[str]): ``"numpy"`` or ``"pyarrow"`` dtypes, see
+            :func:`query_to_df`.
+        transform_engine (str): ``"pandas"``, or ``"polars"`` to transform and
+            write the inventory with :func:`polars_inventory_to_parquet`. Not
+            used when streaming or merging changes.
+        locations (Optional[pd.DataFrame]): Locations dimension for a query
+            without the location joins, see :func:`resolve_locations`.
+        column_order (Optional[list[str]]): Column order restored by
+            :func:`resolve_locations`.
+
+    Returns:
+        int: Number of records saved.
+    """
+    partition_kwargs = {
+        "partitions": partitions,
+        "partition_key": partition_key,
+        "partition_probe": partition_probe,
+    }
+    transform = partial(
+        transform_inventory,
+        no_viable=no_viable,
+        exclude_conditions=exclude_conditions,
+        exclude_matcodes=exclude_matcodes,
+        trial_code=trial_code,
+        comment_fields=comment_fields,
+        viability_rules=viability_rules,
+        locations=locations,
+        column_order=column_order,
+    )
+    watermark = None
+    if incremental and not full_refresh:
+        watermark = inventory_watermark(final_parquet_file_path)
+    if transform_engine == "polars" and (stream or watermark is not None):
+        logger.info(
+            "The polars engine isn't used for streamed or incremental trial inventories."
+        )
+    if stream and watermark is not None:
+        logger.warning(
+            "Incremental trial inventories are merged in memory; --stream is ignored."
+        )
+    if watermark is not None:
+        change_expression = select_expressions(query).get(
+            INVENTORY_CHANGE_COLUMN, INVENTORY_CHANGE_COLUMN
+        )
+        changed = cached_query_to_df(
+            engine,
+            add_where_condition(query, f"{change_expression} > :since_transaction_id"),
+            trial_code=trial_code,
+            cache_dir=cache_dir,
+            cache_ttl=cache_ttl,
+            cache_max_bytes=cache_max_bytes,
+            refresh_cache=refresh_cache,
+            fetch_engine=fetch_engine,
+            stream_results=stream_results,
+            arraysize=arraysize,
+            params={**(params or {}), "since_transaction_id": watermark},
+            schema=schema,
+            dictionary_threshold=dictionary_threshold,
+            record_dir=record_dir,
+            dtype_backend=dtype_backend,
+            **partition_kwargs,
+        )
+        changed = transform(changed)
+        previous = pd.read_parquet(final_parquet_file_path)
+        trial_inventory, updated_count = merge_inventory(previous, changed)
+        # Categories of the snapshot and the changes differ, so encode again
+        if schema:
+            trial_inventory = apply_schema(trial_inventory, schema)
+        trial_inventory = dictionary_encode(trial_inventory, dictionary_threshold)
+        with timed_phase("to_parquet", trial_code) as phase:
+            write_parquet_atomic(
+                trial_inventory, final_parquet_file_path, parquet_compression
+            )
+            phase["rows"] = len(trial_inventory)
+            phase["bytes"] = final_parquet_file_path.stat().st_size
+        record_count = len(trial_inventory)
+        logger.info(
+            f"Merged {len(changed)} changed {trial_code} records ({updated_count} updated, "
+            f"{len(changed) - updated_count} new) after {INVENTORY_CHANGE_COLUMN} {watermark}."
+        )
+    elif stream:
+        if partitions > 1:
+            logger.info(
+                "Partitioned fetching isn't used for streamed trial inventories."
+            )
+        if record_dir is not None:
+            logger.info("Streamed trial inventories aren't recorded.")
+        record_count = query_to_parquet(
+            engine,
+            query,
+            final_parquet_file_path,
+            trial_code=trial_code,
+            chunk_size=chunk_size,
+            compression=parquet_compression,
+            transform=transform,
+            fetch_engine=fetch_engine,
+            stream_results=stream_results,
+            arraysize=arraysize if stream_results else None,
+            params=params,
+            schema=schema,
+            dictionary_threshold=dictionary_threshold,
+            dtype_backend=dtype_backend,
+        )
+    else:
+        trial_inventory = cached_query_to_df(
+            engine,
+            query,
+            trial_code=trial_code,
+            cache_dir=cache_dir,
+            cache_ttl=cache_ttl,
+            cache_max_bytes=cache_max_bytes,
+            refresh_cache=refresh_cache,
+            fetch_engine=fetch_engine,
+            stream_results=stream_results,
+            arraysize=arraysize,
+            params=params,
+            schema=schema,
+            dictionary_threshold=dictionary_threshold,
+            record_dir=record_dir,
+            dtype_backend=dtype_backend,
+            **partition_kwargs,
+        )
+        if transform_engine == "polars":
+            if locations is not None:
+                with timed_phase("resolve_locations", trial_code) as phase:
+                    trial_inventory = resolve_locations(
+                        trial_inventory, locations, column_order
+                    )
+                    phase["rows"] = len(trial_inventory)
+            with timed_phase("polars_to_parquet", trial_code) as phase:
+                polars_inventory_to_parquet(
+                    trial_inventory,
+                    final_parquet_file_path,
+                    parquet_compression,
+                    no_viable,
+                    exclude_conditions,
+                    exclude_matcodes,
+                    comment_fields=comment_fields,
+                    viability_rules=viability_rules,
+                )
+                phase["rows"] = len(trial_inventory)
+                phase["bytes"] = final_parquet_file_path.stat().st_size
+        else:
+            trial_inventory = transform(trial_inventory)
+            with timed_phase("to_parquet", trial_code) as phase:
+                trial_inventory.to_parquet(
+                    final_parquet_file_path, compression=parquet_compression
+                )
+                phase["rows"] = len(trial_inventory)
+                phase["bytes"] = final_parquet_file_path.stat().st_size
+        record_count = len(trial_inventory)
+    logging.info(
+        f"{record_count} {trial_code} records saved to {final_parquet_file_path.absolute()} with {parquet_compression} compression."
+    )
+    return record_count
+
+
+def download_history_parquet(
+    engine,
+    history_query,
+    trial_code,
+    history_parquet_file_path,
+    parquet_compression,
+    fetch_engine="pandas",
+    stream_results=False,
+    arraysize=10_000,
+    cache_dir=None,
+    cache_ttl=86_400,
+    cache_max_bytes=2**31,
+    refresh_cache=False,
+    schema=None,
+    dictionary_threshold=0,
+    record_dir=None,
+    dtype_backend=None,
+):
+    """
+    Fetch and save the inventory history for a trial.
+
+    Args:
+        engine (Engine): Shared SQLAlchemy engine.
+        history_query (str): Inventory history SQL query text.
+        trial_code (str): Filter parameter for the query.
+        history_parquet_file_path (Path): Destination parquet file.
+        parquet_compression (str): Compression algo for the output file.
+        fetch_engine (str): ``"pandas"`` or ``"arrow"`` row conversion.
+        stream_results (bool): Fetch incrementally and log fetch latency and throughput.
+        arraysize (int): Rows per fetch with ``stream_results``.
+        cache_dir (Optional[Path]): Query cache directory, or None to disable caching.
+        cache_ttl (float): Seconds a cached query result stays valid.
+        cache_max_bytes (float): Size limit of the query cache.
+        refresh_cache (bool): Re-run queries and overwrite their cached results.
+        schema (Optional[dict[str, str]]): Compact column types applied at fetch
+            time, see :func:`apply_schema`.
+        dictionary_threshold (float): Dictionary encode string columns with at
+            most this ratio of distinct values to rows, see :func:`dictionary_encode`.
+        record_dir (Optional[Path]): Record the raw query results here, see
+            :func:`write_recording`.
+        dtype_backend (Optional[str]): ``"numpy"`` or ``"pyarrow"`` dtypes, see
+            :func:`query_to_df`.
+
+    Returns:
+        int: Number of history records saved.
+    """
+    history_df = cached_query_to_df(
+        engine,
+        history_query,
+        trial_code=trial_code,
+        cache_dir=cache_dir,
+        cache_ttl=cache_ttl,
+        cache_max_bytes=cache_max_bytes,
+        refresh_cache=refresh_cache,
+        fetch_engine=fetch_engine,
+        stream_results=stream_results,
+        arraysize=arraysize,
+        schema=schema,
+        dictionary_threshold=dictionary_threshold,
+        record_dir=record_dir,
+        dtype_backend=dtype_backend,
+    )
+    with timed_phase("history_to_parquet", trial_code) as phase:
+        history_df.to_parquet(
+            history_parquet_file_path, compression=parquet_compression
+        )
+        phase["rows"] = len(history_df)
+        phase["bytes"] = history_parquet_file_path.stat().st_size
+    logging.info(
+        f"{len(history_df)} history records for {trial_code} saved to {history_parquet_file_path.absolute()}."
+    )
+    return len(history_df)
+
+
+def history_dataset_path(final_parquet_file_path):
+    """
+    Derive the incremental history dataset directory from the trial inventory parquet path.
+
+    Args:
+        final_parquet_file_path (Path): The trial inventory parquet file.
+
+    Returns:
+        Path: A directory next to it with a '_history' suffix.
+    """
+    return final_parquet_file_path.parent / (final_parquet_file_path.stem + "_history")
+
+
+def read_history_watermark(dataset_dir):
+    """
+    Read the highest transaction already downloaded into a history dataset.
+
+    Args:
+        dataset_dir (Path): The history dataset directory.
+
+    Returns:
+        Optional[dict]: The stored watermark, or None if there isn't one.
+    """
+    watermark_file = Path(dataset_dir) / HISTORY_WATERMARK_FILE
+    if not watermark_file.exists():
+        return None
+    with open(watermark_file, "r") as file:
+        watermark = json.load(file)
+    # A watermark without a transaction, left by an empty first run, means
+    # nothing has been downloaded yet
+    if watermark.get("transaction_id") is None:
+        return None
+    return watermark
+
+
+def write_history_watermark(dataset_dir, watermark):
+    """
+    Store the highest transaction downloaded into a history dataset.
+
+    Args:
+        dataset_dir (Path): The history dataset directory.
+        watermark (dict): The watermark to store.
+    """
+    watermark_file = Path(dataset_dir) / HISTORY_WATERMARK_FILE
+    temp_file = temp_file_path(watermark_file)
+    with open(temp_file, "w") as file:
+        json.dump(watermark, file, indent=2, default=str)
+    os.replace(temp_file, watermark_file)
+
+
+def download_history_increment(
+    engine,
+    history_query,
+    trial_code,
+    dataset_dir,
+    parquet_compression,
+    full_refresh=False,
+    **kwargs,
+):
+    """
+    Download history transactions newer than the stored watermark into a dataset.
+
+    New transactions are appended to ``dataset_dir`` as a new parquet part file
+    and the highest ``TRANSACTION_ID`` and ``TRANSACTION_DT`` seen are stored in
+    a sidecar ``_watermark.json``. The first run, or a ``full_refresh``, replaces
+    the dataset with the complete history. Read the dataset back with
+    ``pd.read_parquet(dataset_dir)``.
+
+    Args:
+        engine (Engine): Shared SQLAlchemy engine.
+        history_query (str): Inventory history SQL query text.
+        trial_code (str): Filter parameter for the query.
+        dataset_dir (Path): History dataset directory.
+        parquet_compression (str): Compression algo for the output files.
+        full_refresh (bool): Ignore the watermark and re-download everything.
+        **kwargs: Passed through to :func:`cached_query_to_df`.
+
+    Returns:
+        int: Number of new history records saved.
+    """
+    dataset_dir = Path(dataset_dir)
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+    watermark = None if full_refresh else read_history_watermark(dataset_dir)
+    if watermark is None:
+        logger.info(f"Downloading full history for {trial_code} into {dataset_dir}")
+        for part_file in dataset_dir.glob("part-*.parquet"):
+            part_file.unlink()
+        (dataset_dir / HISTORY_WATERMARK_FILE).unlink(missing_ok=True)
+        params = {}
+    else:
+        logger.info(
+            f"Downloading {trial_code} history after {HISTORY_WATERMARK_COLUMN} "
+            f"{watermark['transaction_id']} ({watermark.get('transaction_dt')})"
+        )
+        history_query = add_where_condition(
+            history_query, f"{HISTORY_WATERMARK_EXPRESSION} > :since_transaction_id"
+        )
+        params = {"since_transaction_id": watermark["transaction_id"]}
+    history_df = cached_query_to_df(
+        engine, history_query, trial_code=trial_code, params=params, **kwargs
+    )
+    if history_df.empty and watermark is not None:
+        logger.info(f"No new history records for {trial_code}.")
+        return 0
+
+    table = pa.Table.from_pandas(history_df, preserve_index=False)
+    existing_parts = sorted(dataset_dir.glob("part-*.parquet"))
+    # Keep every part on the schema of the first, so the dataset reads as one table
+    schema = (
+        pq.read_schema(existing_parts[0]) if existing_parts else parquet_schema(table)
+    )
+    part_file = dataset_dir / f"part-{datetime.datetime.now():%Y%m%dT%H%M%S%f}.parquet"
+    with timed_phase("history_to_parquet", trial_code) as phase:
+        pq.write_table(table.cast(schema), part_file, compression=parquet_compression)
+        phase["rows"] = len(history_df)
+        phase["bytes"] = part_file.stat().st_size
+
+    new_watermark = {
+        "transaction_id": None if watermark is None else watermark["transaction_id"],
+        "transaction_dt": None if watermark is None else watermark["transaction_dt"],
+        "updated": datetime.datetime.now().isoformat(),
+    }
+    if not history_df.empty:
+        new_watermark["transaction_id"] = int(
+            history_df[HISTORY_WATERMARK_COLUMN].max()
+        )
+        if "TRANSACTION_DT" in history_df:
+            new_watermark["transaction_dt"] = str(history_df["TRANSACTION_DT"].max())
+    # With no history yet there's nothing to watermark, so the next run
+    # downloads everything again
+    if new_watermark["transaction_id"] is not None:
+        write_history_watermark(dataset_dir, new_watermark)
+    logging.info(
+        f"{len(history_df)} history records for {trial_code} saved to {part_file.absolute()}."
+    )
+    return len(history_df)
+
+
+def process_trial(
+    engine,
+    query,
+    trial_code,
+    sql_file,
+    output_dir,
+    add_trial_to_path,
+    include_dsn_in_filename,
+    no_viable,
+    exclude_conditions,
+    exclude_matcodes,
+    parquet_compression,
+    download_history=False,
+    stream=False,
+    chunk_size=50_000,
+    fetch_engine="pandas",
+    stream_results=False,
+    arraysize=10_000,
+    cache_dir=None,
+    cache_ttl=86_400,
+    cache_max_bytes=2**31,
+    refresh_cache=False,
+    incremental_history=False,
+    full_refresh=False,
+    incremental=False,
+    partitions=1,
+    partition_key="INV.INVENTORYID",
+    partition_probe="minmax",
+    params=None,
+    schema=None,
+    dictionary_threshold=0,
+    record_dir=None,
+    comment_fields=None,
+    viability_rules=None,
+    dtype_backend=None,
+    transform_engine="pandas",
+    transform_queries=None,
+    locations=None,
+    column_order=None,
+):
+    """
+    Run the extract, transform and save pipeline for a single trial.
+
+    Args:
+        engine (Engine): Shared SQLAlchemy engine.
+        query (str): Trial inventory SQL query text.
+        trial_code (str): Filter parameter for the query.
+        sql_file (str): Path to the source SQL file; the history query is looked
+            up next to it.
+        output_dir (str): Destination directory for parquet output.
+        add_trial_to_path (bool): Nested directory flag.
+        include_dsn_in_filename (bool): Filename suffix flag.
+        no_viable (bool): Flag to skip viability processing.
+        exclude_conditions (list[str]): Viability filters.
+        exclude_matcodes (list[str]): Matcode filters.
+        parquet_compression (str): Compression algo for the output file.
+        download_history (bool): Also download the inventory history.
+        stream (bool): Stream the trial inventory to parquet in chunks.
+        chunk_size (int): Rows per chunk when streaming.
+        fetch_engine (str): ``"pandas"`` or ``"arrow"`` row conversion.
+        stream_results (bool): Fetch incrementally and log fetch latency and throughput.
+        arraysize (int): Rows per fetch with ``stream_results``.
+        cache_dir (Optional[Path]): Query cache directory, or None to disable caching.
+        cache_ttl (float): Seconds a cached query result stays valid.
+        cache_max_bytes (float): Size limit of the query cache.
+        refresh_cache (bool): Re-run queries and overwrite their cached results.
+        incremental (bool): Merge only changed vials into the existing trial
+            inventory parquet, see :func:`download_inventory_parquet`.
+        incremental_history (bool): Append only new history transactions to a
+            history dataset, see :func:`download_history_increment`.
+        full_refresh (bool): Ignore stored watermarks and re-download everything.
+        transform_engine (str): ``"pandas"`` or ``"polars"`` inventory
+            transforms, see :func:`download_inventory_parquet`.
+        transform_queries (Optional[dict[str, str]]): Post-processing queries
+            run once the downloads finish, see :func:`run_transform_sql`.
+        locations (Optional[pd.DataFrame]): Locations dimension for a query
+            without the location joins, see :func:`resolve_locations`.
+        column_order (Optional[list[str]]): Column order restored by
+            :func:`resolve_locations`.
+
+    Returns:
+        dict: Summary of the run with the trial code, status, record counts,
+        elapsed seconds and output path.
+    """
+    logger.info(f"Processing trial inventory for {trial_code}...")
+    start = time.perf_counter()
+    final_parquet_file_path = parquet_path(
+        trial_code=trial_code,
+        output_dir=output_dir,
+        include_dsn_in_filename=include_dsn_in_filename,
+        add_trial_to_path=add_trial_to_path,
+    )
+    query_kwargs = {
+        "fetch_engine": fetch_engine,
+        "stream_results": stream_results,
+        "arraysize": arraysize,
+        "cache_dir": cache_dir,
+        "cache_ttl": cache_ttl,
+        "cache_max_bytes": cache_max_bytes,
+        "refresh_cache": refresh_cache,
+        "dictionary_threshold": dictionary_threshold,
+        "record_dir": record_dir,
+        "dtype_backend": dtype_backend,
+    }
+    history_query = load_history_query(sql_file) if download_history else None
+    history_schema = (
+        load_schema(Path(sql_file).parent / "inventory_history.sql")
+        if download_history and schema is not None
+        else None
+    )
+    with ThreadPoolExecutor(max_workers=1) as history_pool:
+        # The history query doesn't depend on the inventory, so download it on a
+        # second pooled connection while the inventory is fetched and written
+        history_future = None
+        if history_query and incremental_history:
+            history_future = history_pool.submit(
+                timed,
+                "history",
+                trial_code,
+                download_history_increment,
+                engine,
+                history_query,
+                trial_code,
+                history_dataset_path(final_parquet_file_path),
+                parquet_compression=parquet_compression,
+                full_refresh=full_refresh,
+                schema=history_schema,
+                **query_kwargs,
+            )
+        elif history_query:
+            logger.info(f"Downloading history for {trial_code}...")
+            history_future = history_pool.submit(
+                timed,
+                "history",
+                trial_code,
+                download_history_parquet,
+                engine,
+                history_query,
+                trial_code,
+                history_parquet_path(final_parquet_file_path),
+                parquet_compression=parquet_compression,
+                schema=history_schema,
+                **query_kwargs,
+            )
+        record_count, inventory_seconds = timed(
+            "inventory",
+            trial_code,
+            download_inventory_parquet,
+            engine,
+            query,
+            trial_code,
+            final_parquet_file_path,
+            no_viable=no_viable,
+            exclude_conditions=exclude_conditions,
+            exclude_matcodes=exclude_matcodes,
+            parquet_compression=parquet_compression,
+            stream=stream,
+            chunk_size=chunk_size,
+            incremental=incremental,
+            full_refresh=full_refresh,
+            partitions=partitions,
+            partition_key=partition_key,
+            partition_probe=partition_probe,
+            params=params,
+            schema=schema,
+            comment_fields=comment_fields,
+            viability_rules=viability_rules,
+            transform_engine=transform_engine,
+            locations=locations,
+            column_order=column_order,
+            **query_kwargs,
+        )
+        history_count = None
+        if history_future is not None:
+            history_count, history_seconds = history_future.result()
+            elapsed = time.perf_counter() - start
+            logger.info(
+                f"Downloaded {trial_code} inventory ({inventory_seconds:.2f}s) and history "
+                f"({history_seconds:.2f}s) concurrently in {elapsed:.2f}s, saving "
+                f"{inventory_seconds + history_seconds - elapsed:.2f}s."
+            )
+    if transform_queries:
+        history_path = None
+        if history_count is not None:
+            history_path = (
+                history_dataset_path(final_parquet_file_path)
+                if incremental_history
+                else history_parquet_path(final_parquet_file_path)
+            )
+        run_transform_sql(
+            transform_queries,
+            final_parquet_file_path,
+            parquet_compression,
+            history_path=history_path,
+            trial_code=trial_code,
+        )
+    return {
+        "trial_code": trial_code,
+        "status": "ok",
+        "records": record_count,
+        "history_records": history_count,
+        "seconds": round(time.perf_counter() - start, 2),
+        "path": str(final_parquet_file_path),
+    }
+
+
+def read_trial_codes_file(trial_codes_file):
+    """
+    Read trial codes from a text file, one per line.
+
+    Blank lines and lines starting with ``#`` are ignored.
+
+    Args:
+        trial_codes_file (Union[str, Path]): Path to the file.
+
+    Returns:
+        list[str]: The trial codes in file order.
+    """
+    with open(trial_codes_file, "r") as file:
+        lines = (line.strip() for line in file)
+        return [line for line in lines if line and not line.startswith("#")]
+
+
+def log_trial_summary(trial_summaries, trial_codes):
+    """
+    Log a table of per-trial results for a multi-trial run.
+
+    Args:
+        trial_summaries (list[dict]): Results returned by :func:`process_trial`.
+        trial_codes (list[str]): Trial codes in the order they were requested.
+    """
+    summary = pd.DataFrame(trial_summaries).set_index("trial_code").reindex(trial_codes)
+    logger.info(f"Processed {len(trial_codes)} trials:\n{summary.to_string()}")
+
+
+def main(
+    db_host,
+    db_name,
+    db_port,
+    db_user,
+    db_password,
+    sql_file,
+    trial_code,
+    output_dir,
+    add_trial_to_path,
+    include_dsn_in_filename,
+    no_viable,
+    exclude_conditions,
+    exclude_matcodes,
+    parquet_compression,
+    db_driver,
+    debug=False,
+    download_history=False,
+    stream=False,
+    chunk_size=50_000,
+    fetch_engine="pandas",
+    stream_results=False,
+    arraysize=10_000,
+    pool_size=5,
+    pool_pre_ping=True,
+    pool_recycle=3600,
+    trial_codes=None,
+    trial_codes_file=None,
+    workers=4,
+    cache=False,
+    refresh_cache=False,
+    cache_ttl=24.0,
+    cache_max_mb=2048.0,
+    incremental_history=False,
+    full_refresh=False,
+    incremental=False,
+    partitions=1,
+    partition_key="INV.INVENTORYID",
+    partition_probe="minmax",
+    columns=None,
+    column_profile=None,
+    viable_only=False,
+    use_schema=True,
+    dictionary_threshold=0.05,
+    report=False,
+    profile=False,
+    profile_top=25,
+    record_dir=None,
+    comment_keys=None,
+    viability_rules_file=None,
+    dtype_backend=None,
+    transform_engine="pandas",
+    transform_sql=None,
+    location_cache=False,
+    location_cache_ttl=24.0,
+):
+    """
+    Main orchestration function for the Sparqy data extraction process.
+
+    This function sets up logging, parses the SQL query, connects to the database,
+    fetches data, flags viability, and saves the final result to Parquet. Several
+    trials can be processed in one run; they share the connection pool and run
+    on a bounded pool of worker threads.
+
+    Args:
+        db_host (str): Database server address.
+        db_name (str): SQL database name.
+        db_port (int): Server port.
+        db_user (Optional[str]): Database username.
+        db_password (Optional[str]): Database password.
+        sql_file (str): Path to the source SQL file.
+        trial_code (Optional[str]): Filter parameter for the query.
+        output_dir (str): Destination directory for parquet output.
+        add_trial_to_path (bool): Nested directory flag.
+        include_dsn_in_filename (bool): Filename suffix flag.
+        no_viable (bool): Flag to skip viability processing.
+        exclude_conditions (list[str]): Viability filters.
+        exclude_matcodes (list[str]): Matcode filters.
+        parquet_compression (str): Compression algo for the output file.
+        db_driver (str): Name of the ODBC driver to use.
+        debug (bool): Enable verbose logging.
+        download_history (bool): Also download the inventory history.
+        stream (bool): Stream the trial inventory to parquet in chunks.
+        chunk_size (int): Rows per chunk when streaming.
+        fetch_engine (str): ``"pandas"`` or ``"arrow"`` row conversion.
+        stream_results (bool): Fetch incrementally and log fetch latency and throughput.
+        arraysize (int): Rows per fetch with ``stream_results``.
+        pool_size (int): Connections kept open in the shared pool.
+        pool_pre_ping (bool): Test pooled connections before use.
+        pool_recycle (int): Seconds before pooled connections are replaced.
+        trial_codes (Optional[list[str]]): Additional trial codes to process.
+        trial_codes_file (Optional[str]): File listing trial codes, one per line.
+        workers (int): Number of trials processed concurrently.
+        cache (bool): Cache query results under ``output_dir`` and reuse them.
+        refresh_cache (bool): Re-run queries and overwrite their cached results.
+        cache_ttl (float): Hours a cached query result stays valid.
+        cache_max_mb (float): Size limit of the query cache in megabytes.
+        incremental (bool): Merge only changed vials into the existing trial inventory.
+        incremental_history (bool): Download only new history transactions.
+        full_refresh (bool): Ignore stored watermarks and re-download everything.
+        partitions (int): Key ranges each trial inventory is fetched as in parallel.
+        partition_key (str): SQL expression the key ranges split on.
+        partition_probe (str): ``"minmax"`` or ``"quantile"`` range boundaries.
+        columns (Optional[list[str]]): Trial inventory columns to select.
+        column_profile (Optional[str]): Name of a column set in COLUMN_PROFILES.
+        viable_only (bool): Only download viable specimens, filtering in SQL.
+        use_schema (bool): Apply the compact column types of the schema
+            manifests next to the SQL files.
+        dictionary_threshold (float): Dictionary encode string columns with at
+            most this ratio of distinct values to rows; 0 disables.
+        report (bool): Log a table of the phase timings at the end of the run.
+        profile (bool): Profile the run with cProfile and tracemalloc, see
+            :func:`write_profile`.
+        profile_top (int): Number of functions and allocation sites to report.
+        record_dir (Optional[str]): Record the raw query results to this
+            directory for offline replay, see :func:`write_recording`.
+        comment_keys (Optional[list[str]]): Extra ``KEY:value`` fields to parse
+            out of COMMENTS into columns, see :func:`comment_fields`.
+        viability_rules_file (Optional[str]): TOML file of viability rules;
+            defaults to VIABILITY_RULES_FILE.
+        dtype_backend (Optional[str]): ``"numpy"`` or ``"pyarrow"`` dtypes from
+            fetch to Parquet; defaults to the fetch engine's, see :func:`query_to_df`.
+        transform_engine (str): ``"pandas"``, or ``"polars"`` to run the inventory
+            transforms as a Polars lazy query, see :func:`polars_transform_inventory`.
+        transform_sql (Optional[list[str]]): DuckDB SQL files run over each
+            trial's outputs, each saved as another Parquet file, see
+            :func:`run_transform_sql`.
+        location_cache (bool): Fetch trial_inventory_narrow.sql, without the
+            location joins, and resolve the locations from a cached locations
+            dimension, see :func:`load_location_queries`.
+        location_cache_ttl (float): Hours the cached locations stay valid.
+    """
+    basicConfig(level=INFO if not debug else DEBUG)
+    codes = [trial_code] if trial_code else []
+    codes += list(trial_codes or [])
+    if trial_codes_file:
+        codes += read_trial_codes_file(trial_codes_file)
+    # Drop duplicates but keep the requested order
+    codes = list(dict.fromkeys(codes))
+    if not codes:
+        logger.error("No trial code provided.")
+        return
+    started = datetime.datetime.now()
+    PHASE_TIMINGS.clear()
+    profiler = None
+    if profile:
+        ALLOCATION_SNAPSHOT.update(traced_bytes=0, phase=None, snapshot=None)
+        tracemalloc.start()
+        profiler = cProfile.Profile()
+        profiler.enable()
+    engine = None
+    try:
+        query = parse_sql_file(sql_file)
+        if not query:
+            logger.error("Failed to parse SQL file.")
+            return
+        fields = comment_fields(comment_keys)
+        rules = load_viability_rules(viability_rules_file)
+        transform_queries = load_transform_queries(transform_sql)
+        inventory_params = None
+        if viable_only:
+            if incremental:
+                raise ValueError(
+                    "--viable_only can't be combined with --incremental, which "
+                    "would keep vials that are no longer viable."
+                )
+            condition, inventory_params = viability_condition(
+                query, exclude_conditions, exclude_matcodes, rules=rules
+            )
+        selected_columns = list(columns or [])
+        if column_profile:
+            selected_columns += COLUMN_PROFILES[column_profile]
+        if selected_columns:
+            selected_columns += SAMPLEID_COLUMNS
+            if not no_viable:
+                selected_columns += [rule["column"] for rule in rules]
+            if incremental:
+                selected_columns += [INVENTORY_KEY_COLUMN, INVENTORY_CHANGE_COLUMN]
+            query = project_columns(query, selected_columns)
+        locations_query = column_order = None
+        if location_cache:
+            query, locations_query, column_order = load_location_queries(
+                sql_file, query
+            )
+        if viable_only:
+            query = add_where_condition(query, condition)
+        logger.debug(f"SQL Query: {query}")
+        schema = load_schema(sql_file) if use_schema else None
+        # Common MSSQL parameters. Default to secure TLS settings and allow
+        # explicit environment-based overrides for legacy deployments.
+        encrypt = os.getenv("DB_ENCRYPT", "yes").strip().lower()
+        trust_server_certificate = (
+            os.getenv("DB_TRUST_SERVER_CERTIFICATE", "yes").strip().lower()
+        )
+        if encrypt not in {"yes", "no"}:
+            raise ValueError("DB_ENCRYPT must be either 'yes' or 'no'.")
+        if trust_server_certificate not in {"yes", "no"}:
+            raise ValueError(
+                "DB_TRUST_SERVER_CERTIFICATE must be either 'yes' or 'no'."
+            )
+        if encrypt == "no" or trust_server_certificate == "yes":
+            logger.warning(
+                "Using insecure SQL Server TLS settings: Encrypt=%s, TrustServerCertificate=%s. "
+                "This should only be used for legacy environments.",
+                encrypt,
+                trust_server_certificate,
+            )
+        query_params = {
+            "driver": db_driver,
             "TrustServerCertificate": trust_server_certificate,
             "Encrypt": encrypt,
             "timeout": "30",  # seconds
@@ -410,73 +4017,129 @@ def main(
         import socket
 
         check_port = db_port or 1433  # Default to 1433 for reachability check if None
-        try:
-            with socket.create_connection((db_host, check_port), timeout=5):
-                logger.info(f"Port {check_port} on {db_host} is reachable.")
-        except (socket.timeout, ConnectionRefusedError, OSError) as e:
-            if db_port:
-                logger.error(
-                    f"Cannot reach {db_host}:{db_port}. Check your VPN or network connection. Error: {e}"
-                )
-                return
-            else:
-                logger.warning(
-                    f"Could not reach {db_host} on default port 1433. Dynamic port resolution might still work via the ODBC driver. Proceeding... (Error: {e})"
-                )
+        with timed_phase("precheck"):
+            try:
+                with socket.create_connection((db_host, check_port), timeout=5):
+                    logger.info(f"Port {check_port} on {db_host} is reachable.")
+            except (socket.timeout, ConnectionRefusedError, OSError) as e:
+                if db_port:
+                    logger.error(
+                        f"Cannot reach {db_host}:{db_port}. Check your VPN or network connection. Error: {e}"
+                    )
+                    return
+                else:
+                    logger.warning(
+                        f"Could not reach {db_host} on default port 1433. Dynamic port resolution might still work via the ODBC driver. Proceeding... (Error: {e})"
+                    )
 
         logger.debug(
             f"Connection URL: {connection_url.render_as_string(hide_password=True)}"
         )
-        trial_inventory = query_to_df(connection_url, query, trial_code=trial_code)
-        trial_inventory = extract_sampleid(trial_inventory)
-        if not no_viable:
-            trial_inventory = flag_viable(
-                trial_inventory, exclude_conditions, exclude_matcodes
+        # One engine (and connection pool) serves every query in this run
+        engine = create_db_engine(
+            connection_url,
+            pool_size=pool_size,
+            pool_pre_ping=pool_pre_ping,
+            pool_recycle=pool_recycle,
+        )
+        # Log in once up front, so the ODBC login is timed on its own
+        with timed_phase("connect"):
+            with engine.connect():
+                pass
+        cache_dir = Path(output_dir) / ".sparqy_cache" if cache else None
+        locations = None
+        if locations_query:
+            locations = load_locations(
+                engine,
+                locations_query,
+                Path(output_dir) / ".sparqy_cache",
+                cache_ttl=location_cache_ttl * 3600,
+                cache_max_bytes=cache_max_mb * 2**20,
+                refresh_cache=refresh_cache,
+                schema=schema,
             )
-        final_parquet_file_path = parquet_path(
-            trial_code=trial_code,
-            output_dir=output_dir,
-            include_dsn_in_filename=include_dsn_in_filename,
-            add_trial_to_path=add_trial_to_path,
-        )
-        trial_inventory.to_parquet(
-            final_parquet_file_path, compression=parquet_compression
-        )
-        logging.info(
-            f"{len(trial_inventory)} {trial_code} records saved to {final_parquet_file_path.absolute()} with {parquet_compression} compression."
-        )
-
-        # Download inventory history
-        if download_history:
-            history_sql_file = Path(sql_file).parent / "inventory_history.sql"
-            if history_sql_file.exists():
-                logger.info(f"Downloading history for {trial_code}...")
-                history_query = parse_sql_file(history_sql_file)
-                if history_query:
-                    history_df = query_to_df(
-                        connection_url, history_query, trial_code=trial_code
-                    )
-                    # Create history filename with '_history' suffix
-                    history_parquet_file_name = (
-                        final_parquet_file_path.stem + "_history.parquet"
-                    )
-                    history_parquet_file_path = (
-                        final_parquet_file_path.parent / history_parquet_file_name
-                    )
-
-                    history_df.to_parquet(
-                        history_parquet_file_path, compression=parquet_compression
-                    )
-                    logging.info(
-                        f"{len(history_df)} history records for {trial_code} saved to {history_parquet_file_path.absolute()}."
+        if cache_dir is not None and stream:
+            logger.info("The query cache isn't used for streamed trial inventories.")
+        trial_workers = max(1, min(workers, len(codes)))
+        connections_needed = trial_workers * (
+            (partitions if partitions > 1 and not stream else 1) + download_history
+        )
+        if connections_needed > pool_size:
+            logger.warning(
+                f"Up to {connections_needed} concurrent queries but a pool size of "
+                f"{pool_size}; raise --pool_size so connections are reused."
+            )
+        trial_summaries = []
+        with ThreadPoolExecutor(max_workers=trial_workers) as pool:
+            futures = {
+                pool.submit(
+                    process_trial,
+                    engine,
+                    query,
+                    code,
+                    sql_file=sql_file,
+                    output_dir=output_dir,
+                    add_trial_to_path=add_trial_to_path,
+                    include_dsn_in_filename=include_dsn_in_filename,
+                    no_viable=no_viable,
+                    exclude_conditions=exclude_conditions,
+                    exclude_matcodes=exclude_matcodes,
+                    parquet_compression=parquet_compression,
+                    download_history=download_history,
+                    stream=stream,
+                    chunk_size=chunk_size,
+                    fetch_engine=fetch_engine,
+                    stream_results=stream_results,
+                    arraysize=arraysize,
+                    cache_dir=cache_dir,
+                    cache_ttl=cache_ttl * 3600,
+                    cache_max_bytes=cache_max_mb * 2**20,
+                    refresh_cache=refresh_cache,
+                    incremental=incremental,
+                    incremental_history=incremental_history,
+                    full_refresh=full_refresh,
+                    partitions=partitions,
+                    partition_key=partition_key,
+                    partition_probe=partition_probe,
+                    params=inventory_params,
+                    schema=schema,
+                    dictionary_threshold=dictionary_threshold,
+                    record_dir=record_dir,
+                    comment_fields=fields,
+                    viability_rules=rules,
+                    dtype_backend=dtype_backend,
+                    transform_engine=transform_engine,
+                    transform_queries=transform_queries,
+                    locations=locations,
+                    column_order=column_order,
+                ): code
+                for code in codes
+            }
+            for future in as_completed(futures):
+                try:
+                    trial_summaries.append(future.result())
+                except Exception as e:
+                    logger.error(f"Error processing trial {futures[future]}: {e}")
+                    trial_summaries.append(
+                        {"trial_code": futures[future], "status": f"failed: {e}"}
                     )
-                else:
-                    logger.warning("History query was empty.")
-            else:
-                logger.warning(f"History SQL file not found: {history_sql_file}")
+        if len(codes) > 1:
+            log_trial_summary(trial_summaries, codes)
+        write_run_report(output_dir, started, trial_summaries, PHASE_TIMINGS)
+        if report:
+            logger.info(
+                f"Phase timings:\n{summarize_phases(PHASE_TIMINGS).to_string(index=False)}"
+            )
 
     except Exception as e:
         logger.error(f"Error processing trial inventory: {e}")
+    finally:
+        if engine is not None:
+            engine.dispose()
+        if profiler is not None:
+            profiler.disable()
+            write_profile(output_dir, started, profiler, top_n=profile_top)
+            tracemalloc.stop()
 
 
 if __name__ == "__main__":
@@ -499,4 +4162,41 @@ if __name__ == "__main__":
         db_driver=args.db_driver,
         debug=args.debug,
         download_history=args.download_history,
+        stream=args.stream,
+        chunk_size=args.chunk_size,
+        fetch_engine=args.fetch_engine,
+        stream_results=args.stream_results,
+        arraysize=args.arraysize,
+        cache=args.cache and not args.no_cache,
+        refresh_cache=args.refresh_cache,
+        cache_ttl=args.cache_ttl,
+        cache_max_mb=args.cache_max_mb,
+        incremental=args.incremental,
+        incremental_history=args.incremental_history,
+        full_refresh=args.full_refresh,
+        partitions=args.partitions,
+        partition_key=args.partition_key,
+        partition_probe=args.partition_probe,
+        columns=args.columns,
+        column_profile=args.column_profile,
+        viable_only=args.viable_only,
+        use_schema=not args.no_schema,
+        dictionary_threshold=args.dictionary_threshold,
+        report=args.report,
+        profile=args.profile,
+        profile_top=args.profile_top,
+        record_dir=args.record_dir,
+        comment_keys=args.comment_keys,
+        viability_rules_file=args.viability_rules,
+        dtype_backend=args.dtype_backend,
+        transform_engine=args.engine,
+        transform_sql=args.transform_sql,
+        location_cache=args.location_cache,
+        location_cache_ttl=args.location_cache_ttl,
+        pool_size=args.pool_size,
+        pool_pre_ping=args.pool_pre_ping,
+        pool_recycle=args.pool_recycle,
+        trial_codes=args.trial_codes,
+        trial_codes_file=args.trial_codes_file,
+        workers=args.workers,
     )
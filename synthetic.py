@@ -0,0 +1,379 @@
+"""
+Synthetic StarLIMS-shaped trial inventory and history data.
+
+The generated frames have exactly the columns of ``trial_inventory.sql`` and
+``inventory_history.sql``, with value distributions close to production:
+excluded condition codes, box MATCODEs including ``100x100Box`` and NULL,
+COMMENTS carrying ``SAMPLEID:``/``LAB_ID:`` values, and positions on box grids.
+Use them to exercise the pipeline at scale without the production database:
+
+    uv run synthetic.py --rows 1000000 --output synthetic.db
+"""
+
+import argparse
+import sqlite3
+from logging import INFO, basicConfig, getLogger
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from main import URL, parse_sql_file, select_items
+
+logger = getLogger(__name__)
+
+BASE_DIR = Path(__file__).resolve().parent
+# Queries that run the pipeline against a database written by write_sqlite
+SQLITE_INVENTORY_QUERY = (
+    "SELECT * FROM inventory WHERE LAST_NAME = :trial_code "
+    "ORDER BY VIAL_CONTAINER_INV_ID"
+)
+SQLITE_HISTORY_QUERY = (
+    "SELECT * FROM history WHERE LAST_NAME = :trial_code "
+    "ORDER BY INVENTORYID, TRANSACTION_ID"
+)
+# Box MATCODEs with the size of their grid; NULL means the vial isn't boxed
+BOX_GRIDS = {"10x10Box": 10, "9x9Box": 9, "100x100Box": 100, None: None}
+BOX_GRID_WEIGHTS = [0.6, 0.3, 0.05, 0.05]
+CONDITIONS = ["Good", "SNR", "QNSR", "QNS", "NSI", None]
+RECEIVED_CONDITION_WEIGHTS = [0.9, 0.02, 0.02, 0.02, 0.01, 0.03]
+SAMPLE_CONDITION_WEIGHTS = [0.75, 0.01, 0.01, 0.02, 0.01, 0.2]
+SAMPLE_TYPES = ["Plasma", "Serum", "Buffy Coat", "Whole Blood", "Urine", "PBMC", "RNA"]
+SAMPLE_TYPE_WEIGHTS = [0.3, 0.25, 0.1, 0.1, 0.1, 0.1, 0.05]
+# Vials per subject, and the most transactions a vial has
+VIALS_PER_SUBJECT = 40
+MAX_TRANSACTIONS = 10
+TRANSACTION_TYPES = ["RECEIVE", "STORE", "MOVE", "ALIQUOT", "THAW", "SHIP"]
+# Rows generated and written at a time by write_sqlite
+SQLITE_CHUNK_SIZE = 500_000
+
+
+def sql_columns(sql_file):
+    """
+    Return the result column names of a SQL file, in SELECT order.
+
+    Args:
+        sql_file (Union[str, Path]): Path to the .sql file.
+
+    Returns:
+        list[str]: The column names.
+    """
+    return [name for name, _ in select_items(parse_sql_file(sql_file))]
+
+
+def coded(prefix, numbers, width):
+    """Format integers as zero-padded codes, e.g. ``S000042``."""
+    # Format each distinct number once; most coded columns repeat a lot
+    uniques, inverse = np.unique(numbers, return_inverse=True)
+    labels = [f"{prefix}{number:0{width}d}" for number in uniques.tolist()]
+    return np.array(labels, dtype=object)[inverse]
+
+
+def choice(rng, values, n_rows, weights=None):
+    """Draw ``n_rows`` values, which may include None, with the given weights."""
+    values = np.array(values, dtype=object)
+    return values[rng.choice(len(values), size=n_rows, p=weights)]
+
+
+def with_nulls(rng, values, fraction):
+    """Replace a random ``fraction`` of the values with NULL."""
+    return np.where(rng.random(len(values)) < fraction, None, values)
+
+
+def synthetic_inventory(n_rows, seed=0, trial_code="SYNTH", start=0):
+    """
+    Generate trial inventory rows shaped like the results of trial_inventory.sql.
+
+    Rows are generated with vectorized numpy operations, and the same
+    ``seed`` and ``start`` always give the same rows, so a large table can be
+    built in chunks.
+
+    Args:
+        n_rows (int): Number of vials to generate.
+        seed (int): Random seed.
+        trial_code (str): Value of TRIAL_CODE and LAST_NAME.
+        start (int): Index of the first vial, for generating in chunks.
+
+    Returns:
+        pd.DataFrame: One row per vial, with nullable integer columns as
+        float64 like pandas infers from the database rows.
+    """
+    rng = np.random.default_rng([seed, start])
+    index = np.arange(start, start + n_rows)
+    vial_ids = 1_000_000 + index
+    subjects = index // VIALS_PER_SUBJECT
+    boxes = index // 81
+    freezers = boxes // 600 % 12
+    shelves = boxes // 100 % 6
+    racks = boxes // 5 % 20
+
+    matcodes = choice(rng, list(BOX_GRIDS), n_rows, BOX_GRID_WEIGHTS)
+    axis = pd.Series(matcodes).map(BOX_GRIDS).astype(float).to_numpy()
+    pos_x = np.where(np.isnan(axis), np.nan, np.floor(rng.random(n_rows) * axis) + 1)
+    pos_y = np.where(np.isnan(axis), np.nan, np.floor(rng.random(n_rows) * axis) + 1)
+    # Two-level locations have no rack, so the freezer column shows the shelf
+    two_level = rng.random(n_rows) < 0.1
+    freezer_names = coded("Freezer ", freezers + 1, 2)
+    shelf_names = coded("Shelf ", shelves + 1, 1)
+    rack_names = coded("Rack ", racks + 1, 2)
+
+    collected = np.datetime64("2015-01-01") + rng.integers(
+        0, 10 * 365 * 24 * 60, n_rows
+    ).astype("timedelta64[m]")
+    received = collected + rng.integers(0, 3 * 24 * 60, n_rows).astype("timedelta64[m]")
+    amount = np.round(rng.random(n_rows) * 2, 3)
+    amount[rng.random(n_rows) < 0.08] = 0
+    amount[rng.random(n_rows) < 0.02] = np.nan
+    seq = rng.integers(1, 21, n_rows)
+    transactions = rng.integers(1, MAX_TRANSACTIONS + 1, n_rows)
+
+    sample_ids = coded("SAMPLEID:", rng.integers(0, 10**7, n_rows), 7)
+    lab_ids = coded("LAB_ID:", rng.integers(0, 10**6, n_rows), 6)
+    comment_kind = rng.choice(4, size=n_rows, p=[0.6, 0.15, 0.1, 0.15])
+    comments = np.select(
+        [comment_kind == 0, comment_kind == 1, comment_kind == 2],
+        [sample_ids + ", " + lab_ids, lab_ids, sample_ids + ","],
+        "Hemolyzed",
+    )
+    comments = np.where(comment_kind < 3, comments, with_nulls(rng, comments, 0.7))
+
+    visits = rng.integers(1, 13, n_rows)
+    sites = subjects % 10 + 1
+    buildings = freezers // 6
+    rooms = freezers // 3
+    flags = ["Y", "N", None]
+    columns = {
+        "TRIAL_CODE": trial_code,
+        "SUBJECTID": coded("S", subjects, 6),
+        "LABID": coded("L", subjects, 7),
+        "CID": coded("C", vial_ids, 9),
+        "SAMPLETYPE": choice(rng, SAMPLE_TYPES, n_rows, SAMPLE_TYPE_WEIGHTS),
+        "PRESERVATIVE": choice(
+            rng, ["EDTA", "Heparin", "PAXgene", None], n_rows, [0.5, 0.2, 0.1, 0.2]
+        ),
+        "AMOUNTLEFT": amount,
+        "AMOUNT_UNIT_CODE": choice(rng, ["mL", "uL"], n_rows, [0.9, 0.1]),
+        "THAWCOUNT": choice(rng, [0, 1, 2, 3], n_rows, [0.7, 0.2, 0.07, 0.03]),
+        "SEQ": seq.astype(str).astype(object),
+        "SEQ_NUM": seq,
+        "FREEZER": np.where(two_level, shelf_names, freezer_names),
+        "SHELF": np.where(two_level, rack_names, shelf_names),
+        "RACK": np.where(two_level, None, rack_names),
+        "BOX_CODE": coded("BX", boxes, 7),
+        "BOX_NAME": coded("Box ", boxes % 1000 + 1, 3),
+        "BOX_POS": (pos_y - 1) * axis + pos_x,
+        "ACCESSION": coded("A", subjects * 12 + visits, 8),
+        "DATE_COLLECTED": collected,
+        "DATE_RECEIVED": received,
+        "RECEIVED_CONDITION": choice(
+            rng, CONDITIONS, n_rows, RECEIVED_CONDITION_WEIGHTS
+        ),
+        "SAMPLE_CONDITION": choice(rng, CONDITIONS, n_rows, SAMPLE_CONDITION_WEIGHTS),
+        "COMMENTS": comments,
+        "MS_VISIT": coded("Visit ", visits, 2),
+        "TMS_ID": visits + 100,
+        "TP_CODE": coded("TP", visits, 2),
+        "TP_VISIT": coded("V", visits, 2),
+        "TP_DESC": coded("Timepoint ", visits, 2),
+        "TE_NAME": np.where(visits == 1, "Baseline", "Follow-up"),
+        "CR_VISIT": coded("", visits, 1),
+        "NICKNAME": None,
+        "CPT": choice(rng, flags, n_rows),
+        "EDTA1": choice(rng, flags, n_rows),
+        "EDTA2": choice(rng, flags, n_rows),
+        "PAXGENE": choice(rng, flags, n_rows),
+        "SST1": choice(rng, flags, n_rows),
+        "SST2": choice(rng, flags, n_rows),
+        "SST3": choice(rng, flags, n_rows),
+        "EDTA1_VOLUME": choice(rng, ["4.0", "6.0", "10.0", None], n_rows),
+        "ORASURE": choice(rng, flags, n_rows),
+        "BARCODE": coded("BC", vial_ids, 10),
+        "CONSENT_TYPE": choice(rng, ["Full", "Limited", None], n_rows, [0.8, 0.1, 0.1]),
+        "RACK_CODE": coded("LOC", racks + 100 * freezers, 5),
+        "SHELF_SORT": shelves + 1,
+        "RACK_SORT": racks + 1,
+        "CONTAINERMATCODE": choice(rng, ["Cryovial 2mL", "Cryovial 5mL"], n_rows),
+        "MATCODE": matcodes,
+        "CONTAINER_POS_Y": pos_y,
+        "CONTAINER_AXIS_Y_SIZE": axis,
+        "CONTAINER_POS_X": pos_x,
+        "CONTAINER_AXIS_X_SIZE": axis,
+        "LAST_NAME": trial_code,
+        "STUDY_SITE": coded("Site ", sites, 2),
+        "LONGNAME": freezer_names + " > " + shelf_names + " > " + rack_names,
+        "LONGCODE": coded("F", freezers + 1, 2)
+        + coded("-S", shelves + 1, 1)
+        + coded("-R", racks + 1, 2),
+        "ROOM_NAME": coded("Room ", rooms + 1, 3),
+        "ROOM_CODE": coded("R", rooms + 1, 3),
+        "BUILDING_NAME": coded("Building ", buildings + 1, 1),
+        "BUILDING_CODE": coded("B", buildings + 1, 2),
+        "ARCHIVE_STATUS": choice(rng, ["A", None], n_rows, [0.05, 0.95]),
+        "VIAL_CONTAINER_INV_ID": vial_ids,
+        "PARENT_CONTAINER_INV_ID": np.where(np.isnan(axis), np.nan, 10**8 + boxes),
+        "CR_ORIGREC": subjects * 12 + visits,
+        # Each vial's transactions are numbered vial * MAX_TRANSACTIONS + i
+        "CURRENT_TRANSACTION_ID": vial_ids * MAX_TRANSACTIONS + transactions - 1,
+    }
+    return pd.DataFrame(columns, index=pd.RangeIndex(n_rows))
+
+
+def synthetic_history(inventory, seed=0):
+    """
+    Generate the inventory history of synthetic vials.
+
+    Each vial gets the transactions numbered up to its CURRENT_TRANSACTION_ID,
+    the last of which is its current one, matching inventory_history.sql.
+
+    Args:
+        inventory (pd.DataFrame): Rows from :func:`synthetic_inventory`.
+        seed (int): Random seed.
+
+    Returns:
+        pd.DataFrame: One row per transaction, ordered by vial and transaction.
+    """
+    current = inventory["CURRENT_TRANSACTION_ID"].to_numpy()
+    counts = current % MAX_TRANSACTIONS + 1
+    rng = np.random.default_rng([seed, int(current[0]) if len(current) else 0])
+    rows = np.repeat(np.arange(len(inventory)), counts)
+    n_rows = len(rows)
+    location = inventory["RACK"].fillna(inventory["SHELF"])
+
+    def per_transaction(column):
+        values = location if column == "LOCATION_NAME" else inventory[column]
+        return values.to_numpy()[rows]
+
+    # Number each vial's transactions 0, 1, ... from its first row
+    first_row = np.repeat(np.cumsum(counts) - counts, counts)
+    sequence = np.arange(n_rows) - first_row
+    is_current = sequence == np.repeat(counts - 1, counts)
+    transaction_dt = per_transaction("DATE_RECEIVED") + (
+        sequence * 30 * 24 * 60 + rng.integers(0, 24 * 60, n_rows)
+    ).astype("timedelta64[m]")
+    # Older transactions had more left than the current one
+    amount = per_transaction("AMOUNTLEFT") + (counts[rows] - 1 - sequence) * 0.1
+    inventory_ids = per_transaction("VIAL_CONTAINER_INV_ID")
+    return pd.DataFrame(
+        {
+            "INVENTORYID": inventory_ids,
+            "TRANSACTION_ID": inventory_ids * MAX_TRANSACTIONS + sequence,
+            "TRANSACTION_DT": transaction_dt,
+            "USRNAM": choice(rng, [f"tech{i:02d}" for i in range(25)], n_rows),
+            "AMOUNTLEFT": np.round(amount, 3),
+            "AMOUNT_UNIT_CODE": per_transaction("AMOUNT_UNIT_CODE"),
+            "TRANSACTION_TYPE": np.where(
+                sequence == 0, "RECEIVE", choice(rng, TRANSACTION_TYPES[1:], n_rows)
+            ),
+            "COMMENTS": per_transaction("COMMENTS"),
+            "CONTAINER_POS_Y": per_transaction("CONTAINER_POS_Y"),
+            "CONTAINER_POS_X": per_transaction("CONTAINER_POS_X"),
+            "FLAG_CURRENT": is_current.astype(int),
+            "BOX_NAME": per_transaction("BOX_NAME"),
+            "BOX_CODE": per_transaction("BOX_CODE"),
+            "BOX_POS": per_transaction("BOX_POS"),
+            "LOCATION_NAME": per_transaction("LOCATION_NAME"),
+            "LONGNAME": per_transaction("LONGNAME"),
+        }
+    )
+
+
+def synthetic_arrow(n_rows, seed=0, trial_code="SYNTH"):
+    """
+    Generate synthetic trial inventory and history as Arrow tables.
+
+    Args:
+        n_rows (int): Number of vials to generate.
+        seed (int): Random seed.
+        trial_code (str): Value of TRIAL_CODE and LAST_NAME.
+
+    Returns:
+        tuple[pa.Table, pa.Table]: The inventory and history tables.
+    """
+    inventory = synthetic_inventory(n_rows, seed=seed, trial_code=trial_code)
+    history = synthetic_history(inventory, seed=seed)
+    return (
+        pa.Table.from_pandas(inventory, preserve_index=False),
+        pa.Table.from_pandas(history, preserve_index=False),
+    )
+
+
+def write_sqlite(db_file, n_rows, seed=0, trial_code="SYNTH", history=True):
+    """
+    Write synthetic trial inventory and history tables to a SQLite database.
+
+    The ``inventory`` and ``history`` tables stand in for the production
+    database; run the pipeline against them with SQLITE_INVENTORY_QUERY and
+    SQLITE_HISTORY_QUERY. The history table has an extra LAST_NAME column for
+    the trial filter. Rows are generated and written in chunks, so memory
+    stays bounded for large tables, and existing tables are appended to, so
+    several trials can share a database.
+
+    Args:
+        db_file (Union[str, Path]): SQLite database file.
+        n_rows (int): Number of vials to generate.
+        seed (int): Random seed.
+        trial_code (str): Trial the vials belong to.
+        history (bool): Also write the history table.
+
+    Returns:
+        URL: SQLAlchemy URL of the database.
+    """
+    with sqlite3.connect(db_file) as conn:
+        for start in range(0, n_rows, SQLITE_CHUNK_SIZE):
+            inventory = synthetic_inventory(
+                min(SQLITE_CHUNK_SIZE, n_rows - start),
+                seed=seed,
+                trial_code=trial_code,
+                start=start,
+            )
+            inventory.to_sql("inventory", conn, if_exists="append", index=False)
+            if history:
+                history_df = synthetic_history(inventory, seed=seed)
+                history_df["LAST_NAME"] = trial_code
+                history_df.to_sql("history", conn, if_exists="append", index=False)
+            logger.info(f"Wrote {start + len(inventory)} of {n_rows} rows to {db_file}")
+    return URL.create("sqlite", database=str(db_file))
+
+
+def parse_args():
+    """
+    Parse command line arguments.
+    Returns:
+        Namespace: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Write synthetic StarLIMS-shaped data to a SQLite database."
+    )
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=100_000,
+        help="Number of vials to generate, from 1,000 to 10,000,000",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="synthetic.db",
+        help="SQLite database file to write",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument(
+        "--trial_code", type=str, default="SYNTH", help="Trial code of the vials"
+    )
+    parser.add_argument(
+        "--no_history", action="store_true", help="Skip the history table"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    basicConfig(level=INFO)
+    write_sqlite(
+        args.output,
+        args.rows,
+        seed=args.seed,
+        trial_code=args.trial_code,
+        history=not args.no_history,
+    )
@@ -1,16 +1,67 @@
+import json
 import os
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pytest
 from pathlib import Path
 import environ
 from main import (
     extract_sampleid,
+    parse_comments,
+    comment_fields,
+    load_viability_rules,
     flag_viable,
     redact_dsn_password,
     parquet_path,
     parse_sql_file,
     URL,
     query_to_df,
+    query_to_parquet,
+    transform_inventory,
+    cursor_to_arrow,
+    create_db_engine,
+    process_trial,
+    read_trial_codes_file,
+    cached_query_to_df,
+    evict_query_cache,
+    add_where_condition,
+    download_history_increment,
+    download_inventory_parquet,
+    partition_ranges,
+    project_columns,
+    select_items,
+    COLUMN_PROFILES,
+    viability_condition,
+    apply_schema,
+    load_schema,
+    dictionary_encode,
+    PHASE_TIMINGS,
+    summarize_phases,
+    write_run_report,
+    write_profile,
+    ALLOCATION_SNAPSHOT,
+    timed,
+    read_recording,
+    write_recording,
+    rows_to_arrow,
+    polars_inventory_to_parquet,
+    polars_transform_inventory,
+    polars_comment_columns,
+    load_transform_queries,
+    load_location_queries,
+    load_locations,
+    resolve_locations,
+    LOCATION_COLUMNS,
+    LOCATION_KEY_COLUMN,
+)
+from synthetic import (
+    SQLITE_HISTORY_QUERY,
+    SQLITE_INVENTORY_QUERY,
+    sql_columns,
+    synthetic_history,
+    synthetic_inventory,
+    write_sqlite,
 )
 
 BASE_DIR = Path(__file__).resolve().parent
@@ -46,6 +97,84 @@ def test_extract_sampleid():
     assert pd.isna(result["SAMPLEID2"][3])
 
 
+def test_parse_comments():
+    comments = pd.Series(
+        [
+            "SITE:S01 LAB_ID:5, SAMPLEID:A-1, VISIT:V2",
+            "VISIT:V3; SAMPLEID:,",
+            "line one\nSAMPLEID:B-2, LAB_ID:",
+            None,
+        ]
+    )
+    fields = comment_fields(["SITE", "VISIT"])
+    parsed = parse_comments(comments, fields)
+    assert list(parsed.columns) == ["SAMPLEID", "SAMPLEID2", "SITE", "VISIT"]
+    assert parsed.iloc[0].tolist() == ["A-1", "5", "S01", "V2"]
+    # An empty value is kept apart from a missing key
+    assert parsed["SAMPLEID"][1] == ""
+    assert parsed["VISIT"][1] == "V3"
+    assert parsed["SAMPLEID"][2] == "B-2"
+    assert parsed.iloc[2][["SAMPLEID2", "SITE"]].isna().all()
+    assert parsed.iloc[3].isna().all()
+
+    arrow = parse_comments(comments.astype(pd.ArrowDtype(pa.string())), fields)
+    assert all(isinstance(dtype, pd.ArrowDtype) for dtype in arrow.dtypes)
+    assert arrow["SITE"][0] == "S01"
+    typed = {"SAMPLEID2": {"key": "LAB_ID", "value": r"\d+", "dtype": "Int64"}}
+    assert parse_comments(comments, typed)["SAMPLEID2"].tolist() == [
+        5,
+        pd.NA,
+        pd.NA,
+        pd.NA,
+    ]
+    with pytest.raises(ValueError):
+        comment_fields(["LAB ID"])
+
+
+def test_parse_comments_matches_separate_scans():
+    from benchmarks import extract_separately
+
+    comments = pd.Series(
+        [
+            # LAB_ID inside the SAMPLEID value
+            "SAMPLEID:ABC LAB_ID:5, x",
+            # Repeated keys give their first value
+            "LAB_ID:1 LAB_ID:2",
+            "SAMPLEID:,SAMPLEID:B,",
+            "LAB_ID:x LAB_ID:7",
+            # ID: also appears in LAB_ID:
+            "LAB_ID:3 ID:four",
+            "ID:8 SAMPLEID:C, LAB_ID:9",
+            "SAMPLEID:D",
+            "",
+            None,
+        ]
+    )
+    fields = comment_fields(["ID"])
+    expected = extract_separately(comments, fields)
+    assert expected.loc[0, "SAMPLEID2"] == "5"
+    assert expected.loc[1, "SAMPLEID2"] == "1"
+    for parsed in [
+        parse_comments(comments, fields),
+        parse_comments(comments.astype(pd.ArrowDtype(pa.string())), fields),
+    ]:
+        assert (
+            parsed.astype(object).where(parsed.notna(), None).values.tolist()
+            == expected.astype(object).where(expected.notna(), None).values.tolist()
+        )
+    # Both fields of a shared key are parsed
+    shared = comment_fields(["LAB_ID"])
+    assert parse_comments(comments, shared).equals(extract_separately(comments, shared))
+
+    pl = pytest.importorskip("polars")
+    frame = pl.from_pandas(comments.to_frame("COMMENTS"))
+    result = frame.select(polars_comment_columns(fields))
+    assert result.rows() == [
+        tuple(row)
+        for row in expected.astype(object).where(expected.notna(), None).values
+    ]
+
+
 def test_flag_viable():
     df = pd.DataFrame(
         {
@@ -74,6 +203,46 @@ def test_flag_viable():
     assert not result["VIABLE"][5]
 
 
+def test_flag_viable_reasons(tmp_path):
+    df = pd.DataFrame(
+        {
+            "MATCODE": ["Box", None, "100x100Box", "Box"],
+            "RECEIVED_CONDITION": ["Good", "SNR", "Good", "Good"],
+            "SAMPLE_CONDITION": ["Good", "Good", "Good", "QNS"],
+            "AMOUNTLEFT": [1.0, 0.0, None, 1.0],
+        }
+    )
+    result = flag_viable(df, ["SNR", "QNS"], ["100x100Box"])
+    rules = [rule["name"] for rule in load_viability_rules()]
+
+    def bits(*names):
+        return sum(1 << rules.index(name) for name in names)
+
+    assert result["NONVIABLE_REASON"].dtype == "uint8"
+    assert result["NONVIABLE_REASON"].tolist() == [
+        0,
+        bits("NOT_BOXED", "RECEIVED_CONDITION_EXCLUDED", "AMOUNT_EMPTY"),
+        bits("MATCODE_EXCLUDED", "AMOUNT_MISSING"),
+        bits("SAMPLE_CONDITION_EXCLUDED"),
+    ]
+    assert result["VIABLE"].tolist() == [True, False, False, False]
+    assert result.attrs["nonviable_counts"]["NOT_BOXED"] == 1
+    assert sum(result.attrs["nonviable_counts"].values()) == 6
+
+    rules_file = tmp_path / "rules.toml"
+    rules_file.write_text(
+        '[[rules]]\nname = "LOW"\ncolumn = "AMOUNTLEFT"\ntest = "at_most"\nvalue = 0.5\n'
+        '[[rules]]\nname = "SERUM"\ncolumn = "MATCODE"\ntest = "in"\nvalues = ["Box"]\n'
+    )
+    result = flag_viable(df, [], [], rules=load_viability_rules(rules_file))
+    assert result["NONVIABLE_REASON"].tolist() == [2, 1, 0, 2]
+    rules_file.write_text(
+        '[[rules]]\nname = "BAD"\ncolumn = "MATCODE"\ntest = "like"\n'
+    )
+    with pytest.raises(ValueError):
+        load_viability_rules(rules_file)
+
+
 def test_redact_dsn_password():
     dsn = "Driver={ODBC Driver 17 for SQL Server};Server=myServer;Database=myDB;UID=myUser;PWD=secretPassword123;"
     redacted = redact_dsn_password(dsn)
@@ -113,6 +282,1332 @@ def test_parse_sql_file(tmp_path):
     assert parse_sql_file(tmp_path / "missing.sql") is None
 
 
+@pytest.fixture
+def sqlite_inventory(tmp_path):
+    """A small SQLite stand-in for the trial inventory query."""
+    import sqlite3
+
+    db_file = tmp_path / "inventory.db"
+    with sqlite3.connect(db_file) as conn:
+        conn.execute(
+            "CREATE TABLE inventory (VIAL_CONTAINER_INV_ID INTEGER, LAST_NAME TEXT, "
+            "MATCODE TEXT, RECEIVED_CONDITION TEXT, SAMPLE_CONDITION TEXT, "
+            "AMOUNTLEFT REAL, COMMENTS TEXT)"
+        )
+        conn.executemany(
+            "INSERT INTO inventory VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (1, "T1", "Box", "Good", "Good", 1.0, "SAMPLEID:A-1, x"),
+                (2, "T1", None, "Good", "Good", 1.0, "LAB_ID:22"),
+                (3, "T1", "100x100Box", "Good", None, 1.0, None),
+                (4, "T1", "Box", "SNR", "Good", 1.0, "SAMPLEID:A-4, LAB_ID:44"),
+                (5, "T1", "Box", "Good", "QNS", 1.0, "nothing"),
+                (6, "T1", "Box", "Good", "Good", 0.0, "SAMPLEID:A-6,"),
+                (7, "T1", "Box", None, "Good", None, "SAMPLEID:A-7,"),
+                (8, "T2", "Box", "Good", "Good", 1.0, "SAMPLEID:B-8,"),
+            ],
+        )
+        conn.execute(
+            "CREATE TABLE history (INVENTORYID INTEGER, TRANSACTION_ID INTEGER, "
+            "TRANSACTION_DT TEXT, LAST_NAME TEXT, AMOUNTLEFT REAL)"
+        )
+        conn.executemany(
+            "INSERT INTO history VALUES (?, ?, ?, ?, ?)",
+            [
+                (1, 10, "2024-01-01 09:00:00", "T1", 2.0),
+                (1, 11, "2024-01-02 09:00:00", "T1", 1.0),
+                (2, 12, "2024-01-03 09:00:00", "T1", 1.0),
+                (8, 13, "2024-01-04 09:00:00", "T2", 1.0),
+            ],
+        )
+    return URL.create("sqlite", database=str(db_file))
+
+
+INVENTORY_QUERY = "SELECT * FROM inventory WHERE LAST_NAME = :trial_code ORDER BY VIAL_CONTAINER_INV_ID"
+HISTORY_QUERY = "SELECT * FROM history WHERE LAST_NAME = :trial_code ORDER BY INVENTORYID, TRANSACTION_ID"
+
+
+def test_query_to_parquet_matches_in_memory(sqlite_inventory, tmp_path):
+    def transform(df):
+        return transform_inventory(df, False, ["SNR", "QNS"], ["100x100Box", None])
+
+    expected = transform(query_to_df(sqlite_inventory, INVENTORY_QUERY, "T1"))
+    parquet_file = tmp_path / "T1.parquet"
+    row_count = query_to_parquet(
+        sqlite_inventory,
+        INVENTORY_QUERY,
+        parquet_file,
+        trial_code="T1",
+        chunk_size=3,
+        transform=transform,
+    )
+    assert row_count == 7
+    result = pd.read_parquet(parquet_file)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+    # An empty result still produces a readable file with the same columns
+    empty_file = tmp_path / "empty.parquet"
+    row_count = query_to_parquet(
+        sqlite_inventory, INVENTORY_QUERY, empty_file, "NONE", transform=transform
+    )
+    assert row_count == 0
+    assert list(pd.read_parquet(empty_file).columns) == list(expected.columns)
+
+
+def test_arrow_fetch_engine(sqlite_inventory, tmp_path):
+    expected = query_to_df(sqlite_inventory, INVENTORY_QUERY, "T1")
+    result = query_to_df(sqlite_inventory, INVENTORY_QUERY, "T1", fetch_engine="arrow")
+    assert all(isinstance(dtype, pd.ArrowDtype) for dtype in result.dtypes)
+    assert list(result.columns) == list(expected.columns)
+    assert (
+        result.astype(object).where(result.notna(), None).values.tolist()
+        == expected.astype(object).where(expected.notna(), None).values.tolist()
+    )
+
+    parquet_file = tmp_path / "T1.parquet"
+    query_to_parquet(
+        sqlite_inventory,
+        INVENTORY_QUERY,
+        parquet_file,
+        trial_code="T1",
+        chunk_size=2,
+        fetch_engine="arrow",
+    )
+    assert pd.read_parquet(parquet_file).shape == expected.shape
+
+
+@pytest.mark.parametrize("fetch_engine", ["pandas", "arrow"])
+def test_query_to_df_stream_results(sqlite_inventory, caplog, fetch_engine):
+    expected = query_to_df(sqlite_inventory, INVENTORY_QUERY, "T1", fetch_engine)
+    with caplog.at_level("INFO"):
+        result = query_to_df(
+            sqlite_inventory,
+            INVENTORY_QUERY,
+            "T1",
+            fetch_engine,
+            stream_results=True,
+            arraysize=2,
+        )
+    pd.testing.assert_frame_equal(result, expected)
+    assert "Time to first row" in caplog.text
+    assert "rows/sec" in caplog.text
+
+
+def test_shared_engine_is_reused(sqlite_inventory):
+    from sqlalchemy import event
+
+    engine = create_db_engine(sqlite_inventory, pool_size=1)
+    connects = []
+    event.listen(engine, "connect", lambda *args: connects.append(args))
+    try:
+        first = query_to_df(engine, INVENTORY_QUERY, "T1")
+        second = query_to_df(engine, INVENTORY_QUERY, "T2")
+        # Both queries were served by the same pooled DBAPI connection
+        assert len(connects) == 1
+        assert len(first) == 7 and len(second) == 1
+    finally:
+        engine.dispose()
+
+
+@pytest.mark.parametrize("partition_probe", ["minmax", "quantile"])
+def test_partitioned_query_to_df(sqlite_inventory, partition_probe):
+    ranges = partition_ranges(
+        sqlite_inventory,
+        INVENTORY_QUERY,
+        "VIAL_CONTAINER_INV_ID",
+        3,
+        partition_probe=partition_probe,
+        trial_code="T1",
+    )
+    assert len(ranges) == 3
+    assert ranges[-1][1] is None
+    expected = query_to_df(sqlite_inventory, INVENTORY_QUERY, "T1")
+    df = query_to_df(
+        sqlite_inventory,
+        INVENTORY_QUERY,
+        "T1",
+        partitions=3,
+        partition_key="VIAL_CONTAINER_INV_ID",
+        partition_probe=partition_probe,
+    )
+    pd.testing.assert_frame_equal(df, expected)
+    # No matching rows means no ranges, and an empty result
+    assert (
+        partition_ranges(
+            sqlite_inventory,
+            INVENTORY_QUERY,
+            "VIAL_CONTAINER_INV_ID",
+            3,
+            trial_code="NONE",
+        )
+        == []
+    )
+    assert query_to_df(
+        sqlite_inventory,
+        INVENTORY_QUERY,
+        "NONE",
+        partitions=3,
+        partition_key="VIAL_CONTAINER_INV_ID",
+    ).empty
+
+
+def test_process_trial(sqlite_inventory, tmp_path):
+    engine = create_db_engine(sqlite_inventory)
+    try:
+        summaries = [
+            process_trial(
+                engine,
+                INVENTORY_QUERY,
+                code,
+                sql_file=tmp_path / "inventory.sql",
+                output_dir=tmp_path / "output",
+                add_trial_to_path=False,
+                include_dsn_in_filename=False,
+                no_viable=False,
+                exclude_conditions=["SNR", "QNS"],
+                exclude_matcodes=["100x100Box", None],
+                parquet_compression="zstd",
+            )
+            for code in ["T1", "T2"]
+        ]
+    finally:
+        engine.dispose()
+    assert [summary["records"] for summary in summaries] == [7, 1]
+    assert all(summary["status"] == "ok" for summary in summaries)
+    assert len(pd.read_parquet(summaries[1]["path"])) == 1
+
+
+def test_process_trial_downloads_history(sqlite_inventory, tmp_path):
+    (tmp_path / "inventory_history.sql").write_text(HISTORY_QUERY)
+    engine = create_db_engine(sqlite_inventory)
+    try:
+        summary = process_trial(
+            engine,
+            INVENTORY_QUERY,
+            "T1",
+            sql_file=tmp_path / "inventory.sql",
+            output_dir=tmp_path / "output",
+            add_trial_to_path=False,
+            include_dsn_in_filename=False,
+            no_viable=True,
+            exclude_conditions=[],
+            exclude_matcodes=[],
+            parquet_compression="zstd",
+            download_history=True,
+        )
+    finally:
+        engine.dispose()
+    assert summary["records"] == 7
+    assert summary["history_records"] == 3
+    history = pd.read_parquet(tmp_path / "output" / "T1_history.parquet")
+    assert history["TRANSACTION_ID"].tolist() == [10, 11, 12]
+
+
+def test_process_trial_transform_sql(sqlite_inventory, tmp_path):
+    pytest.importorskip("duckdb")
+    (tmp_path / "inventory_history.sql").write_text(HISTORY_QUERY)
+    (tmp_path / "by_matcode.sql").write_text(
+        "SELECT MATCODE, count(*) AS VIALS, sum(VIABLE::INT) AS VIABLE_VIALS "
+        "FROM inventory GROUP BY MATCODE ORDER BY MATCODE NULLS LAST"
+    )
+    (tmp_path / "transactions.sql").write_text(
+        "SELECT i.VIAL_CONTAINER_INV_ID, count(h.TRANSACTION_ID) AS TRANSACTIONS "
+        "FROM inventory i LEFT JOIN history h ON h.INVENTORYID = i.VIAL_CONTAINER_INV_ID "
+        "GROUP BY ALL ORDER BY 1"
+    )
+    queries = load_transform_queries(
+        [tmp_path / "by_matcode.sql", tmp_path / "transactions.sql"]
+    )
+    engine = create_db_engine(sqlite_inventory)
+    try:
+        process_trial(
+            engine,
+            INVENTORY_QUERY,
+            "T1",
+            sql_file=tmp_path / "inventory.sql",
+            output_dir=tmp_path / "output",
+            add_trial_to_path=False,
+            include_dsn_in_filename=False,
+            no_viable=False,
+            exclude_conditions=["SNR", "QNS"],
+            exclude_matcodes=["100x100Box", None],
+            parquet_compression="zstd",
+            download_history=True,
+            transform_queries=queries,
+        )
+    finally:
+        engine.dispose()
+    by_matcode = pd.read_parquet(tmp_path / "output" / "T1_by_matcode.parquet")
+    assert by_matcode["MATCODE"].tolist()[:2] == ["100x100Box", "Box"]
+    assert by_matcode["VIALS"].tolist() == [1, 5, 1]
+    assert by_matcode["VIABLE_VIALS"].tolist() == [0, 1, 0]
+    transactions = pd.read_parquet(tmp_path / "output" / "T1_transactions.parquet")
+    assert transactions["TRANSACTIONS"].tolist() == [2, 1, 0, 0, 0, 0, 0]
+
+    with pytest.raises(ValueError):
+        load_transform_queries([tmp_path / "missing.sql"])
+    (tmp_path / "history.sql").write_text("SELECT 1")
+    with pytest.raises(ValueError):
+        load_transform_queries([tmp_path / "history.sql"])
+
+
+def test_run_report(sqlite_inventory, tmp_path):
+    import datetime
+
+    PHASE_TIMINGS.clear()
+    engine = create_db_engine(sqlite_inventory)
+    try:
+        summary = process_trial(
+            engine,
+            INVENTORY_QUERY,
+            "T1",
+            sql_file=tmp_path / "inventory.sql",
+            output_dir=tmp_path,
+            add_trial_to_path=False,
+            include_dsn_in_filename=False,
+            no_viable=False,
+            exclude_conditions=["SNR", "QNS"],
+            exclude_matcodes=["100x100Box", None],
+            parquet_compression="zstd",
+        )
+    finally:
+        engine.dispose()
+    phases = summarize_phases(PHASE_TIMINGS).set_index("phase")
+    assert {
+        "execute",
+        "fetch",
+        "dataframe",
+        "extract_sampleid",
+        "flag_viable",
+        "to_parquet",
+        "inventory",
+    } <= set(phases.index)
+    assert phases.loc["fetch", "rows"] == 7
+    assert phases.loc["to_parquet", "bytes"] > 0
+    assert pd.isna(phases.loc["execute", "rows"])
+
+    report_file = write_run_report(
+        tmp_path, datetime.datetime.now(), [summary], PHASE_TIMINGS
+    )
+    report = json.loads(report_file.read_text())
+    assert report["trials"][0]["records"] == 7
+    assert {phase["phase"] for phase in report["phases"]} == set(phases.index)
+    assert all(phase["wall_seconds"] >= 0 for phase in report["phases"])
+
+
+def test_write_profile(sqlite_inventory, tmp_path):
+    import cProfile
+    import datetime
+    import pstats
+    import tracemalloc
+
+    PHASE_TIMINGS.clear()
+    ALLOCATION_SNAPSHOT.update(traced_bytes=0, phase=None, snapshot=None)
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        timed(
+            "inventory",
+            "T1",
+            download_inventory_parquet,
+            sqlite_inventory,
+            INVENTORY_QUERY,
+            "T1",
+            tmp_path / "T1.parquet",
+            no_viable=False,
+            exclude_conditions=["SNR", "QNS"],
+            exclude_matcodes=["100x100Box", None],
+            parquet_compression="zstd",
+        )
+    finally:
+        profiler.disable()
+        stats_file = write_profile(tmp_path, datetime.datetime.now(), profiler, 10)
+        tracemalloc.stop()
+    stats = pstats.Stats(str(stats_file))
+    assert any(function[2] == "extract_sampleid" for function in stats.stats)
+    allocations = stats_file.with_name(stats_file.stem + "-allocations.txt")
+    assert "allocation sites" in allocations.read_text()
+    peaks = summarize_phases(PHASE_TIMINGS).set_index("phase")["traced_peak_mb"]
+    assert peaks.notna().all()
+    # A phase's peak includes those of the phases nested in it
+    assert peaks["inventory"] >= peaks.drop("inventory").max()
+
+
+def test_main_profiles_trials(sqlite_inventory, tmp_path, monkeypatch):
+    import contextlib
+    import pstats
+    import socket
+    import threading
+
+    import main as sparqy
+
+    monkeypatch.setattr(
+        sparqy,
+        "create_db_engine",
+        lambda *args, **kwargs: create_db_engine(sqlite_inventory),
+    )
+    monkeypatch.setattr(
+        socket, "create_connection", lambda *args, **kwargs: contextlib.nullcontext()
+    )
+    threads = []
+    process_trial = sparqy.process_trial
+
+    def recording_process_trial(*args, **kwargs):
+        threads.append(threading.current_thread())
+        return process_trial(*args, **kwargs)
+
+    monkeypatch.setattr(sparqy, "process_trial", recording_process_trial)
+    sql_file = tmp_path / "inventory.sql"
+    sql_file.write_text(INVENTORY_QUERY)
+    output_dir = tmp_path / "output"
+    sparqy.main(
+        db_host="localhost",
+        db_name="test",
+        db_port=1433,
+        db_user=None,
+        db_password=None,
+        sql_file=str(sql_file),
+        trial_code="T1",
+        output_dir=output_dir,
+        add_trial_to_path=False,
+        include_dsn_in_filename=False,
+        no_viable=False,
+        exclude_conditions=["SNR", "QNS"],
+        exclude_matcodes=["100x100Box", None],
+        parquet_compression="zstd",
+        db_driver="SQLite",
+        trial_codes=["T2"],
+        workers=2,
+        profile=True,
+    )
+    assert (output_dir / "T1.parquet").exists()
+    assert (output_dir / "T2.parquet").exists()
+    # The trials run on the pool's threads, which cProfile records since 3.12
+    assert threading.main_thread() not in threads
+    (stats_file,) = output_dir.glob("sparqy-profile-*.pstats")
+    functions = {function[2] for function in pstats.Stats(str(stats_file)).stats}
+    assert {
+        "process_trial",
+        "query_to_df",
+        "extract_sampleid",
+        "flag_viable",
+    } <= functions
+
+
+def test_add_where_condition():
+    query = (
+        "SELECT A, (SELECT MAX(X) FROM T2 WHERE T2.ID = T1.ID) AS M\n"
+        "FROM T1 -- WHERE in a comment\n"
+        "WHERE A = 1 OR B = 2 -- trailing comment\n"
+        "ORDER BY A"
+    )
+    result = add_where_condition(query, "C > :since")
+    assert result.endswith("AND (C > :since)\nORDER BY A")
+    assert "(A = 1 OR B = 2 -- trailing comment\n    )" in result
+    # The subquery's WHERE is left alone
+    assert "WHERE T2.ID = T1.ID)" in result
+
+    assert add_where_condition("SELECT * FROM T1;", "C = 1") == (
+        "SELECT * FROM T1\nWHERE\n    (C = 1)"
+    )
+
+
+def test_download_history_increment(sqlite_inventory, tmp_path):
+    import sqlite3
+
+    query = "SELECT * FROM history IT WHERE LAST_NAME = :trial_code ORDER BY INVENTORYID, TRANSACTION_ID"
+    dataset_dir = tmp_path / "T1_history"
+    assert (
+        download_history_increment(sqlite_inventory, query, "T1", dataset_dir, "zstd")
+        == 3
+    )
+    watermark = json.loads((dataset_dir / "_watermark.json").read_text())
+    assert watermark["transaction_id"] == 12
+
+    # Nothing new: no part file is added
+    assert (
+        download_history_increment(sqlite_inventory, query, "T1", dataset_dir, "zstd")
+        == 0
+    )
+    assert len(list(dataset_dir.glob("part-*.parquet"))) == 1
+
+    with sqlite3.connect(sqlite_inventory.database) as conn:
+        conn.execute(
+            "INSERT INTO history VALUES (2, 14, '2024-01-05 09:00:00', 'T1', 0.5)"
+        )
+    assert (
+        download_history_increment(sqlite_inventory, query, "T1", dataset_dir, "zstd")
+        == 1
+    )
+    history = pd.read_parquet(dataset_dir)
+    assert sorted(history["TRANSACTION_ID"]) == [10, 11, 12, 14]
+
+    # A full refresh replaces the dataset
+    assert (
+        download_history_increment(
+            sqlite_inventory, query, "T1", dataset_dir, "zstd", full_refresh=True
+        )
+        == 4
+    )
+    assert len(list(dataset_dir.glob("part-*.parquet"))) == 1
+
+
+def test_download_history_increment_empty_first_run(sqlite_inventory, tmp_path):
+    import sqlite3
+
+    query = "SELECT * FROM history IT WHERE LAST_NAME = :trial_code ORDER BY INVENTORYID, TRANSACTION_ID"
+    dataset_dir = tmp_path / "T3_history"
+    assert (
+        download_history_increment(sqlite_inventory, query, "T3", dataset_dir, "zstd")
+        == 0
+    )
+    assert not (dataset_dir / "_watermark.json").exists()
+
+    # The next run still downloads everything, rather than filtering on a NULL watermark
+    with sqlite3.connect(sqlite_inventory.database) as conn:
+        conn.execute(
+            "INSERT INTO history VALUES (3, 20, '2024-01-06 09:00:00', 'T3', 0.5)"
+        )
+    assert (
+        download_history_increment(sqlite_inventory, query, "T3", dataset_dir, "zstd")
+        == 1
+    )
+    assert (
+        json.loads((dataset_dir / "_watermark.json").read_text())["transaction_id"]
+        == 20
+    )
+    assert list(pd.read_parquet(dataset_dir)["TRANSACTION_ID"]) == [20]
+
+    # An old watermark without a transaction is treated as no watermark
+    (dataset_dir / "_watermark.json").write_text('{"transaction_id": null}')
+    assert (
+        download_history_increment(sqlite_inventory, query, "T3", dataset_dir, "zstd")
+        == 1
+    )
+
+
+def test_download_inventory_parquet_incremental(tmp_path, caplog):
+    import sqlite3
+
+    db_file = tmp_path / "inventory.db"
+    with sqlite3.connect(db_file) as conn:
+        conn.execute(
+            "CREATE TABLE vials (VIAL_CONTAINER_INV_ID INTEGER, LAST_NAME TEXT, "
+            "BOX_POS INTEGER, COMMENTS TEXT, TRANSACTION_ID INTEGER)"
+        )
+        conn.executemany(
+            "INSERT INTO vials VALUES (?, 'T1', ?, 'SAMPLEID:S, x', ?)",
+            [(1, 1, 100), (2, 2, 101), (3, 3, 102)],
+        )
+    connection_url = URL.create("sqlite", database=str(db_file))
+    # The change column is filtered on through its own alias
+    query = (
+        "SELECT V.VIAL_CONTAINER_INV_ID, V.LAST_NAME, V.BOX_POS, V.COMMENTS, "
+        "V.TRANSACTION_ID AS CURRENT_TRANSACTION_ID "
+        "FROM vials V WHERE LAST_NAME = :trial_code"
+    )
+    parquet_file = tmp_path / "T1.parquet"
+
+    def download(**kwargs):
+        return download_inventory_parquet(
+            connection_url,
+            query,
+            "T1",
+            parquet_file,
+            no_viable=True,
+            exclude_conditions=[],
+            exclude_matcodes=[],
+            parquet_compression="zstd",
+            incremental=True,
+            **kwargs,
+        )
+
+    assert download() == 3
+    with sqlite3.connect(db_file) as conn:
+        # Vial 2 moves and vial 4 is added
+        conn.execute(
+            "UPDATE vials SET BOX_POS = 20, TRANSACTION_ID = 103 "
+            "WHERE VIAL_CONTAINER_INV_ID = 2"
+        )
+        conn.execute("INSERT INTO vials VALUES (4, 'T1', 4, 'LAB_ID:4', 104)")
+        # Without a new transaction this edit isn't picked up incrementally
+        conn.execute("UPDATE vials SET BOX_POS = 30 WHERE VIAL_CONTAINER_INV_ID = 3")
+    with caplog.at_level("WARNING"):
+        assert download(stream=True) == 4
+    assert "--stream is ignored" in caplog.text
+    merged = pd.read_parquet(parquet_file).set_index("VIAL_CONTAINER_INV_ID")
+    assert merged["BOX_POS"].to_dict() == {1: 1, 2: 20, 3: 3, 4: 4}
+    assert merged.loc[4, "SAMPLEID2"] == "4"
+
+    assert download(full_refresh=True) == 4
+    refreshed = pd.read_parquet(parquet_file).set_index("VIAL_CONTAINER_INV_ID")
+    assert refreshed.loc[3, "BOX_POS"] == 30
+
+
+@pytest.mark.parametrize(
+    "fetch_engine, dtype_backend", [("arrow", None), ("pandas", "pyarrow")]
+)
+@pytest.mark.parametrize("stream", [False, True])
+def test_arrow_categories_read_back(
+    sqlite_inventory, tmp_path, fetch_engine, dtype_backend, stream
+):
+    parquet_file = tmp_path / "T1.parquet"
+    download_inventory_parquet(
+        sqlite_inventory,
+        INVENTORY_QUERY,
+        "T1",
+        parquet_file,
+        no_viable=False,
+        exclude_conditions=["SNR", "QNS"],
+        exclude_matcodes=["100x100Box", None],
+        parquet_compression="zstd",
+        stream=stream,
+        chunk_size=3,
+        fetch_engine=fetch_engine,
+        dtype_backend=dtype_backend,
+        schema={"MATCODE": "category"},
+        dictionary_threshold=0.5,
+    )
+    assert pa.types.is_dictionary(pq.read_schema(parquet_file).field("MATCODE").type)
+    # A plain read_parquet, like the incremental merge does
+    df = pd.read_parquet(parquet_file)
+    assert isinstance(df["MATCODE"].dtype, pd.CategoricalDtype)
+    assert df["MATCODE"].iloc[[0, 2]].tolist() == ["Box", "100x100Box"]
+    assert pd.isna(df["MATCODE"][1])
+    assert len(df) == 7
+
+
+def test_project_columns(sqlite_inventory):
+    query = parse_sql_file(BASE_DIR / "trial_inventory.sql")
+    names = [name for name, _ in select_items(query)]
+    assert len(names) == len(set(names))
+    assert {
+        "FREEZER",
+        "LABID",
+        "MATCODE",
+        "BUILDING_NAME",
+        "CURRENT_TRANSACTION_ID",
+    } <= set(names)
+    for profile in COLUMN_PROFILES.values():
+        projected = project_columns(query, profile)
+        # Columns keep their SELECT order, and the rest of the query is untouched
+        assert [name for name, _ in select_items(projected)] == [
+            name for name in names if name in profile
+        ]
+        assert projected.endswith(query[query.index("FROM INVENTORY_VLA") :])
+    with pytest.raises(ValueError, match="NOT_A_COLUMN"):
+        project_columns(query, ["CID", "NOT_A_COLUMN"])
+
+    query = (
+        "SELECT VIAL_CONTAINER_INV_ID, LAST_NAME AS [TRIAL], (AMOUNTLEFT * 2) AS DOUBLE,"
+        " COMMENTS FROM inventory WHERE LAST_NAME = :trial_code"
+    )
+    df = query_to_df(
+        sqlite_inventory, project_columns(query, ["COMMENTS", "DOUBLE"]), "T1"
+    )
+    assert list(df.columns) == ["DOUBLE", "COMMENTS"]
+    assert len(df) == 7
+
+
+@pytest.mark.parametrize(
+    "exclude_conditions, exclude_matcodes",
+    [
+        (["SNR", "QNS"], ["100x100Box", None]),
+        (["SNR", None], []),
+        ([], ["Box"]),
+    ],
+)
+def test_viability_condition_matches_flag_viable(
+    sqlite_inventory, exclude_conditions, exclude_matcodes
+):
+    df = flag_viable(
+        query_to_df(sqlite_inventory, INVENTORY_QUERY, "T1"),
+        exclude_conditions,
+        exclude_matcodes,
+    )
+    expected = df.loc[df["VIABLE"], "VIAL_CONTAINER_INV_ID"].tolist()
+    condition, params = viability_condition(
+        INVENTORY_QUERY, exclude_conditions, exclude_matcodes
+    )
+    viable = query_to_df(
+        sqlite_inventory,
+        add_where_condition(INVENTORY_QUERY, condition),
+        "T1",
+        params=params,
+    )
+    assert viable["VIAL_CONTAINER_INV_ID"].tolist() == expected
+
+
+def test_viability_condition_keeps_nulls_at_most(sqlite_inventory, tmp_path):
+    # Without an is_null rule, a NULL AMOUNTLEFT is viable
+    rules_file = tmp_path / "rules.toml"
+    rules_file.write_text(
+        '[[rules]]\nname = "EMPTY"\ncolumn = "AMOUNTLEFT"\ntest = "at_most"\nvalue = 0\n'
+    )
+    rules = load_viability_rules(rules_file)
+    df = flag_viable(
+        query_to_df(sqlite_inventory, INVENTORY_QUERY, "T1"), [], [], rules=rules
+    )
+    expected = df.loc[df["VIABLE"], "VIAL_CONTAINER_INV_ID"].tolist()
+    assert 7 in expected
+    condition, params = viability_condition(INVENTORY_QUERY, [], [], rules=rules)
+    viable = query_to_df(
+        sqlite_inventory,
+        add_where_condition(INVENTORY_QUERY, condition),
+        "T1",
+        params=params,
+    )
+    assert viable["VIAL_CONTAINER_INV_ID"].tolist() == expected
+
+
+def test_viability_condition_uses_select_expressions():
+    query = parse_sql_file(BASE_DIR / "trial_inventory.sql")
+    condition, params = viability_condition(query, ["QNS"], ["100x100Box", None])
+    assert "SC.RECEIVEDCONDITION IS NULL OR" in condition
+    assert "INV_META.FIELD16 NOT IN (:exclude_condition_" in condition
+    assert "PARENT_CONTAINER.MATCODE IS NOT NULL AND" in condition
+    assert "(IT.AMOUNTLEFT IS NULL OR IT.AMOUNTLEFT > 0)" in condition
+    assert sorted(params.values()) == ["100x100Box", "QNS", "QNS"]
+
+
+@pytest.mark.parametrize("sql_file", ["trial_inventory.sql", "inventory_history.sql"])
+def test_schema_manifest_columns(sql_file):
+    schema = load_schema(BASE_DIR / sql_file)
+    assert schema
+    names = {name for name, _ in select_items(parse_sql_file(BASE_DIR / sql_file))}
+    assert set(schema) <= names
+
+
+def test_narrow_query_matches_trial_inventory():
+    query = parse_sql_file(BASE_DIR / "trial_inventory.sql")
+    narrow_query, locations_query, column_order = load_location_queries(
+        BASE_DIR / "trial_inventory.sql", query
+    )
+    assert "JOIN LOCATIONS" not in narrow_query
+    assert column_order == [name for name, _ in select_items(query)]
+    narrow_columns = [name for name, _ in select_items(narrow_query)]
+    assert narrow_columns == [
+        name
+        for name in column_order
+        if name not in LOCATION_COLUMNS or name == LOCATION_KEY_COLUMN
+    ]
+    assert {name for name, _ in select_items(locations_query)} >= {
+        "LOCATIONCODE",
+        "PARENT_LOCATION_CODE",
+        "LOCATION_NAME",
+    }
+
+    # A column selection narrows the narrow query the same way
+    selected = project_columns(query, ["CID", "FREEZER", "COMMENTS"])
+    narrow_query, _, column_order = load_location_queries(
+        BASE_DIR / "trial_inventory.sql", selected
+    )
+    assert column_order == ["CID", "FREEZER", "COMMENTS"]
+    assert [name for name, _ in select_items(narrow_query)] == [
+        "CID",
+        "COMMENTS",
+        "RACK_CODE",
+    ]
+
+
+@pytest.fixture
+def sqlite_locations(tmp_path):
+    """Vials stored two and three levels deep, and under a building-level location."""
+    import sqlite3
+
+    db_file = tmp_path / "locations.db"
+    with sqlite3.connect(db_file) as conn:
+        conn.execute(
+            "CREATE TABLE LOCATIONS (LOCATIONCODE TEXT, PARENT_LOCATION_CODE TEXT, "
+            "LOCATION_NAME TEXT, SORTER INTEGER, LONGNAME TEXT, LONGCODE TEXT, "
+            "ROOM_ID INTEGER)"
+        )
+        conn.executemany(
+            "INSERT INTO LOCATIONS VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                ("SITE", None, "Site", 1, "Site", "S", None),
+                ("F1", "SITE", "Freezer 1", 1, "F1", "F1", 1),
+                ("S1", "F1", "Shelf 1", 2, "F1 > S1", "F1S1", None),
+                ("R1", "S1", "Rack 1", 3, "F1 > S1 > R1", "F1S1R1", None),
+                ("F2", None, "Freezer 2", 2, "F2", "F2", 2),
+                ("S2", "F2", "Shelf 2", 1, "F2 > S2", "F2S2", None),
+                ("R2", "S2", "Rack 2", 5, "F2 > S2 > R2", "F2S2R2", None),
+            ],
+        )
+        conn.execute(
+            "CREATE TABLE ROOMS (ROOM_ID INTEGER, ROOM_NAME TEXT, ROOM_CODE TEXT, BUILDING_ID INTEGER)"
+        )
+        conn.executemany(
+            "INSERT INTO ROOMS VALUES (?, ?, ?, ?)",
+            [(1, "Room 1", "R01", 1), (2, "Room 2", "R02", None)],
+        )
+        conn.execute(
+            "CREATE TABLE BUILDINGS (BUILDING_ID INTEGER, BUILDING_NAME TEXT, BUILDING_CODE TEXT)"
+        )
+        conn.execute("INSERT INTO BUILDINGS VALUES (1, 'Building 1', 'B1')")
+        conn.execute("CREATE TABLE VIALS (ID INTEGER, LOCATIONCODE TEXT)")
+        conn.executemany(
+            "INSERT INTO VIALS VALUES (?, ?)",
+            [
+                (1, "R1"),
+                (2, "S1"),
+                (3, "R2"),
+                (4, "S2"),
+                (5, "F2"),
+                (6, "GONE"),
+                (7, None),
+            ],
+        )
+    return URL.create("sqlite", database=str(db_file))
+
+
+LOCATION_JOINS_QUERY = """
+SELECT
+    V.ID
+    , CASE WHEN FREEZER.LOCATIONCODE IS NOT NULL THEN FREEZER.LOCATION_NAME ELSE SHELF.LOCATION_NAME END AS FREEZER
+    , CASE WHEN FREEZER.LOCATIONCODE IS NOT NULL THEN SHELF.LOCATION_NAME ELSE RACK.LOCATION_NAME END AS SHELF
+    , CASE WHEN FREEZER.LOCATIONCODE IS NOT NULL THEN RACK.LOCATION_NAME ELSE NULL END AS RACK
+    , RACK.LOCATIONCODE AS RACK_CODE
+    , SHELF.SORTER AS SHELF_SORT
+    , RACK.SORTER AS RACK_SORT
+    , RACK.LONGNAME
+    , RACK.LONGCODE
+    , ROOMS.ROOM_NAME
+    , ROOMS.ROOM_CODE
+    , BUILDINGS.BUILDING_NAME AS BUILDING_NAME
+    , BUILDINGS.BUILDING_CODE AS BUILDING_CODE
+FROM VIALS V
+    LEFT JOIN LOCATIONS RACK ON V.LOCATIONCODE = RACK.LOCATIONCODE
+    LEFT JOIN LOCATIONS SHELF ON RACK.PARENT_LOCATION_CODE = SHELF.LOCATIONCODE
+    LEFT JOIN LOCATIONS FREEZER ON SHELF.PARENT_LOCATION_CODE = FREEZER.LOCATIONCODE
+    LEFT JOIN ROOMS ON FREEZER.ROOM_ID = ROOMS.ROOM_ID
+    LEFT JOIN BUILDINGS ON ROOMS.BUILDING_ID = BUILDINGS.BUILDING_ID
+ORDER BY V.ID
+"""
+
+
+def test_resolve_locations_matches_joins(sqlite_locations, tmp_path):
+    import sqlite3
+
+    expected = query_to_df(sqlite_locations, LOCATION_JOINS_QUERY)
+    narrow = query_to_df(
+        sqlite_locations, "SELECT ID, LOCATIONCODE AS RACK_CODE FROM VIALS ORDER BY ID"
+    )
+    locations_query = parse_sql_file(BASE_DIR / "locations.sql")
+    cache_dir = tmp_path / "cache"
+    locations = load_locations(sqlite_locations, locations_query, cache_dir)
+    resolved = resolve_locations(narrow, locations, list(expected.columns))
+    assert list(resolved.columns) == list(expected.columns) + ["LOCATION_PATH"]
+    assert (
+        resolved[expected.columns]
+        .astype(object)
+        .where(resolved.notna(), None)
+        .values.tolist()
+        == expected.astype(object).where(expected.notna(), None).values.tolist()
+    )
+    assert resolved["LOCATION_PATH"].tolist()[:3] == [
+        "Site > Freezer 1 > Shelf 1 > Rack 1",
+        "Site > Freezer 1 > Shelf 1",
+        "Freezer 2 > Shelf 2 > Rack 2",
+    ]
+    assert resolved["LOCATION_PATH"].isna().tolist()[-2:] == [True, True]
+
+    # The dimension is served from the cache until it expires
+    with sqlite3.connect(sqlite_locations.database) as conn:
+        conn.execute("DELETE FROM LOCATIONS")
+    cached = load_locations(sqlite_locations, locations_query, cache_dir)
+    pd.testing.assert_frame_equal(cached, locations)
+    assert load_locations(
+        sqlite_locations, locations_query, cache_dir, cache_ttl=0
+    ).empty
+
+
+def test_apply_schema(sqlite_inventory, tmp_path, caplog):
+    schema = {
+        "VIAL_CONTAINER_INV_ID": "Int32",
+        "MATCODE": "category",
+        "AMOUNTLEFT": "decimal(10, 2)",
+        "NOT_SELECTED": "Int16",
+    }
+    df = query_to_df(sqlite_inventory, INVENTORY_QUERY, "T1")
+    with caplog.at_level("INFO"):
+        compact = apply_schema(df.copy(), schema, report=True)
+    assert "bytes_saved" in caplog.text
+    assert str(compact["VIAL_CONTAINER_INV_ID"].dtype) == "Int32"
+    assert isinstance(compact["MATCODE"].dtype, pd.CategoricalDtype)
+    assert str(compact["AMOUNTLEFT"].dtype) == "decimal128(10, 2)[pyarrow]"
+    # Viability flags are unchanged on the compact types
+    assert (
+        flag_viable(compact, ["SNR", "QNS"], ["100x100Box", None])["VIABLE"].tolist()
+        == flag_viable(df, ["SNR", "QNS"], ["100x100Box", None])["VIABLE"].tolist()
+    )
+    with pytest.raises((TypeError, ValueError)):
+        apply_schema(pd.DataFrame({"BOX_POS": [40_000]}), {"BOX_POS": "Int16"})
+
+    # Streamed chunks keep the manifest types rather than the described ones
+    out_file = tmp_path / "compact.parquet"
+    query_to_parquet(
+        sqlite_inventory,
+        INVENTORY_QUERY,
+        out_file,
+        trial_code="T1",
+        chunk_size=3,
+        schema=schema,
+    )
+    arrow_schema = pq.read_schema(out_file)
+    assert str(arrow_schema.field("VIAL_CONTAINER_INV_ID").type) == "int32"
+    assert pa.types.is_dictionary(arrow_schema.field("MATCODE").type)
+    assert pd.read_parquet(out_file)["MATCODE"].tolist() == compact["MATCODE"].tolist()
+
+
+def test_dictionary_encode(sqlite_inventory, tmp_path):
+    df = pd.DataFrame(
+        {
+            "SAMPLETYPE": ["Plasma", "Serum"] * 50,
+            "CID": [f"C{i:04d}" for i in range(100)],
+            "EMPTY": [None] * 100,
+            "THAWCOUNT": [0, 1] * 50,
+        }
+    )
+    encoded = dictionary_encode(df, 0.05)
+    assert isinstance(encoded["SAMPLETYPE"].dtype, pd.CategoricalDtype)
+    assert not any(
+        isinstance(encoded[column].dtype, pd.CategoricalDtype)
+        for column in ["CID", "EMPTY", "THAWCOUNT"]
+    )
+    assert dictionary_encode(df, 0) is df
+    parquet_file = tmp_path / "encoded.parquet"
+    encoded.to_parquet(parquet_file)
+    assert pa.types.is_dictionary(pq.read_schema(parquet_file).field("SAMPLETYPE").type)
+
+    # Streamed chunks all use the columns chosen for the first chunk
+    out_file = tmp_path / "streamed.parquet"
+    query_to_parquet(
+        sqlite_inventory,
+        INVENTORY_QUERY,
+        out_file,
+        trial_code="T1",
+        chunk_size=4,
+        dictionary_threshold=0.5,
+    )
+    arrow_schema = pq.read_schema(out_file)
+    assert pa.types.is_dictionary(arrow_schema.field("LAST_NAME").type)
+    assert not pa.types.is_dictionary(arrow_schema.field("COMMENTS").type)
+    assert pd.read_parquet(out_file)["LAST_NAME"].tolist() == ["T1"] * 7
+
+
+@pytest.mark.parametrize("fetch_engine", ["pandas", "arrow"])
+def test_pyarrow_dtype_backend(sqlite_inventory, tmp_path, fetch_engine):
+    df = query_to_df(
+        sqlite_inventory,
+        INVENTORY_QUERY,
+        "T1",
+        fetch_engine=fetch_engine,
+        dtype_backend="pyarrow",
+    )
+    assert all(isinstance(dtype, pd.ArrowDtype) for dtype in df.dtypes)
+    df = transform_inventory(df, False, ["SNR", "QNS"], ["100x100Box", None])
+    assert all(isinstance(dtype, pd.ArrowDtype) for dtype in df.dtypes)
+    assert df["VIABLE"].tolist() == [True, False, False, False, False, False, False]
+    assert df["SAMPLEID"].iloc[0] == "A-1"
+    assert df["SAMPLEID2"].iloc[1] == "22"
+
+    compact = apply_schema(
+        df, {"MATCODE": "category", "VIAL_CONTAINER_INV_ID": "Int32"}
+    )
+    assert isinstance(compact["MATCODE"].dtype, pd.CategoricalDtype)
+    assert compact["VIAL_CONTAINER_INV_ID"].dtype == pd.ArrowDtype(pa.int32())
+    encoded = dictionary_encode(compact, 0.5)
+    assert isinstance(encoded["LAST_NAME"].dtype, pd.CategoricalDtype)
+
+    parquet_file = tmp_path / "arrow.parquet"
+    encoded.to_parquet(parquet_file)
+    assert pa.types.is_dictionary(pq.read_schema(parquet_file).field("MATCODE").type)
+    for round_trip in [
+        pd.read_parquet(parquet_file),
+        pd.read_parquet(parquet_file, dtype_backend="pyarrow"),
+    ]:
+        assert round_trip["VIABLE"].tolist() == df["VIABLE"].tolist()
+        matcodes = round_trip["MATCODE"].astype(object)
+        assert matcodes.where(matcodes.notna(), None).tolist() == [
+            None if pd.isna(matcode) else matcode for matcode in df["MATCODE"]
+        ]
+
+    # numpy asks the arrow engine for the default pandas dtypes
+    numpy_df = query_to_df(
+        sqlite_inventory,
+        INVENTORY_QUERY,
+        "T1",
+        fetch_engine="arrow",
+        dtype_backend="numpy",
+    )
+    assert not any(isinstance(dtype, pd.ArrowDtype) for dtype in numpy_df.dtypes)
+
+
+@pytest.mark.parametrize(
+    "fetch_engine, use_schema",
+    [("pandas", False), ("arrow", False), ("pandas", True), ("arrow", True)],
+)
+def test_polars_engine_matches_pandas(tmp_path, fetch_engine, use_schema):
+    pytest.importorskip("polars")
+    engine = create_db_engine(
+        write_sqlite(tmp_path / "synthetic.db", 3000, trial_code="P1")
+    )
+    schema = load_schema(BASE_DIR / "trial_inventory.sql") if use_schema else None
+    fields = comment_fields(["SITE"])
+    outputs = {}
+    for transform_engine in ["pandas", "polars"]:
+        outputs[transform_engine] = tmp_path / f"{transform_engine}.parquet"
+        download_inventory_parquet(
+            engine,
+            SQLITE_INVENTORY_QUERY,
+            "P1",
+            outputs[transform_engine],
+            False,
+            ["SNR", "QNSR", "QNS", "NSI"],
+            ["100x100Box", None],
+            "zstd",
+            fetch_engine=fetch_engine,
+            schema=schema,
+            comment_fields=fields,
+            transform_engine=transform_engine,
+        )
+    expected = pq.read_table(outputs["pandas"])
+    result = pq.read_table(outputs["polars"])
+    assert result.column_names == expected.column_names
+    assert result.num_rows == 3000
+    for name in expected.column_names:
+        assert result[name].to_pylist() == expected[name].to_pylist(), name
+    assert result.schema.field("NONVIABLE_REASON").type == pa.uint8()
+    assert 0 < sum(result["VIABLE"].to_pylist()) < 3000
+
+
+def test_polars_transform_inventory(sqlite_inventory, tmp_path):
+    pytest.importorskip("polars")
+    df = query_to_df(sqlite_inventory, INVENTORY_QUERY, "T1")
+    expected = transform_inventory(
+        df.copy(), False, ["SNR", "QNS"], ["100x100Box", None]
+    )
+    result = polars_transform_inventory(
+        df, False, ["SNR", "QNS"], ["100x100Box", None]
+    ).collect()
+    assert result.columns == list(expected.columns)
+    for name in ["SAMPLEID", "SAMPLEID2", "VIABLE", "NONVIABLE_REASON"]:
+        assert (
+            result[name].to_list()
+            == expected[name]
+            .astype(object)
+            .where(expected[name].notna(), None)
+            .tolist()
+        )
+    rules = load_viability_rules()
+    counts = polars_inventory_to_parquet(
+        df,
+        tmp_path / "inventory.parquet",
+        None,
+        False,
+        ["SNR", "QNS"],
+        ["100x100Box", None],
+    )
+    reasons = pd.read_parquet(tmp_path / "inventory.parquet")["NONVIABLE_REASON"]
+    assert counts == {
+        rule["name"]: int(((reasons & (1 << bit)) != 0).sum())
+        for bit, rule in enumerate(rules)
+    }
+    without = polars_transform_inventory(df, True, [], []).collect()
+    assert "VIABLE" not in without.columns
+    with pytest.raises(ValueError):
+        polars_transform_inventory(
+            df,
+            True,
+            [],
+            [],
+            comment_fields={"N": {"key": "N", "value": r"\d+", "dtype": "Int32"}},
+        )
+
+
+def test_synthetic_columns_match_sql():
+    inventory = synthetic_inventory(500)
+    history = synthetic_history(inventory)
+    assert list(inventory.columns) == sql_columns(BASE_DIR / "trial_inventory.sql")
+    assert list(history.columns) == sql_columns(BASE_DIR / "inventory_history.sql")
+    # Each vial's last transaction is its current one
+    current = history[history["FLAG_CURRENT"] == 1]
+    assert (
+        current["INVENTORYID"].tolist() == inventory["VIAL_CONTAINER_INV_ID"].tolist()
+    )
+    assert (
+        current["TRANSACTION_ID"].tolist()
+        == inventory["CURRENT_TRANSACTION_ID"].tolist()
+    )
+    # Chunks are reproducible and continue the vial numbering
+    chunk = synthetic_inventory(300, start=500)
+    pd.testing.assert_frame_equal(chunk, synthetic_inventory(300, start=500))
+    assert chunk["VIAL_CONTAINER_INV_ID"].iloc[0] == (
+        inventory["VIAL_CONTAINER_INV_ID"].iloc[-1] + 1
+    )
+
+
+def test_write_sqlite(tmp_path, monkeypatch):
+    import synthetic
+
+    monkeypatch.setattr(synthetic, "SQLITE_CHUNK_SIZE", 700)
+    url = write_sqlite(tmp_path / "synthetic.db", 2_000, trial_code="T1")
+    write_sqlite(tmp_path / "synthetic.db", 100, trial_code="T2", history=False)
+
+    df = query_to_df(url, SQLITE_INVENTORY_QUERY, "T1")
+    assert len(df) == 2_000
+    assert df["VIAL_CONTAINER_INV_ID"].is_unique
+    df = transform_inventory(df, False, ["SNR", "QNSR", "QNS", "NSI"], ["100x100Box"])
+    # The generated data exercises both sides of every rule
+    assert df["VIABLE"].any() and not df["VIABLE"].all()
+    assert df["SAMPLEID"].notna().any() and df["SAMPLEID"].isna().any()
+    assert df["SAMPLEID2"].notna().any()
+
+    history = query_to_df(url, SQLITE_HISTORY_QUERY, "T1")
+    assert set(history["INVENTORYID"]) == set(df["VIAL_CONTAINER_INV_ID"])
+    assert query_to_df(url, SQLITE_HISTORY_QUERY, "T2").empty
+
+
+def test_bench_pipeline_baseline(tmp_path):
+    from benchmarks import (
+        PIPELINE_STAGES,
+        bench_pipeline,
+        compare_to_baseline,
+        load_results,
+        save_results,
+    )
+
+    results = bench_pipeline(
+        [300], repeat=1, work_dir=tmp_path, dtype_backends=["numpy", "pyarrow"]
+    )
+    assert results["stage"].tolist() == list(PIPELINE_STAGES) * 2
+    assert results["dtype_backend"].tolist() == ["numpy"] * 5 + ["pyarrow"] * 5
+    assert (results["seconds"] > 0).all()
+    assert (tmp_path / "BENCH300.parquet").exists()
+
+    baseline = load_results(save_results(results, tmp_path / "baseline.json"))
+    assert not compare_to_baseline(results, baseline)["regressed"].any()
+    slower = results.assign(seconds=results["seconds"] * 1.5)
+    comparison = compare_to_baseline(slower, baseline, threshold=0.2)
+    assert comparison["regressed"].all()
+    assert not compare_to_baseline(slower, baseline, threshold=1)["regressed"].any()
+
+
+def test_bench_compare_requires_baseline(tmp_path, monkeypatch, capsys):
+    import sys
+
+    from benchmarks import parse_args
+
+    monkeypatch.setattr(
+        sys, "argv", ["benchmarks.py", "--compare", str(tmp_path / "missing.json")]
+    )
+    with pytest.raises(SystemExit):
+        parse_args()
+    assert "No baseline at" in capsys.readouterr().err
+    (tmp_path / "baseline.json").write_text("[]")
+    monkeypatch.setattr(
+        sys, "argv", ["benchmarks.py", "--compare", str(tmp_path / "baseline.json")]
+    )
+    assert parse_args().compare == str(tmp_path / "baseline.json")
+
+
+@pytest.mark.parametrize("fetch_engine", ["pandas", "arrow"])
+def test_record_and_replay(sqlite_inventory, tmp_path, fetch_engine):
+    from benchmarks import ReplayCursor, fetch_with_engine
+
+    df = query_to_df(
+        sqlite_inventory,
+        INVENTORY_QUERY,
+        "T1",
+        fetch_engine=fetch_engine,
+        record_dir=tmp_path,
+    )
+    (recording_file,) = tmp_path.glob("T1-*.arrow")
+    table, description, info = read_recording(recording_file)
+    assert info["query"] == INVENTORY_QUERY
+    assert info["params"] == {"trial_code": "T1"}
+    assert [column[0] for column in description] == list(df.columns)
+
+    cursor = ReplayCursor.from_recording(recording_file)
+    assert cursor.fetchone() == (1, "T1", "Box", "Good", "Good", 1.0, "SAMPLEID:A-1, x")
+    cursor.rewind()
+    replayed = fetch_with_engine(cursor, fetch_engine)
+    pd.testing.assert_frame_equal(replayed, df)
+    assert cursor.fetchall() == []
+
+
+def test_recording_keeps_description_types(tmp_path):
+    import datetime
+    import decimal
+
+    description = [
+        ("ID", int, None, 10, 10, 0, False),
+        ("AMOUNT", decimal.Decimal, None, 10, 10, 2, True),
+        ("WHEN", datetime.datetime, None, 23, 23, 3, True),
+    ]
+    rows = [
+        (1, decimal.Decimal("1.50"), datetime.datetime(2024, 1, 1, 9, 30)),
+        (2, None, None),
+    ]
+    recording_file = write_recording(
+        tmp_path / "types.arrow", rows_to_arrow(rows, description), description
+    )
+    table, replayed_description, _ = read_recording(recording_file)
+    assert replayed_description == description
+    assert table.schema.field("AMOUNT").type == pa.decimal128(10, 2)
+    assert list(zip(*(column.to_pylist() for column in table.columns))) == rows
+
+
+def test_read_trial_codes_file(tmp_path):
+    trial_codes_file = tmp_path / "trials.txt"
+    trial_codes_file.write_text("# nightly trials\n10KFS\n\n  ABC-1  \n")
+    assert read_trial_codes_file(trial_codes_file) == ["10KFS", "ABC-1"]
+
+
+def test_cached_query_to_df(sqlite_inventory, tmp_path):
+    import sqlite3
+
+    cache_dir = tmp_path / "cache"
+    first = cached_query_to_df(sqlite_inventory, INVENTORY_QUERY, "T1", cache_dir)
+    assert len(list(cache_dir.glob("*.arrow"))) == 1
+
+    with sqlite3.connect(sqlite_inventory.database) as conn:
+        conn.execute("DELETE FROM inventory WHERE LAST_NAME = 'T1'")
+
+    # A hit skips the database entirely
+    cached = cached_query_to_df(sqlite_inventory, INVENTORY_QUERY, "T1", cache_dir)
+    pd.testing.assert_frame_equal(cached, first)
+    # Different parameters are a different key
+    assert (
+        len(cached_query_to_df(sqlite_inventory, INVENTORY_QUERY, "T2", cache_dir)) == 1
+    )
+    # Refreshing re-runs the query and replaces the cached result
+    refreshed = cached_query_to_df(
+        sqlite_inventory, INVENTORY_QUERY, "T1", cache_dir, refresh_cache=True
+    )
+    assert len(refreshed) == 0
+    assert (
+        len(cached_query_to_df(sqlite_inventory, INVENTORY_QUERY, "T1", cache_dir)) == 0
+    )
+    # Expired results are ignored
+    with sqlite3.connect(sqlite_inventory.database) as conn:
+        conn.execute("INSERT INTO inventory (LAST_NAME) VALUES ('T1')")
+    expired = cached_query_to_df(
+        sqlite_inventory, INVENTORY_QUERY, "T1", cache_dir, cache_ttl=-1
+    )
+    assert len(expired) == 1
+
+
+def test_cached_query_to_df_keys_on_types(sqlite_inventory, tmp_path, monkeypatch):
+    import main as sparqy
+
+    cache_dir = tmp_path / "cache"
+    schema = {"VIAL_CONTAINER_INV_ID": "Int16"}
+    cached_query_to_df(sqlite_inventory, INVENTORY_QUERY, "T1", cache_dir)
+    typed = cached_query_to_df(
+        sqlite_inventory, INVENTORY_QUERY, "T1", cache_dir, schema=schema
+    )
+    assert str(typed["VIAL_CONTAINER_INV_ID"].dtype) == "Int16"
+    encoded = cached_query_to_df(
+        sqlite_inventory,
+        INVENTORY_QUERY,
+        "T1",
+        cache_dir,
+        schema=schema,
+        dictionary_threshold=1,
+    )
+    assert isinstance(encoded["LAST_NAME"].dtype, pd.CategoricalDtype)
+    # --no_schema, a manifest and a dictionary threshold each get their own entry
+    assert len(list(cache_dir.glob("*.arrow"))) == 3
+    plain = cached_query_to_df(sqlite_inventory, INVENTORY_QUERY, "T1", cache_dir)
+    assert str(plain["VIAL_CONTAINER_INV_ID"].dtype) != "Int16"
+
+    # A result evicted between the exists() check and the read is a miss
+    def evicted(*args, **kwargs):
+        raise FileNotFoundError("evicted")
+
+    monkeypatch.setattr(sparqy.pd, "read_feather", evicted)
+    assert sparqy.read_query_cache(cache_dir, "missing", 3600) is None
+    key = sparqy.query_cache_key(
+        sqlite_inventory, INVENTORY_QUERY, sparqy.query_params("T1"), schema
+    )
+    assert (cache_dir / f"{key}.arrow").exists()
+    assert sparqy.read_query_cache(cache_dir, key, 3600) is None
+
+
+def test_evict_query_cache(tmp_path):
+    for i, name in enumerate(["old", "recent", "newest"]):
+        cache_file = tmp_path / f"{name}.arrow"
+        cache_file.write_bytes(b"x" * 100)
+        os.utime(cache_file, (1_000 + i, cache_file.stat().st_mtime))
+    evict_query_cache(tmp_path, ttl=3600, max_bytes=250)
+    assert sorted(path.stem for path in tmp_path.glob("*.arrow")) == [
+        "newest",
+        "recent",
+    ]
+
+
+def test_evict_query_cache_races(tmp_path, monkeypatch):
+    import threading
+
+    import main as sparqy
+
+    (tmp_path / "kept.arrow").write_bytes(b"x" * 100)
+    glob = Path.glob
+
+    # Another trial evicts a result between the listing and the stat
+    def glob_with_evicted(self, pattern):
+        return [self / "evicted.arrow", *glob(self, pattern)]
+
+    monkeypatch.setattr(Path, "glob", glob_with_evicted)
+    evict_query_cache(tmp_path, ttl=3600, max_bytes=250)
+    monkeypatch.undo()
+    assert [path.name for path in tmp_path.glob("*.arrow")] == ["kept.arrow"]
+
+    # Concurrent writers of the same file get their own temporary files
+    names = []
+    thread = threading.Thread(
+        target=lambda: names.append(sparqy.temp_file_path(tmp_path / "a.arrow"))
+    )
+    thread.start()
+    thread.join()
+    assert names[0] != sparqy.temp_file_path(tmp_path / "a.arrow")
+
+
+def test_cursor_to_arrow_types_from_description():
+    import datetime
+    import decimal
+    import pyarrow as pa
+
+    class Cursor:
+        description = [
+            ("ID", int, None, 10, 10, 0, False),
+            ("AMOUNT", decimal.Decimal, None, 10, 10, 2, True),
+            ("WHEN", datetime.datetime, None, 23, 23, 3, True),
+            ("NOTE", None, None, None, None, None, True),
+        ]
+
+        def __init__(self):
+            self.rows = [
+                (1, decimal.Decimal("1.50"), datetime.datetime(2024, 1, 1), None),
+                (2, None, None, "text"),
+            ]
+
+        def fetchmany(self, size):
+            rows, self.rows = self.rows[:size], self.rows[size:]
+            return rows
+
+    table = cursor_to_arrow(Cursor(), batch_size=1)
+    assert table.schema.field("ID").type == pa.int64()
+    assert table.schema.field("AMOUNT").type == pa.decimal128(10, 2)
+    assert table.schema.field("WHEN").type == pa.timestamp("us")
+    # Untyped columns are inferred from the first non-NULL batch
+    assert table.schema.field("NOTE").type == pa.string()
+    assert table.column("NOTE").to_pylist() == [None, "text"]
+
+
 @pytest.mark.skipif(
     not RUN_DB_TESTS,
     reason="Skipping DB tests in GitHub Actions or if DB_HOST is missing.",
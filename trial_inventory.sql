@@ -77,6 +77,7 @@ SELECT
     , INV.INVENTORYID AS [VIAL_CONTAINER_INV_ID]
     , PARENT_CONTAINER.INVENTORYID AS [PARENT_CONTAINER_INV_ID]
     , CR.ORIGREC AS [CR_ORIGREC]
+    , IT.TRANSACTION_ID AS [CURRENT_TRANSACTION_ID]
 FROM INVENTORY_VLA INV
     INNER JOIN CENTRALRECEIVING_VLA CR ON CR.EXTERNAL_ID = INV.EXTERNAL_ID
     INNER JOIN SAMPLECONTAINERS_VLA SC ON SC.INVENTORYID = INV.INVENTORYID